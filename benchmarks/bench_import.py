@@ -0,0 +1,66 @@
+"""
+Measure the time taken by `import mattermostpython` using `python -X importtime`, as paid by every
+short-lived script which sends a message. Each run is a fresh interpreter, after one warm-up run so
+that the bytecode cache is populated. Exits with an error if the median is over the target
+
+    python -m benchmarks.bench_import [-n RUNS] [--target MILLISECONDS]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+####################################################################################################
+def import_time(module : str, env : dict) -> tuple:
+    """
+    Import module in a fresh interpreter, and return the cumulative import time of the module in
+    seconds and a list of (seconds, name) for the modules it imported
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    total = None
+    imported = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if name.strip() == module:
+            total = int(cumulative_us) / 1e6
+            break
+
+        # Modules imported by module are listed, indented, just before it
+        if name[1:] == name.lstrip():
+            imported = []
+        else:
+            imported.append( (int(self_us) / 1e6, name.strip()) )
+    return total, imported
+
+####################################################################################################
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=10, help='number of runs')
+    parser.add_argument('--target', type=float, default=20.0, help='target median import time in ms')
+    parser.add_argument('--module', default='mattermostpython', help='module to import')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPATH'] = os.pathsep.join([os.getcwd()] + env.get('PYTHONPATH', '').split(os.pathsep))
+
+    import_time(args.module, env)
+    runs = [ import_time(args.module, env) for _ in range(args.n) ]
+    median = statistics.median( x[0] for x in runs )
+
+    print(f"import {args.module}: median {1e3*median:.2f} ms, min {1e3*min(x[0] for x in runs):.2f} ms over {args.n} runs")
+    print("slowest imports:")
+    for seconds, name in sorted(runs[-1][1], reverse=True)[:10]:
+        print(f"  {1e3*seconds:7.2f} ms  {name}")
+
+    if 1e3*median > args.target:
+        print(f"FAILED: over the {args.target} ms target")
+        sys.exit(1)
+    return
+
+if __name__ == '__main__':
+    main()
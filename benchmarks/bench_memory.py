@@ -0,0 +1,40 @@
+"""
+Measure the memory held by buffered messages with tracemalloc: build N messages with a few fields,
+get their payloads (as posting them does) and report the memory still allocated per message
+
+    python -m benchmarks.bench_memory [-n MESSAGES]
+"""
+import argparse
+import gc
+import tracemalloc
+
+import mattermostpython as mp
+
+####################################################################################################
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=100000, help='number of messages to buffer')
+    args = parser.parse_args()
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    messages = []
+    for i in range(args.n):
+        message = mp.MattermostMessage(title='HV trip', text=f'channel {i}', colour='#FF0000', fields=[
+            mp.MattermostField(True, 'Run', '42'), mp.MattermostField(True, 'Channel', str(i))
+        ])
+        message.get_message_data()
+        messages.append(message)
+
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    total = sum(x.size_diff for x in after.compare_to(before, 'filename'))
+    print(f"{args.n} messages: {total/1e6:.1f} MB, {total/args.n:.0f} bytes/message")
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""
+Measure the throughput of MattermostInterface.post_many against a stand-in webhook server with a
+fixed response latency, for an increasing number of worker threads
+
+    python -m benchmarks.bench_post_many [-n MESSAGES] [--latency SECONDS]
+"""
+import argparse
+import time
+
+import mattermostpython as mp
+from benchmarks.webhook_server import StandInWebhookServer
+
+####################################################################################################
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=200, help='number of messages per run')
+    parser.add_argument('--latency', type=float, default=0.02, help='server response latency in seconds')
+    args = parser.parse_args()
+
+    messages = [ mp.MattermostMessage(title='benchmark', text=f'message {i}') for i in range(args.n) ]
+
+    with StandInWebhookServer(latency=args.latency, keep_payloads=False) as server:
+        for workers in [1, 2, 4, 8, 16, 32]:
+            with mp.MattermostInterface(server.url, pool_maxsize=workers) as interface:
+                start = time.perf_counter()
+                results = interface.post_many(messages, max_workers=workers)
+                elapsed = time.perf_counter() - start
+            ok = sum(1 for x in results if x)
+            print(f"max_workers {workers:3d}: {args.n/elapsed:8.1f} messages/s   "
+                  f"mean latency {1e3*sum(x.elapsed for x in results)/len(results):7.2f} ms   ok {ok}/{args.n}")
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Measure how long an urgent message takes to be posted by MattermostInterface.post_async when it is
+queued behind an increasing backlog of standard messages, against a stand-in webhook server with a
+fixed response latency. The latency stays bounded by a few sends however deep the backlog is
+
+    python -m benchmarks.bench_priority [--latency SECONDS] [--workers N]
+"""
+import argparse
+import time
+
+import requests # So that the first run does not pay for importing it
+
+import mattermostpython as mp
+from benchmarks.webhook_server import StandInWebhookServer
+
+####################################################################################################
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.01, help='server response latency in seconds')
+    parser.add_argument('--workers', type=int, default=2, help='number of background worker threads')
+    args = parser.parse_args()
+
+    standard = mp.MattermostMessage(text='standard').get_message_data()
+    urgent = mp.MattermostMessage(text='urgent', priority=mp.MattermostMessagePriority.URGENT)
+
+    with StandInWebhookServer(latency=args.latency) as server:
+        for backlog in [0, 100, 1000, 10000]:
+            server.payloads.clear()
+            with mp.MattermostInterface(server.url, workers=args.workers, queue_size=backlog + 1) as interface:
+                for i in range(backlog):
+                    interface.post_async(standard)
+                start = time.perf_counter()
+                interface.post_async(urgent)
+                while not any( x['attachments'][0]['text'] == 'urgent' for x in list(server.payloads) ):
+                    time.sleep(0.0005)
+                elapsed = time.perf_counter() - start
+                behind = interface.get_queue_depth()
+
+                # Let the backlog drain quickly
+                server.latency = 0.0
+                interface.flush()
+                server.latency = args.latency
+            print(f"backlog {backlog:6d}: urgent posted after {1e3*elapsed:8.2f} ms   "
+                  f"in order it would take {1e3*backlog*args.latency/args.workers:9.1f} ms   still queued {behind}")
+    return
+
+if __name__ == '__main__':
+    main()
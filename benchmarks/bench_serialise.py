@@ -0,0 +1,31 @@
+"""
+Compare the encoding throughput of the available JSON backends on a typical message payload
+
+    python -m benchmarks.bench_serialise [-n MESSAGES]
+"""
+import argparse
+import timeit
+
+import mattermostpython as mp
+
+####################################################################################################
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=100000, help='number of payloads per run')
+    args = parser.parse_args()
+
+    data = mp.MattermostMessage(title='Rate monitor', colour='#FF0000', text='Rate dropped on\n' + 'channel '*40, fields=[
+        mp.MattermostField(True, f'Field {i}', f'Value {i}') for i in range(10)
+    ]).get_message_data()
+
+    default = mp.get_json_backend()
+    for backend in mp.get_json_backends():
+        mp.set_json_backend(backend)
+        size = len(mp.encode_payload(data))
+        elapsed = min(timeit.repeat(lambda: mp.encode_payload(data), number=args.n, repeat=3))
+        print(f"{backend:<8} {args.n/elapsed:10.0f} payloads/s   {size*args.n/elapsed/1e6:8.1f} MB/s")
+    mp.set_json_backend(default)
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Compare the per-message latency of posting through a fresh connection per message (the module-level
+requests.post) against the pooled keep-alive session owned by MattermostInterface
+
+    python -m benchmarks.bench_session [-n MESSAGES]
+"""
+import argparse
+import statistics
+import time
+
+import requests
+
+import mattermostpython as mp
+from benchmarks.webhook_server import StandInWebhookServer
+
+####################################################################################################
+def time_posts(send, n : int) -> list:
+    """
+    Call send() n times and return the latency of each call in seconds
+    """
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        send()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+####################################################################################################
+def summarise(name : str, latencies : list) -> None:
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))]
+    print(f"{name:<24} mean {1e3*statistics.mean(latencies):7.3f} ms   "
+          f"p50 {1e3*statistics.median(latencies):7.3f} ms   p99 {1e3*p99:7.3f} ms")
+    return
+
+####################################################################################################
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=500, help='number of messages per run')
+    args = parser.parse_args()
+
+    message = mp.MattermostMessage(title='benchmark', text='per-message latency')
+    data = message.get_message_data()
+
+    with StandInWebhookServer(keep_payloads=False) as server:
+        summarise('requests.post', time_posts(lambda: requests.post(server.url, json=data, timeout=2.5), args.n))
+        fresh = server.connections
+        with mp.MattermostInterface(server.url) as interface:
+            summarise('pooled interface', time_posts(lambda: interface.post(message), args.n))
+        print(f"connections opened: fresh {fresh}, pooled {server.connections - fresh}")
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""
+Measure how many message payloads per second can be appended to a MattermostSpool, and how fast
+they can be replayed
+
+    python -m benchmarks.bench_spool [-n MESSAGES] [--fsync]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import mattermostpython as mp
+
+####################################################################################################
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=100000, help='number of messages to spool')
+    parser.add_argument('--fsync', action='store_true', help='sync every append to disk')
+    args = parser.parse_args()
+
+    data = mp.MattermostMessage(title='benchmark', text='spooled message').get_message_data()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'bench.spool')
+        with mp.MattermostSpool(path, fsync=args.fsync) as spool:
+            start = time.perf_counter()
+            for _ in range(args.n):
+                spool.append(data)
+            elapsed = time.perf_counter() - start
+            print(f"append: {args.n/elapsed:10.0f} messages/s   ({os.path.getsize(path)/elapsed/1e6:.1f} MB/s)")
+
+        with mp.MattermostSpool(path) as spool:
+            start = time.perf_counter()
+            replayed = spool.replay(lambda x: True)
+            elapsed = time.perf_counter() - start
+            print(f"replay: {replayed/elapsed:10.0f} messages/s")
+    return
+
+if __name__ == '__main__':
+    main()
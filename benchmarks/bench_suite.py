@@ -0,0 +1,267 @@
+"""
+Benchmark suite following a message from being built to being posted: MattermostMessage
+construction, get_message_data, serialisation, and MattermostInterface.post sequentially, from a
+pool of threads and from asyncio, against a local stand-in webhook server, both as it is and with
+injected latency, 429s and failures. Every benchmark reports messages per second, the p50 and p99
+latency per message and the peak memory allocated while it runs.
+
+The results are printed as JSON (and a table on stderr), so that runs on different commits can be
+compared:
+
+    python -m benchmarks.bench_suite -o before.json
+    git checkout my-branch
+    python -m benchmarks.bench_suite -o after.json --compare before.json
+
+Latencies of the benchmarks which do not post are averaged over batches of messages, as a single
+message takes too little time to measure on its own.
+
+    python -m benchmarks.bench_suite [-o FILE] [--compare FILE] [--quick] [--only NAME [NAME ...]]
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import mattermostpython as mp
+from benchmarks.webhook_server import StandInWebhookServer
+
+BATCH = 100
+
+####################################################################################################
+def make_message(i : int = 0) -> mp.MattermostMessage:
+    """
+    A typical alert, with a few fields
+    """
+    return mp.MattermostMessage(title='Rate monitor', text=f'Rate dropped on channel {i}', colour='#FF0000',
+                                priority=mp.MattermostMessagePriority.IMPORTANT, fields=[
+        mp.MattermostField(True, 'Run', '42'), mp.MattermostField(True, 'Rate', '3 Hz'),
+        mp.MattermostField(False, 'Detector', 'silicon array')
+    ])
+
+####################################################################################################
+def time_batches(op, n : int) -> list:
+    """
+    Call op() n times, and return the latency per call of each batch of calls in seconds
+    """
+    latencies = []
+    for start in range(0, n, BATCH):
+        count = min(BATCH, n - start)
+        t = time.perf_counter()
+        for _ in range(count):
+            op()
+        latencies.append( (time.perf_counter() - t) / count )
+    return latencies
+
+####################################################################################################
+# Benchmarks which do not post. Each takes the number of messages and returns their latencies
+def bench_construct(n : int) -> list:
+    return time_batches(make_message, n)
+
+def bench_get_message_data(n : int) -> list:
+    message = make_message()
+    return time_batches(message.get_message_data, n)
+
+def bench_serialise(n : int) -> list:
+    data = make_message().get_message_data()
+    return time_batches(lambda: mp.encode_payload(data), n)
+
+####################################################################################################
+# Benchmarks which post to the server. Each takes the server, the number of messages and the number
+# of threads or concurrent posts, and returns their latencies and how many were posted
+_RETRY_POLICY = mp.MattermostRetryPolicy(max_attempts=5, backoff=0.001, retry_statuses=(429, 500))
+
+def bench_post_sequential(server : StandInWebhookServer, n : int, concurrency : int) -> tuple:
+    messages = [ make_message(i) for i in range(n) ]
+    ok = 0
+    latencies = []
+    with mp.MattermostInterface(server.url, retry_policy=_RETRY_POLICY) as interface:
+        interface.post(messages[0]) # Open the connection
+        for message in messages:
+            t = time.perf_counter()
+            ok += interface.post(message)
+            latencies.append(time.perf_counter() - t)
+    return latencies, ok
+
+def bench_post_threaded(server : StandInWebhookServer, n : int, concurrency : int) -> tuple:
+    messages = [ make_message(i) for i in range(n) ]
+
+    def post(message):
+        t = time.perf_counter()
+        x = interface.post(message)
+        return time.perf_counter() - t, x
+
+    with mp.MattermostInterface(server.url, pool_maxsize=concurrency, retry_policy=_RETRY_POLICY) as interface:
+        interface.post(messages[0])
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(post, messages))
+    return [ x[0] for x in results ], sum( x[1] for x in results )
+
+def bench_post_asyncio(server : StandInWebhookServer, n : int, concurrency : int) -> tuple:
+    messages = [ make_message(i) for i in range(n) ]
+
+    async def run():
+        async with mp.AsyncMattermostInterface(server.url, pool_maxsize=concurrency, max_in_flight=concurrency) as interface:
+            await interface.post(messages[0])
+
+            async def post(message):
+                t = time.perf_counter()
+                x = await interface.post(message)
+                return time.perf_counter() - t, x
+
+            return await asyncio.gather(*( post(x) for x in messages ))
+
+    results = asyncio.run(run())
+    return [ x[0] for x in results ], sum( x[1] for x in results )
+
+# How the stand-in server behaves for the benchmarks with faults
+_FAULTS = dict(latency=0.002, throttle_rate=0.05, failure_rate=0.02)
+
+####################################################################################################
+def percentile(values : list, q : float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def summarise(latencies : list, elapsed : float, n : int, peak : int) -> dict:
+    return {
+        'messages' : n,
+        'messages_per_s' : n / elapsed,
+        'p50_us' : 1e6 * percentile(latencies, 0.5),
+        'p99_us' : 1e6 * percentile(latencies, 0.99),
+        'peak_memory_kb' : peak / 1024,
+    }
+
+def peak_memory(run) -> int:
+    """
+    Peak number of bytes allocated by python while run() runs
+    """
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+####################################################################################################
+def run_suite(n : int, n_posts : int, concurrency : int, only : list = None) -> dict:
+    results = {}
+
+    def selected(name):
+        return not only or any( x in name for x in only )
+
+    for name, bench in [('construct', bench_construct), ('get_message_data', bench_get_message_data),
+                        ('serialise', bench_serialise)]:
+        if not selected(name):
+            continue
+        start = time.perf_counter()
+        latencies = bench(n)
+        elapsed = time.perf_counter() - start
+        # Memory is measured in a separate run, as tracing slows everything down
+        results[name] = summarise(latencies, elapsed, n, peak_memory(lambda: bench(min(n, 1000))))
+        print_result(name, results[name])
+
+    for mode, faults in [('', {}), ('_faults', _FAULTS)]:
+        for name, bench in [('post_sequential', bench_post_sequential), ('post_threaded', bench_post_threaded),
+                            ('post_asyncio', bench_post_asyncio)]:
+            name += mode
+            if not selected(name):
+                continue
+            if bench is bench_post_asyncio and not has_aiohttp():
+                results[name] = { 'skipped' : 'aiohttp is not installed' }
+                continue
+            with StandInWebhookServer(keep_payloads=False, seed=1, **faults) as server:
+                start = time.perf_counter()
+                latencies, ok = bench(server, n_posts, concurrency)
+                elapsed = time.perf_counter() - start
+                counts = dict(posted=ok, throttled=server.throttled, failed=server.failed)
+                result = summarise(latencies, elapsed, n_posts, peak_memory(lambda: bench(server, min(n_posts, 100), concurrency)))
+                result.update(counts)
+            results[name] = result
+            print_result(name, result)
+    return results
+
+def has_aiohttp() -> bool:
+    return importlib.util.find_spec('aiohttp') is not None
+
+####################################################################################################
+def print_result(name : str, result : dict) -> None:
+    print(f"{name:<24} {result['messages_per_s']:10.0f} messages/s   p50 {result['p50_us']:9.1f} us   "
+          f"p99 {result['p99_us']:9.1f} us   peak {result['peak_memory_kb']:8.1f} kB", file=sys.stderr)
+    return
+
+def compare(results : dict, baseline : dict, tolerance : float) -> list:
+    """
+    Print how each benchmark changed from the baseline, and return the names of those which got
+    slower by more than tolerance
+    """
+    regressions = []
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'}:", file=sys.stderr)
+    for name, result in results.items():
+        before = baseline.get('results', {}).get(name)
+        if 'skipped' in result or before is None or 'skipped' in before:
+            continue
+        ratio = result['messages_per_s'] / before['messages_per_s']
+        p99_ratio = result['p99_us'] / before['p99_us'] if before['p99_us'] > 0 else 1.0
+        slower = ratio < 1 - tolerance
+        if slower:
+            regressions.append(name)
+        print(f"{name:<24} throughput x{ratio:5.2f}   p99 x{p99_ratio:5.2f}{'   REGRESSION' if slower else ''}", file=sys.stderr)
+    return regressions
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+####################################################################################################
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=20000, help='number of messages for the benchmarks which do not post')
+    parser.add_argument('--posts', type=int, default=1000, help='number of messages for the benchmarks which post')
+    parser.add_argument('--concurrency', type=int, default=8, help='threads, or concurrent posts with asyncio')
+    parser.add_argument('--quick', action='store_true', help='run a tenth as many messages')
+    parser.add_argument('--only', nargs='+', help='only run the benchmarks whose names contain one of these')
+    parser.add_argument('-o', '--output', help='write the JSON results to this file rather than stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction of throughput that can be lost before it is reported as a regression')
+    args = parser.parse_args()
+
+    if args.quick:
+        args.n = max(BATCH, args.n // 10)
+        args.posts = max(10, args.posts // 10)
+
+    report = {
+        'commit' : get_commit(),
+        'version' : mp.__version__,
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'json_backend' : mp.get_json_backend(),
+        'settings' : { 'n' : args.n, 'posts' : args.posts, 'concurrency' : args.concurrency, 'faults' : _FAULTS },
+        'results' : run_suite(args.n, args.posts, args.concurrency, args.only),
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if compare(report['results'], baseline, args.tolerance):
+            sys.exit(1)
+    return
+
+if __name__ == '__main__':
+    main()
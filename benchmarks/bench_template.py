@@ -0,0 +1,41 @@
+"""
+Compare the cost of building a message payload from scratch with MattermostMessage against rendering
+it from a precompiled MattermostTemplate
+
+    python -m benchmarks.bench_template [-n MESSAGES]
+"""
+import argparse
+import timeit
+
+import mattermostpython as mp
+
+ICON_URL = 'https://upload.wikimedia.org/wikipedia/commons/c/c3/Python-logo-notext.svg'
+
+####################################################################################################
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=100000, help='number of messages per run')
+    args = parser.parse_args()
+
+    static = dict(username='DAQ', icon_url=ICON_URL, priority=mp.MattermostMessagePriority.IMPORTANT,
+                  colour='#FF0000', title='Rate monitor', footer='daq01', author_name='watchdog')
+
+    def from_message():
+        return mp.MattermostMessage(text='Rate dropped', fields=[
+            mp.MattermostField(True, 'Run', '42'), mp.MattermostField(True, 'Rate', '3 Hz')
+        ], **static).get_message_data()
+
+    template = mp.MattermostTemplate(fields=[mp.MattermostField(True, 'Run', ''), mp.MattermostField(True, 'Rate', '')], **static)
+
+    def from_template():
+        return template.render(text='Rate dropped', field_values={'Run': '42', 'Rate': '3 Hz'})
+
+    assert from_message() == from_template()
+
+    for name, build in [('MattermostMessage', from_message), ('MattermostTemplate', from_template)]:
+        elapsed = min(timeit.repeat(build, number=args.n, repeat=3))
+        print(f"{name:<20} {1e6*elapsed/args.n:7.2f} us/message")
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import http.server
+import json
+import random
+import threading
+import time
+
+_API_POSTS = '/api/v4/posts'
+
+####################################################################################################
+class StandInWebhookServer:
+    """
+    A local, in-process stand-in for a Mattermost incoming webhook. It accepts POSTs on any path,
+    records the decoded payloads and replies with 200 "ok", so the library can be tested and
+    benchmarked without a real Mattermost server. Use it as a context manager:
+
+        with StandInWebhookServer() as server:
+            interface = MattermostInterface(server.url)
+
+    Faults can be injected: each request is delayed by latency seconds, and a random fraction
+    throttle_rate of requests is rejected with a 429 (with Retry-After: 0) and a fraction failure_rate
+    with a 500. Specific replies can be scripted with script().
+
+    It also mocks the posts endpoint of the REST API: posts created with POST /api/v4/posts and
+    patched with PUT /api/v4/posts/<id>/patch are kept in posts, by id, if the request carries the
+    bearer token given as token
+    """
+    def __init__(self, host : str = '127.0.0.1', port : int = 0, latency : float = 0.0,
+                 keep_payloads : bool = True, token : str = 'standin-token', throttle_rate : float = 0.0,
+                 failure_rate : float = 0.0, seed : int = None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.throttled = 0
+        self.failed = 0
+        self._random = random.Random(seed)
+        self.token = token
+        self.posts = {}
+        self.patches = 0
+        self.keep_payloads = keep_payloads
+        self.payloads = []
+        self.paths = []
+        self.requests = 0
+        self.connections = 0
+        self.in_flight = 0
+        self.scripted = []
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+        return
+
+    ####################################################################################################
+    def _make_handler(self):
+        """
+        Build the request handler class bound to this server instance
+        """
+        owner = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with owner._lock:
+                    owner.connections += 1
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                if self.path.startswith(_API_POSTS):
+                    status, headers, reply = owner._respond_api(self.command, self.path, self.headers, body)
+                else:
+                    status, headers, reply = owner._respond(self.path, body)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            do_PUT = do_POST
+
+            def log_message(self, format, *args):
+                return
+
+        return Handler
+
+    ####################################################################################################
+    def _respond(self, path : str, body : bytes):
+        """
+        Record the request and decide on the reply. Returns (status, headers, body)
+        """
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self._lock:
+            self.in_flight -= 1
+            self.requests += 1
+            if self.scripted:
+                return self.scripted.pop(0)
+            if self.throttle_rate > 0 or self.failure_rate > 0:
+                x = self._random.random()
+                if x < self.throttle_rate:
+                    self.throttled += 1
+                    return 429, {'Retry-After': '0'}, b'rate limited'
+                if x < self.throttle_rate + self.failure_rate:
+                    self.failed += 1
+                    return 500, {}, b'injected failure'
+            if self.keep_payloads:
+                self.paths.append(path)
+                self.payloads.append(json.loads(body) if body else None)
+        return 200, {}, b'ok'
+
+    ####################################################################################################
+    def _respond_api(self, method : str, path : str, request_headers, body : bytes):
+        """
+        Mock of the REST API's posts endpoint. Returns (status, headers, body)
+        """
+        if request_headers.get('Authorization') != f"Bearer {self.token}":
+            return 401, {}, b'{"message": "invalid token"}'
+        if self.latency > 0:
+            time.sleep(self.latency)
+        post = json.loads(body) if body else {}
+        with self._lock:
+            self.requests += 1
+            if self.scripted:
+                return self.scripted.pop(0)
+            if method == 'POST' and path == _API_POSTS:
+                post['id'] = f"post{len(self.posts)}"
+                self.posts[post['id']] = post
+                return 201, {}, json.dumps(post).encode()
+            parts = path[len(_API_POSTS):].strip('/').split('/')
+            if method == 'PUT' and len(parts) == 2 and parts[1] == 'patch' and parts[0] in self.posts:
+                self.patches += 1
+                self.posts[parts[0]].update(post)
+                return 200, {}, json.dumps(self.posts[parts[0]]).encode()
+        return 404, {}, b'{"message": "not found"}'
+
+    ####################################################################################################
+    def script(self, status : int, headers : dict = None, body : bytes = b'', count : int = 1) -> None:
+        """
+        Reject the next count requests with the given status, headers and body instead of accepting
+        them. Rejected payloads are not recorded
+        """
+        with self._lock:
+            self.scripted.extend( [(status, headers or {}, body)]*count )
+        return
+
+    ####################################################################################################
+    @property
+    def url(self) -> str:
+        return self.url_for('standin')
+
+    def url_for(self, hook : str) -> str:
+        """
+        URL of a webhook called hook on this server
+        """
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/hooks/{hook}"
+
+    ####################################################################################################
+    def start(self) -> 'StandInWebhookServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
@@ -1,4 +1,32 @@
-from .mattermostpython import MattermostField, MattermostMessagePriority, MattermostMessage, MattermostInterface
+from .mattermostpython import (MattermostField, MattermostMessagePriority, MattermostMessage, MattermostInterface,
+                               MattermostProfile, MattermostQueuePolicy, MattermostPostResult, MattermostRateLimiter,
+                               MattermostRetryPolicy, exception_fingerprint, format_exception)
+from .api import MattermostAPIInterface, MattermostLivePost, MattermostProgress
+from .coalesce import MattermostCoalescer
+from .spool import MattermostSpool
+from .template import MattermostTemplate
+from .metrics import MattermostMetrics
+from .reporter import MattermostExceptionReporter, install_crash_reporter, uninstall_crash_reporter
+from .serialise import encode_payload, get_json_backend, get_json_backends, set_json_backend
+from .split import split_payload
 
-__all__ = ["MattermostMessage", "MattermostField", "MattermostMessagePriority", "MattermostInterface"]
+__all__ = ["MattermostMessage", "MattermostField", "MattermostMessagePriority", "MattermostInterface", "MattermostProfile",
+           "MattermostQueuePolicy", "MattermostPostResult", "MattermostRateLimiter", "MattermostRetryPolicy", "AsyncMattermostInterface", "MattermostCoalescer",
+           "MattermostSpool", "MattermostTemplate", "MattermostHandler", "MattermostMetrics",
+           "MattermostAPIInterface", "MattermostLivePost", "MattermostProgress",
+           "MattermostExceptionReporter", "exception_fingerprint", "format_exception",
+           "install_crash_reporter", "uninstall_crash_reporter", "MattermostSenderClient", "MattermostSenderDaemon",
+           "encode_payload", "get_json_backend", "get_json_backends", "set_json_backend", "split_payload"]
 __version__ = '1.0'
+
+# Submodules which are slow to import (asyncio, logging, socketserver) are only imported when first used
+_LAZY = {"AsyncMattermostInterface": ".asyncinterface", "MattermostHandler": ".handler",
+         "MattermostSenderClient": ".daemon", "MattermostSenderDaemon": ".daemon"}
+
+def __getattr__(name):
+    if name in _LAZY:
+        import importlib
+        value = getattr(importlib.import_module(_LAZY[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,203 @@
+"""
+Send messages to Mattermost from the command line. Either send one message built from the options:
+
+    python -m mattermostpython --title 'Run finished' --text 'Run 42 took 3 hours' --field Run=42
+
+or, with --stream, post each line read from standard input as a message, until the input ends:
+
+    tail -F daq.log | python -m mattermostpython --stream --title 'DAQ log'
+
+Lines holding a JSON object are used as MattermostMessage arguments, on top of the options, and any
+other line is used as the message text. In streaming mode the messages are posted in the background
+over one persistent connection, and repeats of the same title and priority within the coalescing
+window are collapsed into a digest.
+
+With --serve, run a sender daemon on a Unix domain socket, which posts the messages handed to it by
+every process using a MattermostSenderClient, until interrupted:
+
+    python -m mattermostpython --serve /tmp/mattermost.sock
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+
+from .mattermostpython import (MattermostField, MattermostInterface, MattermostMessage, MattermostMessagePriority,
+                               MattermostQueuePolicy)
+from .coalesce import MattermostCoalescer
+
+_PRIORITIES = { str(x) : x for x in MattermostMessagePriority }
+
+_MESSAGE_OPTIONS = ['username', 'icon_url', 'message_info', 'colour', 'pretext', 'text', 'footer', 'footer_icon',
+                    'author_name', 'author_link', 'author_icon', 'title', 'title_link', 'notification_message']
+
+####################################################################################################
+def _parse_field(x : str, short : bool) -> MattermostField:
+    title, sep, value = x.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"fields must be given as TITLE=VALUE, not {x}")
+    return MattermostField(short, title, value)
+
+####################################################################################################
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m mattermostpython', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--webhook', default=os.environ.get('MATTERMOST_WEBHOOK', '.mattermost_url.txt'),
+                        help='incoming webhook URL, or a file containing it (default: $MATTERMOST_WEBHOOK or .mattermost_url.txt)')
+    parser.add_argument('--timeout', type=float, default=2.5, help='seconds to wait for the server to respond')
+
+    group = parser.add_argument_group('message')
+    for name in _MESSAGE_OPTIONS:
+        group.add_argument('--' + name.replace('_', '-'), dest=name)
+    group.add_argument('--priority', choices=list(_PRIORITIES))
+    group.add_argument('--field', dest='fields', action='append', metavar='TITLE=VALUE',
+                       type=lambda x: _parse_field(x, False), help='add a full-width field (repeatable)')
+    group.add_argument('--short-field', dest='fields', action='append', metavar='TITLE=VALUE',
+                       type=lambda x: _parse_field(x, True), help='add a half-width field (repeatable)')
+
+    group = parser.add_argument_group('streaming')
+    group.add_argument('--stream', action='store_true', help='post each line of standard input as a message')
+    group.add_argument('--coalesce-window', type=float, default=10.0,
+                       help='seconds over which repeated messages are collapsed into a digest, 0 to disable (default: 10)')
+    group.add_argument('--queue-size', type=int, default=1000,
+                       help='messages waiting to be posted before the oldest are dropped (default: 1000)')
+    group.add_argument('--flush-timeout', type=float, default=10.0,
+                       help='seconds to spend posting queued messages once the input ends (default: 10)')
+
+    group = parser.add_argument_group('daemon')
+    group.add_argument('--serve', metavar='SOCKET',
+                       help='post the messages sent to a Unix domain socket by MattermostSenderClients, until interrupted')
+    return parser
+
+####################################################################################################
+def _message_arguments(args : argparse.Namespace) -> dict:
+    """
+    MattermostMessage arguments given as options
+    """
+    kwargs = { name : getattr(args, name) for name in _MESSAGE_OPTIONS if getattr(args, name) is not None }
+    if args.priority is not None:
+        kwargs['priority'] = _PRIORITIES[args.priority]
+    if args.fields:
+        kwargs['fields'] = args.fields
+    return kwargs
+
+####################################################################################################
+def message_from_line(line : str, defaults : dict) -> MattermostMessage:
+    """
+    Build a message from a line of input: a JSON object of MattermostMessage arguments, or the text
+    """
+    kwargs = dict(defaults)
+    try:
+        values = json.loads(line)
+    except ValueError:
+        values = None
+
+    if isinstance(values, dict):
+        for name, value in values.items():
+            if name == 'priority':
+                kwargs[name] = _PRIORITIES[str(value).lower()]
+            elif name == 'fields':
+                kwargs[name] = [ MattermostField(x.get('short', False), x.get('title', ''), x.get('value', '')) for x in value ]
+            elif name in _MESSAGE_OPTIONS:
+                kwargs[name] = value
+    else:
+        kwargs['text'] = line
+
+    if 'fields' in kwargs:
+        kwargs['fields'] = list(kwargs['fields'])
+    return MattermostMessage(**kwargs)
+
+####################################################################################################
+def _stream_key(message : MattermostMessage) -> tuple:
+    """
+    Coalescer key for streamed lines, which usually all share a --title, so that only lines which
+    really are repeats are collapsed
+    """
+    return (message.get_title(), message.get_priority(), message.get_text())
+
+def stream(interface : MattermostInterface, lines, defaults : dict, coalesce_window : float) -> int:
+    """
+    Post a message for each line until the lines run out. Returns the number of lines read
+    """
+    coalescer = MattermostCoalescer(interface, window=coalesce_window, key=_stream_key) if coalesce_window > 0 else None
+    n = 0
+    try:
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            try:
+                message = message_from_line(line, defaults)
+            except (KeyError, TypeError, AttributeError) as e:
+                print(f"WARNING - ignoring malformed message {line!r}: {e}", file=sys.stderr)
+                continue
+            if coalescer is not None:
+                coalescer.post(message)
+            else:
+                interface.post_async(message)
+            n += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if coalescer is not None:
+            coalescer.close()
+    return n
+
+####################################################################################################
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def serve(interface : MattermostInterface, args : argparse.Namespace) -> int:
+    """
+    Run a sender daemon until interrupted or terminated, then post what it has been sent
+    """
+    from .daemon import MattermostSenderDaemon
+    try:
+        daemon = MattermostSenderDaemon(interface, args.serve, args.coalesce_window)
+    except (OSError, ValueError) as e:
+        print(f"ERROR - {e}", file=sys.stderr)
+        interface.close()
+        return 2
+
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        daemon.serve_forever()
+    finally:
+        daemon.stop(args.flush_timeout)
+    return 0
+
+####################################################################################################
+def main(argv : list = None) -> int:
+    args = make_parser().parse_args(argv)
+
+    try:
+        # Never block reading the input because Mattermost is slow
+        interface = MattermostInterface(args.webhook, timeout=args.timeout, queue_size=args.queue_size,
+                                        queue_policy=MattermostQueuePolicy.DROP_OLDEST)
+    except ValueError as e:
+        print(f"ERROR - {e}", file=sys.stderr)
+        return 2
+
+    if args.serve is not None:
+        return serve(interface, args)
+
+    if not args.stream:
+        try:
+            return 0 if interface.post(MattermostMessage(**_message_arguments(args))) else 1
+        except Exception as e:
+            print(f"ERROR - failed to post message: {e}", file=sys.stderr)
+            return 1
+        finally:
+            interface.close()
+
+    # Post what has been read when terminated, as when interrupted
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        stream(interface, sys.stdin, _message_arguments(args), args.coalesce_window)
+    finally:
+        interface.close(args.flush_timeout)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,366 @@
+import os
+import threading
+import time
+from typing import Union
+
+from .mattermostpython import MattermostField, MattermostMessage, MattermostProfile, MattermostRateLimiter, _get_payload
+from .serialise import encode_payload
+
+####################################################################################################
+def _post_from_payload(data : dict) -> dict:
+    """
+    Turn a webhook payload, as made by MattermostMessage.get_message_data(), into the body of a post
+    for the REST API, where the attachments and overrides go in the post's props
+    """
+    props = dict(data.get('props', {}))
+    if data.get('attachments'):
+        props['attachments'] = data['attachments']
+    if data.get('username'):
+        props['override_username'] = data['username']
+    if data.get('icon_url'):
+        props['override_icon_url'] = data['icon_url']
+
+    post = { 'message' : data.get('text', ''), 'props' : props }
+    # The API only knows important and urgent priorities
+    priority = data.get('priority', {}).get('priority')
+    if priority in ('important', 'urgent'):
+        post['metadata'] = { 'priority' : { 'priority' : priority } }
+    return post
+
+####################################################################################################
+class MattermostAPIInterface:
+    """
+    Posts to a channel through the Mattermost REST API, with the access token of a bot (or user),
+    rather than through an incoming webhook. Unlike a webhook, the API says which post it created,
+    so the post can be edited afterwards:
+
+        with MattermostAPIInterface('https://mattermost.example.com', '.mattermost_token.txt', channel_id) as api:
+            post_id = api.create_post( MattermostMessage(title='Run 42', text='Starting') )
+            api.update_post( post_id, MattermostMessage(title='Run 42', text='Finished') )
+
+    MattermostLivePost and MattermostProgress build on this to keep one post up to date instead of
+    posting a new message for every update.
+
+    The username and icon of a message are sent as overrides, which the server only honours if it
+    allows integrations to override them, and a post's priority can only be set when it is created.
+    Requests share the MattermostRateLimiter of the server's API, which follows the server's rate
+    limit headers, and a request rejected with a 429 is resent once.
+
+    token : access token, or the path to a file containing one
+    """
+    def __init__(self, server_url : str, token : str, channel_id : str, timeout : float = 2.5,
+                 rate_limit : float = None, rate_burst : int = None):
+        if os.path.isfile(token):
+            with open(token, 'r') as f:
+                token = f.read().strip()
+        self.api_url = server_url.rstrip('/') + '/api/v4'
+        self.channel_id = channel_id
+        self.timeout = timeout if timeout > 0 else 2.5
+        self.rate_limiter = MattermostRateLimiter.for_url(self.api_url, rate_limit, rate_burst)
+        self._headers = { 'Content-Type' : 'application/json', 'Authorization' : f"Bearer {token}" }
+        self._session = None
+        self._session_lock = threading.Lock()
+        return
+
+    ####################################################################################################
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    ####################################################################################################
+    def _get_session(self) -> 'requests.Session':
+        """
+        Get the pooled session, creating it on first use
+        """
+        session = self._session
+        if session is None:
+            with self._session_lock:
+                session = self._session
+                if session is None:
+                    import requests
+                    session = requests.Session()
+                    self._session = session
+        return session
+
+    def close(self) -> None:
+        with self._session_lock:
+            session = self._session
+            self._session = None
+        if session is not None:
+            session.close()
+        return
+
+    ####################################################################################################
+    def _request(self, method : str, path : str, post : dict) -> 'requests.Response':
+        """
+        Send a request to the API, resending it once if it is rejected for going over the rate limit
+        """
+        body = encode_payload(post)
+        for attempt in range(2):
+            self.rate_limiter.acquire()
+            x = self._get_session().request(method, self.api_url + path, data=body, headers=self._headers,
+                                            timeout=self.timeout)
+            self.rate_limiter.update(x.status_code, x.headers)
+            if x.status_code != 429:
+                break
+        return x
+
+    ####################################################################################################
+    def create_post(self, message : Union[MattermostMessage, dict]) -> str:
+        """
+        Post the message to the channel. Returns the id of the new post, or None if it was refused
+        """
+        post = _post_from_payload(_get_payload(message))
+        post['channel_id'] = self.channel_id
+        x = self._request('POST', '/posts', post)
+        if x.status_code != 201:
+            print(f"WARNING - Mattermost refused to create post ({x.status_code}): {x.text[:200]}")
+            return None
+        return x.json()['id']
+
+    def update_post(self, post_id : str, message : Union[MattermostMessage, dict]) -> bool:
+        """
+        Replace the text and attachments of an existing post with those of the message. Returns true
+        if it worked
+        """
+        post = _post_from_payload(_get_payload(message))
+        post.pop('metadata', None)
+        x = self._request('PUT', f"/posts/{post_id}/patch", post)
+        if x.status_code != 200:
+            print(f"WARNING - Mattermost refused to update post {post_id} ({x.status_code}): {x.text[:200]}")
+            return False
+        return True
+
+####################################################################################################
+class MattermostLivePost:
+    """
+    One post which is kept showing the latest of a stream of messages, such as the status of a long
+    analysis run, by editing it rather than posting each message. The first message creates the post
+    and later ones update it, at most once every interval seconds: when messages come faster than
+    that, only the latest is sent and the ones in between are skipped.
+
+        live = MattermostLivePost(api, interval=5)
+        for event in run:
+            live.update( MattermostMessage(title='Run 42', text=f"{event} events") )
+        live.close()
+
+    update() never blocks, as the requests are made by a background thread. A message which could
+    not be sent is tried again after the interval, unless a newer one has replaced it. close() sends
+    the latest message straight away
+    """
+    def __init__(self, api : MattermostAPIInterface, interval : float = 5.0):
+        self.api = api
+        self.interval = interval
+        self.post_id = None # Set once the post has been created
+        self.sent = 0       # Number of messages sent
+        self.skipped = 0    # Number of messages replaced by a newer one before they were sent
+        self._pending = None
+        self._next_time = 0.0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        return
+
+    ####################################################################################################
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    ####################################################################################################
+    def update(self, message : Union[MattermostMessage, dict]) -> None:
+        """
+        Show the message in the post, as soon as the interval allows. The message is copied, so it
+        can be modified afterwards
+        """
+        data = _get_payload(message)
+        with self._lock:
+            if self._closed:
+                raise ValueError("MattermostLivePost has been closed")
+            if self._pending is not None:
+                self.skipped += 1
+            self._pending = data
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sender, name='mattermost-live-post', daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+        return
+
+    ####################################################################################################
+    def close(self, timeout : float = None) -> None:
+        """
+        Send the latest message now, if it has not been sent, and stop the background thread
+        """
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        return
+
+    ####################################################################################################
+    def _sender(self) -> None:
+        """
+        Body of the background thread: send the latest message each time the interval has passed
+        """
+        while True:
+            with self._lock:
+                while self._pending is None or (not self._closed and time.monotonic() < self._next_time):
+                    if self._closed:
+                        return
+                    self._wakeup.wait(self._next_time - time.monotonic() if self._pending is not None else None)
+                data = self._pending
+                self._pending = None
+                closed = self._closed
+
+            try:
+                if self.post_id is None:
+                    self.post_id = self.api.create_post(data)
+                    ok = self.post_id is not None
+                else:
+                    ok = self.api.update_post(self.post_id, data)
+            except Exception as e:
+                print(f"WARNING - failed to update Mattermost post: {e}")
+                ok = False
+
+            with self._lock:
+                self._next_time = time.monotonic() + self.interval
+                if ok:
+                    self.sent += 1
+                elif self._pending is None and not closed:
+                    self._pending = data
+            if closed and self._pending is None:
+                return
+
+####################################################################################################
+def _format_duration(seconds : float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds // 3600}h {seconds // 60 % 60:02d}m {seconds % 60:02d}s"
+
+####################################################################################################
+class MattermostProgress:
+    """
+    Shows the progress of a long job in a single post, kept up to date with a MattermostLivePost.
+    The post has fields for the progress, with a bar if the total is known, the time taken so far
+    and the estimated time left, followed by any fields given to update():
+
+        with MattermostProgress(api, 'Sorting run 42', total=len(files)) as progress:
+            for i, f in enumerate(files):
+                sort(f)
+                progress.update(i + 1, Current=f)
+
+    Leaving the with block finishes the post, or marks it failed if an exception was raised. Only
+    the latest state is sent, at most once every interval seconds, so update() can be called as
+    often as is convenient
+    """
+    COLOUR_RUNNING = '#1E90FF'
+    COLOUR_FINISHED = '#00C000'
+    COLOUR_FAILED = '#FF0000'
+    BAR_WIDTH = 20
+
+    def __init__(self, api : MattermostAPIInterface, title : str, total : int = None, interval : float = 5.0,
+                 profile : Union[MattermostProfile, str] = None):
+        self.title = title
+        self.total = total
+        self.profile = profile
+        self.done = 0
+        self.text = ''
+        self.fields = {}
+        self.finished = False
+        self.live = MattermostLivePost(api, interval)
+        self._start = time.monotonic()
+        self._publish(self.COLOUR_RUNNING)
+        return
+
+    ####################################################################################################
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.fail(f"{exc_type.__name__}: {exc_value}")
+        return False
+
+    ####################################################################################################
+    def update(self, done : int = None, text : str = None, **fields) -> None:
+        """
+        Set how much has been done, the text under the title and the values of extra fields
+        """
+        if done is not None:
+            self.done = done
+        if text is not None:
+            self.text = text
+        self.fields.update(fields)
+        self._publish(self.COLOUR_RUNNING)
+        return
+
+    def advance(self, n : int = 1, **fields) -> None:
+        self.update(self.done + n, **fields)
+        return
+
+    ####################################################################################################
+    def finish(self, text : str = None) -> None:
+        """
+        Show the job as finished and send the final state now
+        """
+        if self.total is not None:
+            self.done = self.total
+        self._end(self.COLOUR_FINISHED, 'finished', text)
+        return
+
+    def fail(self, text : str = None) -> None:
+        """
+        Show the job as failed and send the final state now
+        """
+        self._end(self.COLOUR_FAILED, 'failed', text)
+        return
+
+    def _end(self, colour : str, status : str, text : str) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        if text is not None:
+            self.text = text
+        self._publish(colour, status)
+        self.live.close()
+        return
+
+    ####################################################################################################
+    def make_message(self, colour : str, status : str = None) -> MattermostMessage:
+        """
+        Build the message showing the current state
+        """
+        elapsed = time.monotonic() - self._start
+        if self.total:
+            fraction = min(1.0, self.done / self.total)
+            filled = int(round(fraction * self.BAR_WIDTH))
+            progress = f"`{'#' * filled}{'.' * (self.BAR_WIDTH - filled)}` {self.done}/{self.total} ({100*fraction:.0f}%)"
+        else:
+            fraction = None
+            progress = str(self.done)
+
+        fields = [ MattermostField(True, 'Progress', progress),
+                   MattermostField(True, 'Elapsed', _format_duration(elapsed)) ]
+        if status is None and fraction:
+            fields.append( MattermostField(True, 'Remaining', _format_duration(elapsed * (1 - fraction) / fraction)) )
+        fields.extend( MattermostField(True, name, str(value)) for name, value in self.fields.items() )
+
+        title = f"{self.title} ({status})" if status is not None else self.title
+        return MattermostMessage(title=title, text=self.text, colour=colour, fields=fields, profile=self.profile)
+
+    def _publish(self, colour : str, status : str = None) -> None:
+        self.live.update( self.make_message(colour, status) )
+        return
@@ -0,0 +1,199 @@
+import asyncio
+import time
+from typing import List, Tuple, Union
+
+# aiohttp is optional, and slow to import, so it is only imported when an interface is created
+aiohttp = None
+
+from .mattermostpython import (MattermostMessage, MattermostPostResult, MattermostRateLimiter, _JSON_HEADERS,
+                               _MAX_RESPONSE_TEXT, _encode_parts, _is_transient, _resolve_webhook)
+from .split import DEFAULT_MAX_PAYLOAD_BYTES
+
+####################################################################################################
+class AsyncMattermostInterface:
+    """
+    asyncio counterpart of MattermostInterface, for posting from inside an event loop without
+    blocking it. Requires the optional aiohttp package.
+
+    The interface owns a pooled aiohttp session, created on the first post inside the running loop,
+    and at most max_in_flight requests are sent at the same time. Close it with close(), or use it as
+    an asynchronous context manager:
+
+        async with AsyncMattermostInterface('.mattermost_url.txt') as interface:
+            await interface.post(message)
+
+    pool_maxsize  : maximum number of connections kept alive
+    max_in_flight : maximum number of requests waiting on a response at any one time
+    rate_limit    : maximum messages per second to this webhook (see MattermostRateLimiter)
+    rate_burst    : number of messages that can be sent back-to-back before rate_limit applies
+    metrics       : collects delivery statistics and calls hooks around each request (see
+                    MattermostMetrics)
+    max_payload_bytes: messages which encode to more than this are split into several posts, sent
+                    one after another (see split_payload). None to never split
+    """
+    def __init__(self, incomingwebhook : str, timeout : float = 2.5, pool_maxsize : int = 10,
+                 max_in_flight : int = 10, rate_limit : float = None, rate_burst : int = None,
+                 metrics = None, max_payload_bytes : int = DEFAULT_MAX_PAYLOAD_BYTES):
+        global aiohttp
+        if aiohttp is None:
+            try:
+                import aiohttp
+            except ImportError:
+                raise ImportError("AsyncMattermostInterface requires the aiohttp package (pip install aiohttp)")
+
+        # Store timeout
+        if timeout > 0:
+            self.timeout = timeout
+        else:
+            self.timeout = 2.5
+
+        self.pool_maxsize = max(1, pool_maxsize)
+        self.max_in_flight = max(1, max_in_flight)
+        self.url = _resolve_webhook(incomingwebhook)
+        self.rate_limiter = MattermostRateLimiter.for_url(self.url, rate_limit, rate_burst)
+        self.metrics = metrics
+        self.max_payload_bytes = max_payload_bytes
+
+        # These must be created inside the event loop that uses them
+        self._session = None
+        self._semaphore = None
+        return
+
+    ####################################################################################################
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+        return False
+
+    ####################################################################################################
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        """
+        Get the pooled session, creating it (and the in-flight semaphore) on first use
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_maxsize),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._session
+
+    ####################################################################################################
+    async def close(self) -> None:
+        """
+        Close the pooled connections
+        """
+        session = self._session
+        self._session = None
+        self._semaphore = None
+        if session is not None:
+            await session.close()
+        return
+
+    ####################################################################################################
+    async def _send(self, body : bytes, result : MattermostPostResult = None) -> bool:
+        """
+        Send an encoded message payload to the webhook, and return true or false if it worked! If
+        result is given, the number of requests made and the server's response are recorded in it
+        """
+        session = self._get_session()
+        metrics = self.metrics
+
+        # Resend once if we were rate limited
+        for attempt in range(2):
+            if result is not None:
+                result.attempts += 1
+            wait = self.rate_limiter.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            async with self._semaphore:
+                if metrics is not None:
+                    metrics.call_hooks('before_send', self.url, body)
+                    start = time.perf_counter()
+                try:
+                    async with session.post(self.url, data=body, headers=_JSON_HEADERS) as x:
+                        text = await x.read()
+                except Exception as e:
+                    if metrics is not None:
+                        metrics.observe_request(self.url, len(body), None, time.perf_counter() - start, e)
+                        metrics.increment('failed')
+                    raise
+                if metrics is not None:
+                    metrics.observe_request(self.url, len(body), x.status, time.perf_counter() - start, None)
+            if self.rate_limiter.update(x.status, x.headers) == 0:
+                break
+            if metrics is not None:
+                metrics.increment('retried')
+
+        if metrics is not None:
+            metrics.increment('sent' if x.status == 200 else 'failed')
+        if result is not None:
+            result.status_code = x.status
+            if x.status != 200:
+                result.response_text = text[:_MAX_RESPONSE_TEXT].decode('utf-8', 'replace')
+        return x.status == 200
+
+    ####################################################################################################
+    async def _send_parts(self, body : Union[bytes, Tuple[bytes, ...]], result : MattermostPostResult = None) -> bool:
+        """
+        Send an encoded message payload, or each of the parts of a split message in turn, stopping at
+        the first which fails
+        """
+        for part in (body if isinstance(body, tuple) else (body,)):
+            if not await self._send(part, result):
+                return False
+        return True
+
+    ####################################################################################################
+    async def _post_result(self, message : Union[MattermostMessage, dict],
+                           body : Union[bytes, Tuple[bytes, ...]]) -> MattermostPostResult:
+        """
+        Send a message payload and package up what happened
+        """
+        result = MattermostPostResult(self.url, message=message)
+        start = time.perf_counter()
+        try:
+            await self._send_parts(body, result)
+            result.retryable = _is_transient(result.status_code)
+        except Exception as e:
+            result.error = e
+            result.retryable = isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    ####################################################################################################
+    async def post(self, message : Union[MattermostMessage, dict],
+                   return_result : bool = False) -> Union[bool, MattermostPostResult]:
+        """
+        Post the message, and return true or false if it worked! With return_result true, a
+        MattermostPostResult saying what happened is returned instead, and no exception is raised
+        for a failed post
+        """
+        body = _encode_parts(message, self.max_payload_bytes)
+        if return_result:
+            return await self._post_result(message, body)
+        return await self._send_parts(body)
+
+    ####################################################################################################
+    async def post_many(self, messages : List[Union[MattermostMessage, dict]],
+                        return_result : bool = False) -> List[Union[bool, MattermostPostResult]]:
+        """
+        Post several messages concurrently (at most max_in_flight at a time). Returns true or false
+        for each message, in the same order as messages. Messages that could not be sent because of
+        a connection error or timeout count as false. With return_result true, a MattermostPostResult
+        is returned for each message instead
+        """
+        bodies = [ _encode_parts(message, self.max_payload_bytes) for message in messages ]
+        if return_result:
+            return list(await asyncio.gather(*[ self._post_result(message, body) for message, body in zip(messages, bodies) ]))
+        results = await asyncio.gather(*[ self._send_parts(body) for body in bodies ], return_exceptions=True)
+        return [ x is True for x in results ]
+
+    ####################################################################################################
+    async def post_message_from_exception(self, e : Exception) -> None:
+        """
+        Posts a message from an exception without having to call MattermostMessage
+        """
+        await self.post( MattermostMessage.create_message_from_exception(e) )
@@ -0,0 +1,195 @@
+import copy
+import threading
+import time
+from typing import Callable, Hashable
+
+from .mattermostpython import MattermostField, MattermostInterface, MattermostMessage
+
+####################################################################################################
+class _Window:
+    """
+    POD class for the messages seen for one key since its window opened
+    """
+    def __init__(self, message : MattermostMessage, now : float, deadline : float):
+        self.first_time = now
+        self.last_time = now
+        self.last_message = message
+        self.deadline = deadline
+        self.suppressed = 0
+        self.rows = []
+        return
+
+####################################################################################################
+class MattermostCoalescer:
+    """
+    Sits in front of a MattermostInterface and collapses storms of near-identical messages. Messages
+    are grouped by a key, by default their title and priority. The first message for a key is posted
+    straight away and opens a window of window seconds; any further messages with the same key
+    arriving within the window are held back, and when the window closes they are replaced by a
+    single digest message, built from the last of them, giving the number of repeats, the first and
+    last occurrence and a table of up to max_rows of their times and texts.
+
+        coalescer = MattermostCoalescer(interface, window=30)
+        for reading in readings:
+            coalescer.post(MattermostMessage(title='HV trip', text=reading))
+
+    key       : function mapping a message to a hashable key
+    max_rows  : maximum number of occurrences listed in the digest
+    use_queue : post through the interface's background queue rather than blocking
+    """
+    def __init__(self, interface : MattermostInterface, window : float = 10.0,
+                 key : Callable[[MattermostMessage], Hashable] = None, max_rows : int = 10,
+                 use_queue : bool = True):
+        self.interface = interface
+        self.window = window
+        self.key = key if key is not None else self.default_key
+        self.max_rows = max(0, max_rows)
+        self.use_queue = use_queue
+        self.coalesced = 0 # Number of messages merged into digests
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._closed = False
+        return
+
+    ####################################################################################################
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    ####################################################################################################
+    @staticmethod
+    def default_key(message : MattermostMessage) -> Hashable:
+        return (message.get_title(), message.get_priority())
+
+    ####################################################################################################
+    def post(self, message : MattermostMessage) -> bool:
+        """
+        Post the message, unless another message with the same key was posted within the window, in
+        which case it is held back for the digest and true is returned
+        """
+        now = time.monotonic()
+        key = self.key(message)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is not None and now < window.deadline and not self._closed:
+                window.suppressed += 1
+                window.last_time = now
+                window.last_message = message
+                if len(window.rows) < self.max_rows:
+                    window.rows.append( (time.time(), message.get_text()) )
+                self.coalesced += 1
+                if self.interface.metrics is not None:
+                    self.interface.metrics.increment('coalesced')
+                return True
+
+            # Open a new window for this key
+            self._windows[key] = _Window(message, now, now + self.window)
+            self._start_timer()
+            self._wakeup.notify()
+
+        digest = self._make_digest(window) if window is not None else None
+        if digest is not None:
+            self._send(digest)
+        return self._send(message)
+
+    ####################################################################################################
+    def flush(self) -> None:
+        """
+        Close every open window now, posting the pending digests
+        """
+        with self._lock:
+            windows = list(self._windows.values())
+            self._windows.clear()
+        for window in windows:
+            digest = self._make_digest(window)
+            if digest is not None:
+                self._send(digest)
+        return
+
+    ####################################################################################################
+    def close(self) -> None:
+        """
+        Post the pending digests and stop the timer thread
+        """
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify()
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            thread.join()
+        self.flush()
+        return
+
+    ####################################################################################################
+    def _send(self, message : MattermostMessage) -> bool:
+        if self.use_queue:
+            return self.interface.post_async(message)
+        return self.interface.post(message)
+
+    ####################################################################################################
+    def _make_digest(self, window : _Window) -> MattermostMessage:
+        """
+        Build the digest message for a closed window, or None if nothing was held back
+        """
+        if window.suppressed == 0:
+            return None
+        import datetime
+
+        def timestamp(x):
+            return datetime.datetime.fromtimestamp(x).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+        # Convert the monotonic window times into wall-clock times
+        offset = time.time() - time.monotonic()
+
+        digest = copy.copy(window.last_message)
+        title = digest.get_title() or 'Message'
+        digest.set_title(f"{title} (repeated {window.suppressed} more times)")
+        digest.set_notification_message(digest.get_title())
+        digest.set_fields([
+            MattermostField(True, 'Occurrences', str(window.suppressed + 1)),
+            MattermostField(True, 'First occurrence', timestamp(window.first_time + offset)),
+            MattermostField(True, 'Last occurrence', timestamp(window.last_time + offset))
+        ])
+        for when, text in window.rows:
+            digest.add_field( MattermostField(False, timestamp(when), text) )
+        if window.suppressed > len(window.rows):
+            digest.add_field( MattermostField(False, '', f"... and {window.suppressed - len(window.rows)} more") )
+        return digest
+
+    ####################################################################################################
+    def _start_timer(self) -> None:
+        """
+        Start the thread which posts digests when windows close. Must hold the lock
+        """
+        if self._thread is None and not self._closed:
+            self._thread = threading.Thread(target=self._timer, name='mattermost-coalescer', daemon=True)
+            self._thread.start()
+        return
+
+    ####################################################################################################
+    def _timer(self) -> None:
+        """
+        Body of the timer thread: post digests for windows as they close
+        """
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                now = time.monotonic()
+                expired = [ key for key, window in self._windows.items() if window.deadline <= now ]
+                windows = [ self._windows.pop(key) for key in expired ]
+                if not windows:
+                    deadlines = [ window.deadline for window in self._windows.values() ]
+                    self._wakeup.wait( min(deadlines) - now if deadlines else None )
+                    continue
+
+            for window in windows:
+                digest = self._make_digest(window)
+                if digest is not None:
+                    self._send(digest)
@@ -0,0 +1,276 @@
+import os
+import select
+import socket
+import socketserver
+import threading
+import time
+from typing import Union
+import weakref
+
+from .mattermostpython import MattermostInterface, MattermostMessage, _encode, _get_payload
+from .coalesce import MattermostCoalescer
+
+####################################################################################################
+class MattermostSenderDaemon:
+    """
+    Posts messages on behalf of many processes, such as the workers of a multiprocessing pool, so
+    that one interface owns the connection pool, rate limiter, queue and coalescer instead of every
+    process opening its own connections and hitting the rate limit at the same time. The daemon
+    listens on a Unix domain socket at path, and processes hand it messages with a
+    MattermostSenderClient:
+
+        with MattermostSenderDaemon(MattermostInterface('.mattermost_url.txt'), '/tmp/mattermost.sock'):
+            with multiprocessing.Pool(64) as pool:
+                pool.map(analyse, runs) # each worker posts with MattermostSenderClient('/tmp/mattermost.sock')
+
+    Messages are posted through the interface's background queue. With coalesce_window above 0,
+    repeats within the window are collapsed into digests (see MattermostCoalescer), which means
+    decoding each payload; otherwise the encoded payloads are queued as they arrive.
+
+    The daemon runs in a background thread of the process which starts it, or can be run as a
+    process of its own with serve_forever(), as python -m mattermostpython --serve does
+    """
+    def __init__(self, interface : MattermostInterface, path : str, coalesce_window : float = 0.0):
+        self.interface = interface
+        self.path = path
+        self.received = 0 # Number of messages handed to the daemon
+        self.coalescer = MattermostCoalescer(interface, window=coalesce_window) if coalesce_window > 0 else None
+        self._lock = threading.Lock()
+        self._thread = None
+
+        # Replace the socket left behind by a daemon which did not shut down cleanly
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)
+            else:
+                raise ValueError(f"Another sender daemon is already listening on {path}")
+            finally:
+                probe.close()
+
+        self._server = _Server(path, self._make_handler())
+        return
+
+    ####################################################################################################
+    def _make_handler(self):
+        """
+        Build the request handler class bound to this daemon
+        """
+        owner = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                # One JSON-encoded payload per line; the encoders never put a raw newline in one. A
+                # line cut short by the client going away is dropped
+                for line in self.rfile:
+                    if line.endswith(b'\n') and len(line) > 1:
+                        owner._receive(line[:-1])
+
+        return Handler
+
+    ####################################################################################################
+    def _receive(self, body : bytes) -> None:
+        with self._lock:
+            self.received += 1
+        try:
+            if self.coalescer is not None:
+                self.coalescer.post( MattermostMessage.from_message_data(_get_payload(body)) )
+            else:
+                self.interface.post_async(body)
+        except Exception as e:
+            print(f"WARNING - sender daemon could not post message: {e}")
+        return
+
+    ####################################################################################################
+    def start(self) -> 'MattermostSenderDaemon':
+        """
+        Serve in a background thread
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mattermost-daemon', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        """
+        Serve in this thread until stop() is called from another, or KeyboardInterrupt
+        """
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    ####################################################################################################
+    def stop(self, timeout : float = None) -> None:
+        """
+        Stop accepting connections and remove the socket, then wait for the clients still connected
+        to disconnect and post everything they sent, taking at most timeout seconds in all
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        def remaining():
+            return max(0.0, deadline - time.monotonic()) if deadline is not None else None
+
+        if self._thread is not None:
+            # Let the connections already waiting be accepted first
+            server = self._server
+            while select.select([server.socket], [], [], 0)[0] and (deadline is None or remaining() > 0):
+                time.sleep(0.01)
+            server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        with self._server.idle:
+            self._server.idle.wait_for(lambda: self._server.connections == 0, remaining())
+        if self.coalescer is not None:
+            self.coalescer.close()
+        self.interface.close(remaining())
+        return
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop(self.interface.exit_timeout)
+        return False
+
+####################################################################################################
+class _Server(socketserver.ThreadingUnixStreamServer):
+    """
+    Server which keeps count of the connections being handled
+    """
+    # Every worker of a large pool may connect at once
+    request_queue_size = 128
+    daemon_threads = True
+    poll_interval = 0.1
+
+    def __init__(self, path : str, handler):
+        self.connections = 0
+        self.idle = threading.Condition()
+        super().__init__(path, handler)
+        return
+
+    def serve_forever(self):
+        super().serve_forever(self.poll_interval)
+        return
+
+    def process_request(self, request, client_address):
+        with self.idle:
+            self.connections += 1
+        super().process_request(request, client_address)
+        return
+
+    def shutdown_request(self, request):
+        super().shutdown_request(request)
+        with self.idle:
+            self.connections -= 1
+            self.idle.notify_all()
+        return
+
+####################################################################################################
+class MattermostSenderClient:
+    """
+    Hands messages to a MattermostSenderDaemon listening on the Unix domain socket at path. Sending
+    only encodes the message and writes it to the socket, so it is cheap, and it returns as soon as
+    the daemon has the message, not once the message is posted.
+
+    A client can be shared by the threads of a process, and can be created before forking: each
+    process connects on its first post, so children never share the parent's connection
+    """
+    def __init__(self, path : str, timeout : float = 2.5):
+        self.path = path
+        self.timeout = timeout
+        self._sock = None
+        self._lock = threading.Lock()
+        _clients.add(self)
+        return
+
+    def _reset_after_fork(self) -> None:
+        """
+        Called in the child after a fork, which must use neither the parent's lock, which may have
+        been held by another of the parent's threads, nor its connection
+        """
+        self._lock = threading.Lock()
+        self._sock = None
+        return
+
+    ####################################################################################################
+    def _connect(self) -> socket.socket:
+        """
+        Get this process's connection to the daemon, connecting on first use. Must hold the lock
+        """
+        if self._sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            deadline = time.monotonic() + self.timeout
+            while True:
+                try:
+                    sock.connect(self.path)
+                    break
+                except BlockingIOError:
+                    # The daemon's backlog is full, so wait for it to accept some connections
+                    if time.monotonic() < deadline:
+                        time.sleep(0.01)
+                        continue
+                    sock.close()
+                    raise
+                except OSError:
+                    sock.close()
+                    raise
+            self._sock = sock
+        return self._sock
+
+    ####################################################################################################
+    def post(self, message : Union[MattermostMessage, dict]) -> bool:
+        """
+        Hand the message to the daemon. Returns false if the daemon could not be reached
+        """
+        line = _encode(message) + b'\n'
+        with self._lock:
+            # Reconnect once if the daemon has been restarted since we connected
+            for attempt in range(2):
+                try:
+                    self._connect().sendall(line)
+                    return True
+                except OSError as e:
+                    self._close()
+                    error = e
+        print(f"WARNING - could not reach Mattermost sender daemon at {self.path}: {error}")
+        return False
+
+    post_async = post
+
+    ####################################################################################################
+    def _close(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        return
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+####################################################################################################
+# Every client, so that they can be made safe to use in the child after a fork
+_clients = weakref.WeakSet()
+
+def _after_fork_in_child() -> None:
+    for client in list(_clients):
+        client._reset_after_fork()
+    return
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
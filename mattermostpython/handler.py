@@ -0,0 +1,176 @@
+import collections
+import logging
+import threading
+import time
+from typing import Dict, List
+
+from .mattermostpython import MattermostField, MattermostInterface, MattermostMessage, MattermostMessagePriority
+
+####################################################################################################
+class MattermostHandler(logging.Handler):
+    """
+    logging handler which posts log records to Mattermost without holding up the code doing the
+    logging. emit() only appends the record to a buffer of at most max_buffer records (dropping the
+    oldest when it is full), and a background thread posts the buffered records in batches: every
+    flush_interval seconds, or as soon as batch_size records are waiting. A batch of one record is
+    posted as its own message, and larger batches as one message listing all the records.
+
+        logging.getLogger().addHandler( MattermostHandler(interface, level=logging.ERROR) )
+
+    Record levels map to message priorities and colours, and exception information is posted as a
+    python code block, as MattermostMessage.create_message_from_exception does. If the handler has a
+    formatter, it is used for the text of each record instead. As formatting is done in the
+    background, arguments to the logging call should not be modified after it.
+
+    close(), which logging.shutdown() calls at exit, spends at most close_timeout seconds (by default
+    the interface's exit_timeout) posting what is still buffered, and drops the rest
+    """
+    _default_priorities = {
+        logging.ERROR : MattermostMessagePriority.IMPORTANT,
+        logging.CRITICAL : MattermostMessagePriority.URGENT
+    }
+    _default_colours = {
+        logging.WARNING : '#FFA500',
+        logging.ERROR : '#FF0000',
+        logging.CRITICAL : '#8B0000'
+    }
+
+    def __init__(self, interface : MattermostInterface, level : int = logging.ERROR, batch_size : int = 20,
+                 flush_interval : float = 2.0, max_buffer : int = 1000,
+                 priorities : Dict[int, MattermostMessagePriority] = None, colours : Dict[int, str] = None,
+                 close_timeout : float = None):
+        super().__init__(level)
+        self.interface = interface
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.close_timeout = close_timeout if close_timeout is not None else getattr(interface, 'exit_timeout', 5.0)
+        self.priorities = priorities if priorities is not None else self._default_priorities
+        self.colours = colours if colours is not None else self._default_colours
+        self.dropped = 0 # Number of records discarded because the buffer was full, or left when closing
+        self._buffer = collections.deque(maxlen=max(1, max_buffer))
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._send_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='mattermost-logging', daemon=True)
+        self._thread.start()
+        return
+
+    ####################################################################################################
+    def emit(self, record : logging.LogRecord) -> None:
+        # Ignore anything logged while we are posting, such as by urllib3, to avoid feedback
+        if threading.get_ident() == self._thread.ident:
+            return
+        buffer = self._buffer
+        if len(buffer) == buffer.maxlen:
+            self.dropped += 1
+        buffer.append(record)
+        if len(buffer) >= self.batch_size:
+            self._wakeup.set()
+        return
+
+    ####################################################################################################
+    def flush(self, timeout : float = None) -> None:
+        """
+        Post all the buffered records now, or as many as can be posted within timeout seconds
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if not self._send_lock.acquire(timeout=max(0.0, timeout) if timeout is not None else -1):
+            return
+        try:
+            while self._buffer and (deadline is None or time.monotonic() < deadline):
+                batch = []
+                while self._buffer and len(batch) < self.batch_size:
+                    batch.append(self._buffer.popleft())
+                # Report a failed batch once, rather than once for every record in it
+                try:
+                    if not self.interface.post(self.make_message(batch)):
+                        print(f"WARNING - failed to post {len(batch)} log records to Mattermost")
+                except Exception as e:
+                    print(f"WARNING - failed to post {len(batch)} log records to Mattermost: {e}")
+        finally:
+            self._send_lock.release()
+        return
+
+    ####################################################################################################
+    def close(self) -> None:
+        """
+        Stop the background thread and post anything still buffered, giving up on what is left after
+        close_timeout seconds
+        """
+        deadline = time.monotonic() + self.close_timeout
+        self._closed = True
+        self._wakeup.set()
+        if self._thread.is_alive() and threading.get_ident() != self._thread.ident:
+            self._thread.join(self.close_timeout)
+        self.flush(max(0.0, deadline - time.monotonic()))
+        if self._buffer:
+            n = len(self._buffer)
+            self._buffer.clear()
+            self.dropped += n
+            print(f"WARNING - gave up posting {n} log records to Mattermost when closing")
+        super().close()
+        return
+
+    ####################################################################################################
+    def _run(self) -> None:
+        """
+        Body of the background thread: post buffered records until the handler is closed
+        """
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+        return
+
+    ####################################################################################################
+    def get_priority(self, levelno : int) -> MattermostMessagePriority:
+        """
+        The priority of the highest level in the mapping which is not above levelno
+        """
+        levels = [ x for x in self.priorities if x <= levelno ]
+        return self.priorities[max(levels)] if levels else MattermostMessagePriority.STANDARD
+
+    def get_colour(self, levelno : int) -> str:
+        levels = [ x for x in self.colours if x <= levelno ]
+        return self.colours[max(levels)] if levels else ''
+
+    ####################################################################################################
+    def format_text(self, record : logging.LogRecord) -> str:
+        """
+        The text for one record: the formatted record if the handler has a formatter, otherwise the
+        message followed by any exception as a python code block
+        """
+        if self.formatter is not None:
+            return self.format(record)
+        text = record.getMessage()
+        if record.exc_info:
+            text += "\n```python\n" + logging.Formatter().formatException(record.exc_info) + "\n```"
+        elif record.exc_text:
+            text += "\n```python\n" + record.exc_text + "\n```"
+        return text
+
+    ####################################################################################################
+    def make_message(self, records : List[logging.LogRecord]) -> MattermostMessage:
+        """
+        Build the message for a batch of records
+        """
+        levelno = max( x.levelno for x in records )
+        if len(records) == 1:
+            record = records[0]
+            return MattermostMessage(
+                title=f"{record.levelname}: {record.name}",
+                text=self.format_text(record),
+                priority=self.get_priority(levelno),
+                colour=self.get_colour(levelno),
+                fields=[ MattermostField(True, 'Location', f"{record.pathname}:{record.lineno}"),
+                         MattermostField(True, 'Thread', record.threadName or '') ],
+                profile=getattr(self.interface, 'profile', None)
+            )
+
+        return MattermostMessage(
+            title=f"{logging.getLevelName(levelno)}: {len(records)} log records",
+            text="\n\n".join( f"**{x.levelname}** {x.name}: {self.format_text(x)}" for x in records ),
+            priority=self.get_priority(levelno),
+            colour=self.get_colour(levelno),
+            profile=getattr(self.interface, 'profile', None)
+        )
@@ -1,11 +1,19 @@
-import copy
+import atexit
+import collections
 import enum
 import os
+import random
 import re
-import requests
-import traceback
-from typing import List
-import validators
+import threading
+import time
+from typing import List, Tuple, Union
+import weakref
+
+# requests, validators and the other slower imports are only imported when they are first needed,
+# to keep the start-up time of short-lived scripts down
+
+from . import serialise
+from .split import DEFAULT_MAX_PAYLOAD_BYTES, split_payload
 
 ####################################################################################################
 class MattermostMessagePriority(enum.Enum):
@@ -31,6 +39,8 @@ class MattermostField:
     """
     POD class for holding field information for the Mattermost message
     """
+    __slots__ = ('short', 'title', 'value')
+
     def __init__(self, short : bool = False, title : str = '', value : str = ''):
         self.short = short
         self.title = title
@@ -47,6 +57,324 @@ class MattermostField:
         mystr += " "*padding + "|\n"
         return mystr
 
+####################################################################################################
+class MattermostQueuePolicy(enum.Enum):
+    """
+    Enum for what MattermostInterface.post_async does when the delivery queue is full
+    """
+    BLOCK = 0       # Wait for space in the queue
+    DROP_OLDEST = 1 # Discard the oldest queued message of the lowest priority to make room
+    DROP_NEWEST = 2 # Discard the message being queued, or the newest queued one of a lower priority
+
+    def __str__(self):
+        if self.value == 0:
+            return 'block'
+        if self.value == 1:
+            return 'drop oldest'
+        if self.value == 2:
+            return 'drop newest'
+        return ''
+
+####################################################################################################
+# Share of the messages handed out to each priority while messages of several priorities are waiting
+_DEFAULT_PRIORITY_BUDGETS = {
+    MattermostMessagePriority.URGENT : 8,
+    MattermostMessagePriority.IMPORTANT : 3,
+    MattermostMessagePriority.STANDARD : 1,
+}
+
+####################################################################################################
+class _DeliveryQueue:
+    """
+    Bounded queue of message payloads waiting to be posted by the MattermostInterface workers, with
+    a FIFO for each MattermostMessagePriority. Keeps track of unfinished items so that callers can
+    wait for the queue to drain.
+
+    While messages of several priorities are waiting, each priority is handed out in proportion to
+    its budget (a smooth weighted round robin), so an urgent message is handed out within a couple
+    of items however many others are waiting, while no priority is starved. Standard messages which
+    have waited for aging seconds are moved up to the important ones. Nothing is moved up to
+    urgent, as that would put the backlog back in front of urgent messages
+    """
+    def __init__(self, maxsize : int, policy : MattermostQueuePolicy, budgets : dict = None, aging : float = None):
+        if budgets is None:
+            budgets = _DEFAULT_PRIORITY_BUDGETS
+        if any( budgets.get(x, 0) <= 0 for x in MattermostMessagePriority ):
+            raise ValueError("Every priority needs a positive budget, or it could be starved")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.budgets = budgets
+        self.aging = aging
+        self.dropped = 0
+        self.metrics = None
+        self._weights = [ budgets[x] for x in sorted(MattermostMessagePriority, key=lambda x: x.value) ]
+        self._credits = [0] * len(self._weights)
+        self._items = [ collections.deque() for x in self._weights ] # Indexed by priority value
+        self._size = 0
+        self._unfinished = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+        return
+
+    def __len__(self):
+        with self._lock:
+            return self._size
+
+    def renew(self) -> '_DeliveryQueue':
+        """
+        Get an empty queue with the same settings
+        """
+        queue = _DeliveryQueue(self.maxsize, self.policy, self.budgets, self.aging)
+        queue.metrics = self.metrics
+        return queue
+
+    ####################################################################################################
+    def put(self, item, timeout : float = None, priority : int = 0) -> bool:
+        """
+        Add an item with the given priority value, applying the full-queue policy, which always
+        discards from the lowest priority, counting the item itself. Returns False if the item was
+        not queued
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            if self._size >= self.maxsize:
+                lowest = next( i for i, x in enumerate(self._items) if x )
+                if self.policy == MattermostQueuePolicy.DROP_NEWEST:
+                    # Only make room if the item outranks something queued
+                    if lowest >= priority:
+                        self._drop()
+                        return False
+                    self._items[lowest].pop()
+                    self._size -= 1
+                    self._unfinished -= 1
+                    self._drop()
+                elif self.policy == MattermostQueuePolicy.DROP_OLDEST:
+                    # Never make room by discarding something which outranks the item
+                    if lowest > priority:
+                        self._drop()
+                        return False
+                    self._items[lowest].popleft()
+                    self._size -= 1
+                    self._unfinished -= 1
+                    self._drop()
+                elif not self._not_full.wait_for(lambda: self._size < self.maxsize or self._closed, timeout):
+                    self._drop()
+                    return False
+                elif self._closed:
+                    return False
+            self._items[priority].append( (time.monotonic(), item) )
+            self._size += 1
+            self._unfinished += 1
+            self._not_empty.notify()
+        return True
+
+    def _drop(self) -> None:
+        self.dropped += 1
+        if self.metrics is not None:
+            self.metrics.increment('dropped')
+        return
+
+    ####################################################################################################
+    def get(self):
+        """
+        Remove and return the next item, blocking until one is available. Returns None once the
+        queue is closed and empty
+        """
+        with self._lock:
+            self._not_empty.wait_for(lambda: self._size or self._closed)
+            if not self._size:
+                return None
+            if self.aging is not None:
+                self._age()
+            item = self._items[self._next_priority()].popleft()[1]
+            self._size -= 1
+            self._not_full.notify()
+            return item
+
+    def _age(self) -> None:
+        """
+        Move standard items which have waited too long up to the important ones. Must hold the lock
+        """
+        standard = self._items[MattermostMessagePriority.STANDARD.value]
+        important = self._items[MattermostMessagePriority.IMPORTANT.value]
+        oldest = time.monotonic() - self.aging
+        while standard and standard[0][0] <= oldest:
+            important.append( standard.popleft() )
+        return
+
+    def _next_priority(self) -> int:
+        """
+        Pick the priority to hand out next, by smooth weighted round robin between the priorities
+        which have items waiting, with ties going to the higher priority. Must hold the lock
+        """
+        credits = self._credits
+        total = 0
+        best = None
+        for i in range(len(self._items) - 1, -1, -1):
+            if self._items[i]:
+                credits[i] += self._weights[i]
+                total += self._weights[i]
+                if best is None or credits[i] > credits[best]:
+                    best = i
+            else:
+                credits[i] = 0
+        credits[best] -= total
+        return best
+
+    ####################################################################################################
+    def get_depths(self) -> dict:
+        """
+        Number of items waiting at each priority
+        """
+        with self._lock:
+            return { x : len(self._items[x.value]) for x in MattermostMessagePriority }
+
+    ####################################################################################################
+    def task_done(self) -> None:
+        with self._lock:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._all_done.notify_all()
+        return
+
+    ####################################################################################################
+    def join(self, timeout : float = None) -> bool:
+        """
+        Wait until every queued item has been processed. Returns False on timeout
+        """
+        with self._lock:
+            return self._all_done.wait_for(lambda: self._unfinished <= 0, timeout)
+
+    def discard(self) -> int:
+        """
+        Drop every queued item, returning how many there were
+        """
+        with self._lock:
+            n = self._size
+            for items in self._items:
+                items.clear()
+            self._size = 0
+            self._unfinished -= n
+            for i in range(n):
+                self._drop()
+            self._not_full.notify_all()
+            if self._unfinished <= 0:
+                self._all_done.notify_all()
+            return n
+
+    ####################################################################################################
+    def close(self) -> None:
+        """
+        Stop accepting items and wake up anyone waiting. Items already queued are still handed out
+        """
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        return
+
+####################################################################################################
+_COLOUR_PATTERN = re.compile('#([0-9A-Fa-f]){6}$')
+
+def _valid_colour(colour : str) -> str:
+    """
+    The colour if it is a #RRGGBB hex colour, otherwise no colour
+    """
+    return colour if _COLOUR_PATTERN.match(colour) is not None else ''
+
+####################################################################################################
+class MattermostProfile:
+    """
+    Immutable, named set of defaults for MattermostMessage, such as one for each subsystem posting
+    to the same channel. Register a profile once and then select it by name, either per message or
+    for every message made by an interface:
+
+        MattermostProfile.register( MattermostProfile('daq', username='DAQ', colour='#0000FF') )
+        message = MattermostMessage(profile='daq', text='Run started')
+        interface = MattermostInterface('.mattermost_url.txt', profile='daq')
+
+    Messages share the profile rather than copying it, so making a message costs the same however
+    many defaults there are, and as a profile is never changed, it can be used by any number of
+    threads at once. Changing defaults means making a new profile with replace(). The default
+    fields are copied into a message only if the message's fields are changed or asked for.
+
+    Messages made without a profile use the default profile, which the set_default_*() class
+    methods of MattermostMessage replace
+    """
+    __slots__ = ('name', 'username', 'icon_url', 'priority', 'message_info', 'colour', 'pretext', 'text',
+                 'footer', 'footer_icon', 'author_name', 'author_link', 'author_icon', 'title', 'title_link',
+                 'fields', 'notification_message')
+
+    _profiles = {}
+    _profiles_lock = threading.Lock()
+
+    def __init__(self,
+                 name : str = '',
+                 username : str = '',
+                 icon_url : str = '',
+                 priority : MattermostMessagePriority = MattermostMessagePriority.STANDARD,
+                 message_info : str = '',
+                 colour : str = '',
+                 pretext : str = '',
+                 text : str = '',
+                 footer : str = '',
+                 footer_icon : str = '',
+                 author_name : str = '',
+                 author_link : str = '',
+                 author_icon : str = '',
+                 title : str = '',
+                 title_link : str = '',
+                 fields : List[MattermostField] = (),
+                 notification_message : str = '',
+        ):
+        values = locals()
+        for key in self.__slots__:
+            object.__setattr__(self, key, values[key])
+        object.__setattr__(self, 'colour', _valid_colour(colour))
+
+        # Keep copies, so the fields cannot be changed through the list they were given in
+        object.__setattr__(self, 'fields', tuple( MattermostField(x.short, x.title, x.value) for x in fields ))
+        return
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MattermostProfile is immutable, use replace() to make a changed copy")
+
+    def __repr__(self):
+        return f"MattermostProfile({self.name!r})"
+
+    ####################################################################################################
+    def replace(self, **kwargs) -> 'MattermostProfile':
+        """
+        Get a copy of the profile with the given defaults changed
+        """
+        values = { name : getattr(self, name) for name in self.__slots__ }
+        values.update(kwargs)
+        return MattermostProfile(**values)
+
+    ####################################################################################################
+    @classmethod
+    def register(cls, profile : 'MattermostProfile') -> 'MattermostProfile':
+        """
+        Make the profile selectable by its name, replacing any other profile with that name
+        """
+        with cls._profiles_lock:
+            cls._profiles[profile.name] = profile
+        return profile
+
+    @classmethod
+    def get(cls, name : str) -> 'MattermostProfile':
+        """
+        Get the registered profile with this name
+        """
+        profile = cls._profiles.get(name)
+        if profile is None:
+            raise ValueError(f"No MattermostProfile called {name} has been registered")
+        return profile
+
 ####################################################################################################
 class MattermostMessage:
     """
@@ -54,23 +382,13 @@ class MattermostMessage:
     send the Mattermost message to the desired incoming webhook. Note that this uses some Linux/macos
     only functionality to generate a default username
     """
+    __slots__ = ('username', 'icon_url', 'priority', 'message_info', 'colour', 'pretext', 'text', 'footer',
+                 'footer_icon', 'author_name', 'author_link', 'author_icon', 'title', 'title_link', 'fields',
+                 'notification_message')
 
-    _default_username = ''
-    _default_icon_url = ''
-    _default_priority = MattermostMessagePriority.STANDARD
-    _default_message_info = ''
-    _default_colour = ''
-    _default_pretext = ''
-    _default_text = ''
-    _default_footer = ''
-    _default_footer_icon = ''
-    _default_author_name = ''
-    _default_author_link = ''
-    _default_author_icon = ''
-    _default_title = ''
-    _default_title_link = ''
-    _default_fields = []
-    _default_notification_message = ''
+    # Replaced, never changed, so that messages can share it between threads
+    _default_profile = MattermostProfile()
+    _default_profile_lock = threading.Lock()
 
     def __init__(self,
                  username : str = None,
@@ -89,79 +407,81 @@ class MattermostMessage:
                  title_link : str = None,
                  fields : list = None,
                  notification_message : str = None,
+                 profile : Union[MattermostProfile, str] = None,
         ):
+        # Values which are not given come from the profile
+        if profile is None:
+            profile = self._default_profile
+        elif isinstance(profile, str):
+            profile = MattermostProfile.get(profile)
+
         # Start storing member variables
         if username == None:
-            username = self._default_username
+            username = profile.username
         self.username = username
         
         if icon_url == None:
-            icon_url = self._default_icon_url
+            icon_url = profile.icon_url
         self.icon_url = icon_url
         
         if priority == None:
-            priority = self._default_priority
+            priority = profile.priority
         self.priority = priority
         
         if message_info == None:
-            message_info = self._default_message_info
+            message_info = profile.message_info
         self.message_info = message_info
 
+        # The profile's colour has already been checked
         if colour == None:
-            colour = self._default_colour
-
-        pattern = re.match('#([0-9A-Fa-f]){6}$', colour)
-        if pattern != None:
-            self.colour = colour
+            self.colour = profile.colour
         else:
-            self.colour = ''
-
+            self.colour = _valid_colour(colour)
 
         if pretext == None:
-            pretext = self._default_pretext
+            pretext = profile.pretext
         self.pretext = pretext
 
         if text == None:
-            text = self._default_text
+            text = profile.text
         self.text = text
 
         if footer == None:
-            footer = self._default_footer
+            footer = profile.footer
         self.footer = footer
 
         if footer_icon == None:
-            footer_icon = self._default_footer_icon
+            footer_icon = profile.footer_icon
         self.footer_icon = footer_icon
         
         if author_name == None:
-            author_name = self._default_author_name
+            author_name = profile.author_name
         self.author_name = author_name
         
         if author_link == None:
-            author_link = self._default_author_link
+            author_link = profile.author_link
         self.author_link = author_link
         
         if author_icon == None:
-            author_icon = self._default_author_icon
+            author_icon = profile.author_icon
         self.author_icon = author_icon
         
         if title == None:
-            title = self._default_title
+            title = profile.title
         self.title = title
         
         if title_link == None:
-            title_link = self._default_title_link
+            title_link = profile.title_link
         self.title_link = title_link
         
+        # The profile's fields are shared until they are changed or asked for (see get_fields)
         if fields == None:
-            fields = copy.deepcopy(self._default_fields)
+            fields = profile.fields
         self.fields = fields
-        
-        # self.fields = copy.deepcopy(fields) # This is needed to prevent the lists all sharing the same elements!
 
         # Ensure notification has something useful!
         if notification_message == None:
-            notification_message = self._default_notification_message
+            notification_message = profile.notification_message
         
         if notification_message == '':
             if self.title != '':
@@ -245,6 +565,9 @@ COLOUR:       {self.colour}
         return self.title_link
     
     def get_fields(self) -> List[MattermostField]:
+        # Copy the profile's fields so they can be changed without changing the profile
+        if isinstance(self.fields, tuple):
+            self.fields = [ MattermostField(x.short, x.title, x.value) for x in self.fields ]
         return self.fields
     
     def get_notification_message(self) -> str:
@@ -313,7 +636,7 @@ COLOUR:       {self.colour}
         return
     
     def add_field( self, x : MattermostField) -> None:
-        self.fields.append(x)
+        self.get_fields().append(x)
         return
     
     def set_notification_message( self, x : str ) -> None:
@@ -321,94 +644,127 @@ COLOUR:       {self.colour}
         return
     
     # SETTERS FOR DEFAULTS
-    # SETTERS
+    # Each replaces the default profile with a changed copy, so messages being made in other threads
+    # see either the old defaults or the new ones
+    @classmethod
+    def _replace_default_profile(cls, **kwargs) -> None:
+        with cls._default_profile_lock:
+            cls._default_profile = cls._default_profile.replace(**kwargs)
+        return
+
+    @classmethod
+    def get_default_profile(cls) -> MattermostProfile:
+        return cls._default_profile
+
+    @classmethod
+    def resolve_profile(cls, x : Union[MattermostProfile, str, None]) -> MattermostProfile:
+        """
+        The profile selected by x: the default profile for None, otherwise x or the registered
+        profile called x
+        """
+        if x is None:
+            return cls._default_profile
+        if isinstance(x, str):
+            return MattermostProfile.get(x)
+        return x
+
+    @classmethod
+    def set_default_profile(cls, x : Union[MattermostProfile, str]) -> None:
+        if isinstance(x, str):
+            x = MattermostProfile.get(x)
+        with cls._default_profile_lock:
+            cls._default_profile = x
+        return
+
     @classmethod
     def set_default_username(cls, x : str) -> None:
-        cls._default_username = x
+        cls._replace_default_profile(username=x)
         return
     
     @classmethod
     def set_default_icon_url(cls, x : str) -> None:
-        cls._default_icon_url = x
+        cls._replace_default_profile(icon_url=x)
         return
     
     @classmethod
     def set_default_priority(cls, x : MattermostMessagePriority) -> None:
-        cls._default_priority = x
+        cls._replace_default_profile(priority=x)
         return
     
     @classmethod
     def set_default_message_info(cls, x : str) -> None:
-        cls._default_message_info = x
+        cls._replace_default_profile(message_info=x)
         return
     
     @classmethod
     def set_default_colour(cls, x : str) -> None:
-        cls._default_colour = x
+        cls._replace_default_profile(colour=x)
         return
     
     @classmethod
     def set_default_pretext(cls, x : str) -> None:
-        cls._default_pretext = x
+        cls._replace_default_profile(pretext=x)
         return
     
     @classmethod
     def set_default_text(cls, x : str) -> None:
-        cls._default_text = x
+        cls._replace_default_profile(text=x)
         return
     
     @classmethod
     def set_default_footer(cls, x : str) -> None:
-        cls._default_footer = x
+        cls._replace_default_profile(footer=x)
         return
     
     @classmethod
     def set_default_footer_icon(cls, x : str) -> None:
-        cls._default_footer_icon = x
+        cls._replace_default_profile(footer_icon=x)
         return
     
     @classmethod
     def set_default_author_name(cls, x : str) -> None:
-        cls._default_author_name = x
+        cls._replace_default_profile(author_name=x)
         return
     
     @classmethod
     def set_default_author_link(cls, x : str) -> None:
-        cls._default_author_link = x
+        cls._replace_default_profile(author_link=x)
         return
     
     @classmethod
     def set_default_author_icon(cls, x : str) -> None:
-        cls._default_author_icon = x
+        cls._replace_default_profile(author_icon=x)
         return
     
     @classmethod
     def set_default_title(cls, x : str) -> None:
-        cls._default_title = x
+        cls._replace_default_profile(title=x)
         return
     
     @classmethod
     def set_default_title_link(cls, x : str) -> None:
-        cls._default_title_link = x
+        cls._replace_default_profile(title_link=x)
         return
     
     @classmethod
     def set_default_fields(cls, x : List[MattermostField]) -> None:
-        cls._default_fields = x
+        cls._replace_default_profile(fields=x)
         return
     
     @classmethod
     def add_default_field( cls, x : MattermostField) -> None:
-        cls._default_fields.append(x)
+        with cls._default_profile_lock:
+            profile = cls._default_profile
+            cls._default_profile = profile.replace(fields=profile.fields + (x,))
         return
     
     @classmethod
     def set_default_notification_message(cls, x : str) -> None:
-        cls._default_notification_message = x
+        cls._replace_default_profile(notification_message=x)
         return
 
     ####################################################################################################
-    def _make_dict(self):
+    def _make_dict(self) -> dict:
         """
         This dictionary is passed to the POSTS request to send to Mattermost
         """
@@ -472,30 +828,454 @@ COLOUR:       {self.colour}
             attachments['fields'] = fields
 
         data['attachments'] = [attachments]
-
-        self.dict = data
-        return
+        return data
 
     ####################################################################################################
     @staticmethod
-    def create_message_from_exception(exception : Exception):
+    def create_message_from_exception(exception : Exception, max_frames : int = None, max_length : int = None,
+                                      profile : Union[MattermostProfile, str] = None):
         """
-        A nice static method to package up an exception and post as a message
+        A nice static method to package up an exception and post as a message. The traceback is
+        taken from the exception itself, so this also works outside the except block which caught
+        it. At most the innermost max_frames frames, and the last max_length characters, of the
+        traceback are kept
         """
         message = MattermostMessage(
             title=type(exception).__name__,
-            text="```python\n" + traceback.format_exc() + "\n```"
+            text="```python\n" + format_exception(exception, max_frames, max_length) + "\n```",
+            profile=profile
         )
         return message
     
+    ####################################################################################################
+    @classmethod
+    def from_message_data(cls, data : dict) -> 'MattermostMessage':
+        """
+        Rebuild a message from its payload, as made by get_message_data(). Only the first attachment
+        is used
+        """
+        attachment = (data.get('attachments') or [{}])[0]
+        priority = data.get('priority', {}).get('priority')
+        return cls(
+            username=data.get('username', ''),
+            icon_url=data.get('icon_url', ''),
+            priority=next( (x for x in MattermostMessagePriority if str(x) == priority), None ),
+            message_info=data.get('props', {}).get('card', ''),
+            colour=attachment.get('color', ''),
+            pretext=attachment.get('pretext', ''),
+            text=attachment.get('text', ''),
+            footer=attachment.get('footer', ''),
+            footer_icon=attachment.get('footer_icon', ''),
+            author_name=attachment.get('author_name', ''),
+            author_link=attachment.get('author_link', ''),
+            author_icon=attachment.get('author_icon', ''),
+            title=attachment.get('title', ''),
+            title_link=attachment.get('title_link', ''),
+            fields=[ MattermostField(x.get('short', False), x.get('title', ''), x.get('value', ''))
+                     for x in attachment.get('fields', []) ],
+            notification_message=attachment.get('fallback', '')
+        )
+
     ####################################################################################################
     def get_message_data(self) -> dict:
         """
-        A getter for the dictionary
+        A getter for the dictionary. It is built afresh on every call rather than kept on the message
+        """
+        return self._make_dict()
+
+
+####################################################################################################
+def format_exception(exception : Exception, max_frames : int = None, max_length : int = None) -> str:
+    """
+    Format an exception, with its traceback and any exceptions it was raised from, the way python
+    prints it. Only the innermost max_frames frames of each traceback are kept, and if the text is
+    still longer than max_length characters, the start is cut off at a line boundary
+    """
+    import traceback
+    limit = -max_frames if max_frames else None
+    text = "".join(traceback.format_exception(type(exception), exception, exception.__traceback__, limit=limit)).rstrip('\n')
+    if max_length is not None and len(text) > max_length:
+        text = text[len(text) - max_length:]
+        text = "...\n" + text[text.find('\n') + 1:]
+    return text
+
+####################################################################################################
+def exception_fingerprint(exception : Exception) -> tuple:
+    """
+    Identify where an exception came from, by its type and the location of every frame of its
+    traceback, so that repeats of the same failure can be recognised without formatting them
+    """
+    import traceback
+    locations = tuple( (frame.f_code.co_filename, lineno, frame.f_code.co_name)
+                       for frame, lineno in traceback.walk_tb(exception.__traceback__) )
+    return (type(exception).__module__, type(exception).__qualname__, locations)
+
+####################################################################################################
+class MattermostRateLimiter:
+    """
+    Client-side token bucket limiting how fast messages are posted to one webhook URL, which also
+    backs off when the server says so: after a 429 it waits for Retry-After (or X-Ratelimit-Reset)
+    seconds, and when X-Ratelimit-Remaining reaches 0 it waits for X-Ratelimit-Reset seconds.
+
+    Limiters are shared by every interface posting to the same URL; get one with for_url().
+
+    rate  : sustained messages per second, or None to only follow the server's rate limit headers
+    burst : number of messages that can be sent back-to-back before the rate applies
+    """
+    _limiters = {}
+    _limiters_lock = threading.Lock()
+
+    def __init__(self, rate : float = None, burst : int = None):
+        self.configure(rate, burst)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        return
+
+    ####################################################################################################
+    @classmethod
+    def for_url(cls, url : str, rate : float = None, burst : int = None) -> 'MattermostRateLimiter':
+        """
+        Get the limiter shared by everything posting to url, reconfiguring it if a rate is given
+        """
+        with cls._limiters_lock:
+            limiter = cls._limiters.get(url)
+            if limiter is None:
+                limiter = cls(rate, burst)
+                cls._limiters[url] = limiter
+            elif rate is not None:
+                limiter.configure(rate, burst)
+        return limiter
+
+    ####################################################################################################
+    def configure(self, rate : float = None, burst : int = None) -> None:
+        if rate is not None and rate <= 0:
+            raise ValueError("Rate limit must be positive")
+        self.rate = rate
+        if burst is None:
+            burst = max(1, int(rate)) if rate is not None else 1
+        self.burst = max(1, burst)
+        return
+
+    ####################################################################################################
+    def reserve(self) -> float:
+        """
+        Take a token and return how many seconds the caller must wait before sending
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._blocked_until - now)
+            if self.rate is not None:
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self.rate)
+            return wait
+
+    def cancel(self) -> None:
+        """
+        Give back a token taken by reserve(), when the caller decided not to send after all
+        """
+        with self._lock:
+            if self.rate is not None:
+                self._tokens = min(self.burst, self._tokens + 1)
+        return
+
+    ####################################################################################################
+    def acquire(self) -> None:
+        """
+        Block until a message may be sent
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return
+
+    ####################################################################################################
+    def update(self, status_code : int, headers) -> float:
+        """
+        Adapt to the rate limit headers of a response. Returns how many seconds to wait before
+        retrying if the message was rejected for being over the limit (a 429), otherwise 0
+        """
+        reset = _parse_delay(headers.get('X-Ratelimit-Reset'))
+        delay = 0.0
+        if status_code == 429:
+            delay = _parse_delay(headers.get('Retry-After'))
+            if delay is None:
+                delay = reset if reset is not None else 1.0
+        elif headers.get('X-Ratelimit-Remaining') == '0' and reset is not None:
+            delay = reset
+
+        if delay > 0:
+            with self._lock:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+                self._tokens = min(self._tokens, 0.0)
+        return delay if status_code == 429 else 0.0
+
+####################################################################################################
+def _parse_delay(value : str) -> float:
+    """
+    Parse a header holding either a number of seconds or an HTTP date into seconds from now
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def _rate_limited_response(url : str, wait : float) -> 'requests.Response':
+    """
+    A 429 response standing in for a request which was not made, because the rate limiter would have
+    held it past the deadline of the retry policy
+    """
+    import requests
+    x = requests.Response()
+    x.status_code = 429
+    x.reason = 'Too Many Requests'
+    x.url = url
+    x.headers['Retry-After'] = f"{wait:.3f}"
+    x._content = b'Not sent: the rate limit would have held it past the deadline'
+    return x
+
+####################################################################################################
+class MattermostRetryPolicy:
+    """
+    Decides whether and when MattermostInterface resends a message that failed to post. Retries back
+    off exponentially (backoff, 2*backoff, 4*backoff, ... up to max_backoff seconds), with full
+    jitter unless jitter is false, and never wait less than a 429's Retry-After.
+
+    To avoid posting a message twice, failures where the request may already have reached the
+    server (a read timeout, or the connection dropping after the request was sent) are not retried
+    unless retry_ambiguous is true; only failures to connect and the listed status codes are.
+
+    max_attempts     : maximum number of times a message is sent, including the first
+    retry_statuses   : HTTP status codes which are retried
+    retry_exceptions : exception types which are retried (by default connection errors and timeouts)
+    deadline         : maximum seconds spent on one message, including all attempts and waits
+    """
+    def __init__(self, max_attempts : int = 3, backoff : float = 0.5, max_backoff : float = 10.0,
+                 jitter : bool = True, retry_statuses : Tuple[int, ...] = (429, 502, 503, 504),
+                 retry_exceptions : Tuple[type, ...] = None, deadline : float = None,
+                 retry_ambiguous : bool = False):
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = max(0.0, backoff)
+        self.max_backoff = max(0.0, max_backoff)
+        self.jitter = jitter
+        self.retry_statuses = tuple(retry_statuses)
+        if retry_exceptions is None:
+            import requests
+            retry_exceptions = (requests.ConnectionError, requests.Timeout)
+        self.retry_exceptions = tuple(retry_exceptions)
+        self.deadline = deadline
+        self.retry_ambiguous = retry_ambiguous
+        return
+
+    ####################################################################################################
+    def should_retry(self, attempt : int, status_code : int = None, error : Exception = None) -> bool:
+        """
+        Whether to resend after the given attempt (counting from 1) failed with a status code or an
+        exception
+        """
+        if attempt >= self.max_attempts:
+            return False
+        if error is not None:
+            if not isinstance(error, self.retry_exceptions):
+                return False
+            return self.retry_ambiguous or not _may_have_been_delivered(error)
+        return status_code in self.retry_statuses
+
+    ####################################################################################################
+    def get_backoff(self, attempt : int) -> float:
+        """
+        Seconds to wait before resending after the given attempt (counting from 1)
         """
-        self._make_dict()
-        return self.dict
+        delay = min(self.max_backoff, self.backoff * 2**(attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Without a policy, only resend once after waiting out a 429
+_DEFAULT_RETRY_POLICY = MattermostRetryPolicy(max_attempts=2, backoff=0, retry_statuses=(429,), retry_exceptions=())
+
+####################################################################################################
+def _may_have_been_delivered(error : Exception) -> bool:
+    """
+    Whether a request which failed with error may still have been received by the server
+    """
+    import requests
+    import urllib3
+    if isinstance(error, requests.ConnectTimeout):
+        return False
+    if isinstance(error, requests.ConnectionError) and error.args:
+        reason = getattr(error.args[0], 'reason', error.args[0])
+        return not isinstance(reason, (urllib3.exceptions.NewConnectionError, ConnectionRefusedError))
+    return True
+
+####################################################################################################
+class MattermostPostResult:
+    """
+    POD class holding the outcome of posting one message to one webhook. Evaluates as true if the
+    message was accepted, so it can be used wherever post() would return a bool
+    """
+    def __init__(self, url : str, status_code : int = None, elapsed : float = 0.0,
+                 error : Exception = None, message : Union[MattermostMessage, dict] = None,
+                 attempts : int = 0, response_text : str = '', retryable : bool = False):
+        self.url = url
+        self.status_code = status_code     # None if no response was received
+        self.elapsed = elapsed             # Seconds spent sending the message, including retries
+        self.error = error                 # Exception raised while sending, if any
+        self.message = message
+        self.attempts = attempts           # Number of requests made, including retries
+        self.response_text = response_text # What the server said when it rejected the message
+        self.retryable = retryable         # Whether posting the message again later might work
+        return
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.status_code == 200
+
+    def __bool__(self):
+        return self.ok
+
+    def __repr__(self):
+        return (f"MattermostPostResult(url={self.url!r}, status_code={self.status_code}, "
+                f"elapsed={self.elapsed:.4f}, attempts={self.attempts}, error={self.error!r})")
+
+# Longest server response kept on a MattermostPostResult
+_MAX_RESPONSE_TEXT = 1000
+
+####################################################################################################
+def _is_transient(status_code : int) -> bool:
+    """
+    Whether a message rejected with status_code might be accepted if it is sent again later: the
+    server timed out, was overloaded or was rate limiting us. Other client errors will fail again
+    """
+    return status_code in (408, 429) or (status_code is not None and status_code >= 500)
+
+####################################################################################################
+def _get_payload(message) -> dict:
+    """
+    Messages can be given either as a MattermostMessage or as an already built payload, such as one
+    rendered from a MattermostTemplate, or already encoded, such as one forwarded by a
+    MattermostSenderClient
+    """
+    if isinstance(message, dict):
+        return message
+    if isinstance(message, bytes):
+        import json
+        return json.loads(message)
+    return message.get_message_data()
+
+def _encode(message) -> bytes:
+    """
+    Get the JSON-encoded payload of a message, which is all that is kept once a message is queued
+    """
+    if isinstance(message, bytes):
+        return message
+    return serialise.encode_payload(_get_payload(message))
+
+def _encode_parts(message, max_bytes : int) -> Union[bytes, Tuple[bytes, ...]]:
+    """
+    Get the JSON-encoded payload of a message, or a tuple of payloads to be posted in order if it
+    is bigger than max_bytes (see split_payload). Most messages fit, and only pay for the length check
+    """
+    body = _encode(message)
+    if not max_bytes or len(body) <= max_bytes:
+        return body
+    return tuple( serialise.encode_payload(x) for x in split_payload(_get_payload(message), max_bytes) )
+
+# Finds the priority of an encoded payload without decoding the rest of it
+_PRIORITY_PATTERN = re.compile(rb'"priority"\s*:\s*\{\s*"priority"\s*:\s*"(\w+)"')
+_PRIORITIES = { str(x) : x for x in MattermostMessagePriority }
+
+def _get_priority(message) -> MattermostMessagePriority:
+    """
+    Get the priority of a message, whether it is a MattermostMessage, a payload or an encoded payload.
+    Anything which is not a known priority counts as standard
+    """
+    if isinstance(message, MattermostMessage):
+        name = message.priority
+        if isinstance(name, MattermostMessagePriority):
+            return name
+    elif isinstance(message, dict):
+        priority = message.get('priority')
+        name = priority.get('priority') if isinstance(priority, dict) else None
+    else:
+        match = _PRIORITY_PATTERN.search(message)
+        name = match.group(1).decode() if match is not None else None
+    return _PRIORITIES.get(name if isinstance(name, str) else None, MattermostMessagePriority.STANDARD)
+
+####################################################################################################
+# Webhooks which have already been resolved: validated URLs, and the URL read from each webhook file
+# along with the file's modification time and size, so the file is only read again if it changes
+_valid_urls = set()
+_webhook_files = {}
+_webhook_lock = threading.Lock()
+
+def _resolve_webhook(incomingwebhook : str) -> str:
+    """
+    Get the webhook URL from either a URL or the path to a file containing one
+    """
+    if incomingwebhook in _valid_urls:
+        return incomingwebhook
+
+    # Check if incomingwebhook is a URL or a file path
+    try:
+        stat = os.stat(incomingwebhook)
+    except (OSError, ValueError):
+        stat = None
+
+    if stat is not None:
+        # It's a file path, get the URL from the file unless we already have
+        path = os.path.abspath(incomingwebhook)
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = _webhook_files.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        import validators
+        url = None
+        with open(incomingwebhook, 'r') as file:
+            # Grab first URL it can
+            for line in file:
+                if validators.url(line.strip()):
+                    url = line.strip()
+                    break
+        if url is None:
+            raise ValueError(f"No valid URL found in {incomingwebhook}. Exiting...")
 
+        with _webhook_lock:
+            _webhook_files[path] = (version, url)
+        return url
+
+    import validators
+    if validators.url(incomingwebhook):
+        # It's a URL
+        with _webhook_lock:
+            _valid_urls.add(incomingwebhook)
+        return incomingwebhook
+
+    # No idea what has been passed as a webhook
+    raise ValueError("Must be a file path containing a valid URL or a URL itself. Exiting...")
+
+def _get_metrics_name(url : str) -> str:
+    """
+    A name for the webhook which can be shown in metrics: its host and a short hash of its URL
+    """
+    import hashlib
+    import urllib.parse
+    host = urllib.parse.urlsplit(url).hostname or 'webhook'
+    return f"{host}-{hashlib.sha256(url.encode()).hexdigest()[:8]}"
 
 ####################################################################################################
 class MattermostInterface:
@@ -503,56 +1283,597 @@ class MattermostInterface:
     See https://developers.mattermost.com/integrate/webhooks/incoming/ for details, but this just
     sends the request to mattermost, and, provided your webhook URL is valid, we can start posting
     messages!
+
+    Each interface owns a keep-alive connection pool (a requests.Session) which is created on the
+    first post and shared by every thread posting through the interface, so only the first message
+    pays for the TCP/TLS handshake. The pool is released by close(), or by using the interface as a
+    context manager:
+
+        with MattermostInterface('.mattermost_url.txt') as interface:
+            interface.post(message)
+
+    Code which creates interfaces over and over can instead use MattermostInterface.get_shared(),
+    which returns the same interface, and so the same connection pool, for every call with the same
+    webhook.
+
+    Messages can also be posted without blocking the caller using post_async(), which puts the
+    message on a bounded queue drained by a pool of background worker threads. The workers are
+    started on the first post_async() call, and the queue is flushed for at most exit_timeout
+    seconds when the interpreter exits.
+
+    pool_connections : number of distinct hosts to keep connection pools for
+    pool_maxsize     : maximum number of connections kept alive per host
+    max_retries      : number of connection-level retries performed by the pool
+    queue_size       : maximum number of messages waiting to be posted by the workers
+    workers          : number of background worker threads
+    queue_policy     : what post_async() does when the queue is full
+    exit_timeout     : how long to spend flushing the queue at interpreter exit
+    rate_limit       : maximum messages per second to this webhook (see MattermostRateLimiter)
+    rate_burst       : number of messages that can be sent back-to-back before rate_limit applies
+    retry_policy     : when to resend failed messages (see MattermostRetryPolicy). By default a
+                       message is only resent once after a 429
+    spool            : durable journal for messages which could not be posted (see MattermostSpool).
+                       They are replayed in the background when the interface is created and after
+                       each message which is posted successfully, and before posting a new message
+                       while any are waiting, which is spooled behind them if they still cannot be
+                       posted, so that messages are always posted in order
+    metrics          : collects delivery statistics and calls hooks around each request (see
+                       MattermostMetrics)
+    metrics_name     : name of the interface's queue in the metrics. By default the webhook's host
+                       followed by a short hash of its URL, as the rest of the URL is a secret
+    max_payload_bytes: messages which encode to more than this are split into several posts, sent
+                       one after another (see split_payload). None to never split
+    profile          : defaults for the messages made by create_message(), and for exceptions
+                       (see MattermostProfile). By default the default profile is used
+    priority_budgets : share of the messages posted by the workers each MattermostMessagePriority
+                       gets while messages of several priorities are queued, such as the default
+                       {URGENT: 8, IMPORTANT: 3, STANDARD: 1}. Each priority has its own queue, so
+                       an urgent message is posted within a few sends however long the backlog of
+                       standard ones is, while standard messages still get a share of the rate limit
+    priority_aging   : seconds after which a queued standard message is moved up to the important
+                       ones, or None to never move it
     """
-    def __init__(self, incomingwebhook : str, timeout : float = 2.5):
+    def __init__(self, incomingwebhook : str, timeout : float = 2.5, pool_connections : int = 1,
+                 pool_maxsize : int = 10, max_retries : int = 0, queue_size : int = 1000,
+                 workers : int = 1, queue_policy : MattermostQueuePolicy = MattermostQueuePolicy.BLOCK,
+                 exit_timeout : float = 5.0, rate_limit : float = None, rate_burst : int = None,
+                 retry_policy : MattermostRetryPolicy = None, spool = None, metrics = None,
+                 max_payload_bytes : int = DEFAULT_MAX_PAYLOAD_BYTES, profile : Union[MattermostProfile, str] = None,
+                 priority_budgets : dict = None, priority_aging : float = 30.0, metrics_name : str = None):
         # Store timeout
         if timeout > 0:
             self.timeout = timeout
         else:
             self.timeout = 2.5
 
+        # Store connection pool settings
+        self.pool_connections = max(1, pool_connections)
+        self.pool_maxsize = max(1, pool_maxsize)
+        self.max_retries = max(0, max_retries)
+        self._session = None
+        self._session_lock = threading.Lock()
 
-        # Check if incomingwebhook is a URL or a file path
-        if os.path.exists(incomingwebhook):
-            # It's a file path, open the file and get the URL
-            lines = []
-            with open(incomingwebhook, 'r') as file:
-                # Grab first URL it can
-                for line in file:
-                    if validators.url(line.strip()):
-                        self.url = line.strip()
-                        break
-        
-        elif validators.url(incomingwebhook):
-            # It's a URL
-            self.url = incomingwebhook
-        
+        # Store background delivery settings
+        self.workers = max(1, workers)
+        self.exit_timeout = exit_timeout
+        self._queue = _DeliveryQueue(max(1, queue_size), queue_policy, priority_budgets, priority_aging)
+        self._threads = []
+        self._threads_lock = threading.Lock()
+        self._closing = False
+        self._worker_state = threading.local() # Which queue the current thread is a worker of
+        self._atexit_registered = False
+
+        self.url = _resolve_webhook(incomingwebhook)
+        self.rate_limiter = MattermostRateLimiter.for_url(self.url, rate_limit, rate_burst)
+        self.retry_policy = retry_policy if retry_policy is not None else _DEFAULT_RETRY_POLICY
+        self.max_payload_bytes = max_payload_bytes
+        self.profile = MattermostProfile.get(profile) if isinstance(profile, str) else profile # None for the default
+
+        # Store metrics settings
+        self.metrics = metrics
+        self.metrics_name = metrics_name if metrics_name is not None else _get_metrics_name(self.url)
+        if metrics is not None:
+            self._queue.metrics = metrics
+            metrics.watch_queue(self.metrics_name, self.get_queue_depth)
+
+        # Store spool settings
+        self.spool = spool
+        self._replay_thread = None
+        if spool is not None and len(spool) > 0:
+            self.replay_spool(wait=False)
+
+        _interfaces.add(self)
+
+    ####################################################################################################
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    ####################################################################################################
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def get_shared(cls, incomingwebhook : str, **kwargs) -> 'MattermostInterface':
+        """
+        Get the interface shared by everything posting to this webhook (a URL or the path to a file
+        containing one), creating it with the given keyword arguments if there is none yet. The
+        keyword arguments are ignored if the interface already exists
+        """
+        url = _resolve_webhook(incomingwebhook)
+        interface = cls._shared.get(url)
+        if interface is None:
+            with cls._shared_lock:
+                interface = cls._shared.get(url)
+                if interface is None:
+                    interface = cls(url, **kwargs)
+                    cls._shared[url] = interface
+        return interface
+
+    @classmethod
+    def close_shared(cls, timeout : float = None) -> None:
+        """
+        Close and forget all the shared interfaces
+        """
+        with cls._shared_lock:
+            interfaces = list(cls._shared.values())
+            cls._shared.clear()
+        for interface in interfaces:
+            interface.close(timeout)
+        return
+
+    ####################################################################################################
+    def _get_session(self) -> 'requests.Session':
+        """
+        Get the pooled session, creating it on first use
+        """
+        session = self._session
+        if session is None:
+            # Workers which outlived close() must not open a new pool nobody will close
+            queue = getattr(self._worker_state, 'queue', None)
+            if queue is not None and queue._closed:
+                raise RuntimeError("MattermostInterface has been closed")
+            with self._session_lock:
+                session = self._session
+                if session is None:
+                    import requests
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=self.pool_connections,
+                        pool_maxsize=self.pool_maxsize,
+                        max_retries=self.max_retries
+                    )
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return session
+
+    ####################################################################################################
+    def _reset_after_fork(self) -> None:
+        """
+        Called in the child after a fork. The child must not share the parent's connections, and
+        has none of its worker threads, so start afresh, leaving the queued messages to the parent
+        """
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._threads = []
+        self._threads_lock = threading.Lock()
+        self._closing = False
+        self._worker_state = threading.local()
+        self._replay_thread = None
+        self._queue = self._queue.renew()
+        return
+
+    ####################################################################################################
+    def close(self, timeout : float = None) -> None:
+        """
+        Flush any queued messages, stop the worker threads and close the pooled connections, taking
+        at most timeout seconds in all before giving up on the queued messages. The interface can
+        still be used for post() afterwards, in which case a new pool is created
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        # No workers are started while closing, so nothing can be queued behind the flush
+        with self._threads_lock:
+            self._closing = True
+            threads = self._threads
+        try:
+            if threads:
+                self.flush(timeout)
+                self._queue.close()
+                for thread in threads:
+                    thread.join(max(0.0, deadline - time.monotonic()) if deadline is not None else None)
+                dropped = self._queue.discard()
+                if dropped:
+                    print(f"WARNING - gave up on {dropped} queued Mattermost messages when closing")
+        finally:
+            with self._threads_lock:
+                self._threads = []
+                self._closing = False
+
+        with self._session_lock:
+            session = self._session
+            self._session = None
+        if session is not None:
+            session.close()
+        return
+
+    ####################################################################################################
+    def _send(self, body : bytes, url : str = None, result : MattermostPostResult = None) -> 'requests.Response':
+        """
+        Send an encoded message payload to the webhook (or to url instead, if given), resending it as
+        allowed by the retry policy. Returns the last response, or raises the last exception if no response
+        was received. The number of requests made is recorded in result, if given
+        """
+        if url is None:
+            url = self.url
+            limiter = self.rate_limiter
         else:
-            # No idea what has been passed as a webhook
-            raise ValueError("Must be a file path containing a valid URL or a URL itself. Exiting...")
+            limiter = MattermostRateLimiter.for_url(url)
+
+        policy = self.retry_policy
+        metrics = self.metrics
+        deadline = None
+        if policy.deadline is not None:
+            deadline = time.monotonic() + policy.deadline
+
+        attempt = 0
+        x, error = None, None
+        while True:
+            # Give up rather than wait for the rate limiter past the deadline
+            wait = limiter.reserve()
+            if deadline is not None and time.monotonic() + wait >= deadline:
+                limiter.cancel()
+                if x is None and error is None:
+                    x = _rate_limited_response(url, wait)
+                break
+            if wait > 0:
+                time.sleep(wait)
+
+            attempt += 1
+            if result is not None:
+                result.attempts += 1
+
+            # Don't let the request overrun the deadline
+            timeout = self.timeout
+            if deadline is not None:
+                timeout = max(0.001, min(timeout, deadline - time.monotonic()))
+
+            if metrics is not None:
+                metrics.call_hooks('before_send', url, body)
+                start = time.perf_counter()
+
+            x, error, retry_after = None, None, 0.0
+            try:
+                x = self._get_session().post(url, data=body, headers=_JSON_HEADERS, timeout=timeout)
+                retry_after = limiter.update(x.status_code, x.headers)
+            except Exception as e:
+                error = e
+
+            if metrics is not None:
+                metrics.observe_request(url, len(body), x.status_code if x is not None else None,
+                                        time.perf_counter() - start, error)
+
+            if not policy.should_retry(attempt, x.status_code if x is not None else None, error):
+                break
+
+            # The rate limiter will make us wait for any Retry-After
+            delay = policy.get_backoff(attempt)
+            if deadline is not None and time.monotonic() + max(delay, retry_after) >= deadline:
+                break
+            if metrics is not None:
+                metrics.increment('retried')
+            time.sleep(delay)
+
+        if metrics is not None:
+            metrics.increment('sent' if error is None and x.status_code == 200 else 'failed')
+
+        if error is not None:
+            raise error
+        return x
+
+    ####################################################################################################
+    def post( self, message : Union[MattermostMessage, dict],
+              return_result : bool = False ) -> Union[bool, MattermostPostResult]:
+        """
+        Post the message, and return true or false if it worked! If the interface has a spool, a
+        message which could not be posted is spooled rather than raising an exception.
+
+        With return_result true, a MattermostPostResult saying what happened is returned instead,
+        and no exception is raised for a failed post.
+
+        A message too big to post in one go is split into several, which are posted in order,
+        stopping at the first which fails
+        """
+        body = _encode_parts(message, self.max_payload_bytes)
+        if return_result:
+            return self._post_result(message, body, self.url, spool=True)
+        return self._deliver(body)
+
+    ####################################################################################################
+    def _deliver( self, body : Union[bytes, Tuple[bytes, ...]] ) -> bool:
+        """
+        Send an encoded message payload, or each of the parts of a split message in turn, to the
+        webhook. Returns false as soon as one fails
+        """
+        if isinstance(body, tuple):
+            for i, part in enumerate(body):
+                if not self._deliver_part(part, body[i+1:]):
+                    return False
+            return True
+        return self._deliver_part(body)
 
     ####################################################################################################
-    def post( self, message : MattermostMessage ) -> bool:
+    def _deliver_part( self, body : bytes, rest : Tuple[bytes, ...] = () ) -> bool:
         """
-        Post the message, and return true or false if it worked!
+        Send one encoded payload to the webhook, spooling it, followed by the rest of the parts of its
+        message, if that fails, and replaying the spool if it succeeds
         """
-        # Get the message
-        data = message.get_message_data()
+        if self.spool is None:
+            return self._send(body).status_code == 200
 
-        # Send the data
-        x = requests.post(self.url, json=data, timeout=self.timeout)
+        # Queue behind the messages already spooled rather than overtaking them
+        if not self._spool_is_clear():
+            return self._spool_outcome(body, None, rest)
 
-        # Check if the message sent
-        if x.status_code == 200:
+        try:
+            status_code = self._send(body).status_code
+        except Exception:
+            status_code = None
+        return self._spool_outcome(body, status_code, rest)
+
+    ####################################################################################################
+    def _spool_outcome( self, body : bytes, status_code : int, rest : Tuple[bytes, ...] = () ) -> bool:
+        """
+        Replay the spool once a payload has been posted, or spool a payload which could not be,
+        followed by the rest of the parts of its message so they stay in order. A status_code of
+        None means no response was received. Returns true if the payload was posted
+        """
+        if status_code == 200:
+            if self.spool is not None and len(self.spool) > 0:
+                self.replay_spool(wait=False)
             return True
+
+        # Client errors other than being rate limited will fail again, so don't spool them
+        if self.spool is not None and (status_code is None or _is_transient(status_code)):
+            self.spool.append(body)
+            for part in rest:
+                self.spool.append(part)
         return False
+
+    def _spool_is_clear(self) -> bool:
+        """
+        Replay the spool if it holds any messages, so that a new message is not posted ahead of them.
+        Returns false if some are still waiting, in which case the new message must be spooled too
+        """
+        if len(self.spool) == 0:
+            return True
+        self.replay_spool()
+        return len(self.spool) == 0
+
+    ####################################################################################################
+    def replay_spool( self, wait : bool = True ) -> int:
+        """
+        Post the messages waiting in the spool, oldest first, stopping at the first one which still
+        cannot be posted. With wait false, this is done in a background thread (unless one is
+        already running) and 0 is returned. Otherwise returns the number of messages posted
+        """
+        if self.spool is None:
+            return 0
+        if not wait:
+            with self._threads_lock:
+                if self._replay_thread is None or not self._replay_thread.is_alive():
+                    self._replay_thread = threading.Thread(target=self.replay_spool, name='mattermost-spool', daemon=True)
+                    self._replay_thread.start()
+            return 0
+
+        def send(body):
+            try:
+                status_code = self._send(body).status_code
+            except Exception:
+                return False
+
+            # Drop messages the server will never accept rather than blocking the spool
+            return status_code == 200 or (400 <= status_code < 500 and not _is_transient(status_code))
+
+        return self.spool.replay(send)
+
+    ####################################################################################################
+    def post_many( self, messages : List[Union[MattermostMessage, dict]], webhooks : List[str] = None,
+                   max_workers : int = None ) -> List[MattermostPostResult]:
+        """
+        Post every message to every webhook (URLs or paths to files containing one; by default just
+        this interface's webhook), sending up to max_workers requests at the same time over the
+        pooled connections. max_workers defaults to pool_maxsize, and should not be larger, as extra
+        connections are not kept alive.
+
+        Never raises for a failed post: returns one MattermostPostResult per message and webhook,
+        ordered by message and then by webhook
+        """
+        if webhooks is None:
+            urls = [self.url]
+        else:
+            urls = [ _resolve_webhook(x) for x in webhooks ]
+        if max_workers is None:
+            max_workers = self.pool_maxsize
+
+        jobs = []
+        for message in messages:
+            body = _encode_parts(message, self.max_payload_bytes)
+            jobs.extend([ (message, body, url) for url in urls ])
+
+        if not jobs:
+            return []
+
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(jobs)))) as executor:
+            return list(executor.map(lambda job: self._post_result(*job), jobs))
+
+    ####################################################################################################
+    def _post_result( self, message : Union[MattermostMessage, dict], body : Union[bytes, Tuple[bytes, ...]],
+                      url : str, spool : bool = False ) -> MattermostPostResult:
+        """
+        Send a message payload, or each of the parts of a split message until one fails, and package
+        up what happened. With spool true, the spool is used as _deliver() would
+        """
+        import requests
+        parts = body if isinstance(body, tuple) else (body,)
+        result = MattermostPostResult(url, message=message)
+        start = time.perf_counter()
+        for i, part in enumerate(parts):
+            if spool and self.spool is not None and not self._spool_is_clear():
+                self._spool_outcome(part, None, parts[i+1:])
+                result.retryable = True
+                break
+            try:
+                x = self._send(part, url, result)
+                result.status_code = x.status_code
+                if x.status_code != 200:
+                    result.response_text = x.text[:_MAX_RESPONSE_TEXT]
+                result.retryable = _is_transient(x.status_code)
+            except Exception as e:
+                result.status_code = None
+                result.error = e
+                result.retryable = isinstance(e, (requests.ConnectionError, requests.Timeout))
+            if spool:
+                self._spool_outcome(part, result.status_code, parts[i+1:])
+            if not result.ok:
+                break
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    ####################################################################################################
+    def post_async( self, message : Union[MattermostMessage, dict], timeout : float = None,
+                    priority : MattermostMessagePriority = None ) -> bool:
+        """
+        Queue the message to be posted by a background worker and return straight away. The message
+        is copied when it is queued, so it can be modified afterwards. Returns false if the message
+        was dropped because the queue was full (or, with the BLOCK policy, stayed full for timeout
+        seconds) or the interface has been closed.
+
+        Messages are queued by their priority, or by the given priority instead (see
+        priority_budgets)
+        """
+        if priority is None:
+            priority = _get_priority(message)
+        if not self._start_workers():
+            return False
+        return self._queue.put(_encode_parts(message, self.max_payload_bytes), timeout, priority.value)
+
+    enqueue = post_async
+
+    ####################################################################################################
+    def flush( self, timeout : float = None ) -> bool:
+        """
+        Wait until every queued message has been posted. Returns false if the queue did not drain
+        within timeout seconds
+        """
+        return self._queue.join(timeout)
+
+    ####################################################################################################
+    def get_queue_depth(self) -> int:
+        return len(self._queue)
+
+    def get_queue_depths(self) -> dict:
+        """
+        Number of messages queued at each MattermostMessagePriority
+        """
+        return self._queue.get_depths()
+
+    def get_dropped_count(self) -> int:
+        return self._queue.dropped
+
+    ####################################################################################################
+    def _start_workers(self) -> bool:
+        """
+        Start the background worker threads if they are not already running. Returns false if the
+        interface is being closed
+        """
+        if self._threads:
+            return True
+        with self._threads_lock:
+            if self._threads:
+                return True
+            if self._closing:
+                return False
+            if self._queue._closed:
+                self._queue = self._queue.renew()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"mattermost-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            if not self._atexit_registered:
+                atexit.register(_flush_at_exit, weakref.ref(self))
+                self._atexit_registered = True
+        return True
+
+    ####################################################################################################
+    def _worker(self) -> None:
+        """
+        Body of the background worker threads: post queued payloads until the queue is closed
+        """
+        queue = self._queue
+        self._worker_state.queue = queue
+        while True:
+            body = queue.get()
+            if body is None:
+                return
+            try:
+                if not self._deliver(body):
+                    print(f"WARNING - failed to post queued message to Mattermost")
+            except Exception as e:
+                print(f"WARNING - failed to post queued message to Mattermost: {e}")
+            finally:
+                queue.task_done()
     
     ####################################################################################################
-    def post_message_from_exception( self, e : Exception ) -> None:
+    def post_message_from_exception( self, e : Exception, max_frames : int = None, max_length : int = None ) -> None:
         """
         Posts a message from an exception without having to call MattermostMessage
         """
-        self.post( MattermostMessage.create_message_from_exception(e) )
+        self.post( MattermostMessage.create_message_from_exception(e, max_frames, max_length, self.profile) )
 
+    ####################################################################################################
+    def create_message( self, **kwargs ) -> MattermostMessage:
+        """
+        Make a MattermostMessage with the interface's profile, unless another profile is given
+        """
+        if kwargs.get('profile') is None:
+            kwargs['profile'] = self.profile
+        return MattermostMessage(**kwargs)
 
+####################################################################################################
+def _flush_at_exit(ref : weakref.ref) -> None:
+    """
+    atexit hook which drains the queue of an interface that is still alive
+    """
+    interface = ref()
+    if interface is not None:
+        interface.close(interface.exit_timeout)
+    return
+
+####################################################################################################
+# Every interface, so that they can be made safe to use in the child after a fork
+_interfaces = weakref.WeakSet()
+
+def _after_fork_in_child() -> None:
+    """
+    Reset everything a forked child inherits which is only valid in the parent: pooled connections,
+    worker threads, and locks which may have been held by another of the parent's threads
+    """
+    global _webhook_lock
+    _webhook_lock = threading.Lock()
+    MattermostRateLimiter._limiters_lock = threading.Lock()
+    for limiter in MattermostRateLimiter._limiters.values():
+        limiter._lock = threading.Lock()
+    MattermostInterface._shared_lock = threading.Lock()
+    MattermostMessage._default_profile_lock = threading.Lock()
+    MattermostProfile._profiles_lock = threading.Lock()
+    for interface in list(_interfaces):
+        interface._reset_after_fork()
+    return
 
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
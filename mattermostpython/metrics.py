@@ -0,0 +1,184 @@
+import bisect
+import os
+import threading
+import types
+import weakref
+from typing import Callable, Dict
+
+####################################################################################################
+class MattermostMetrics:
+    """
+    Collects delivery statistics from the interfaces it is given to, and calls hooks around each
+    request. Interfaces without metrics skip all of this, so it costs nothing unless it is used:
+
+        metrics = MattermostMetrics()
+        interface = MattermostInterface('.mattermost_url.txt', metrics=metrics)
+        metrics.add_hook('on_error', lambda url, error: print(error))
+        ...
+        print(metrics.to_prometheus())
+
+    Counters:
+        sent      : messages posted successfully
+        failed    : messages which could not be posted, after any retries
+        retried   : requests which were resent
+        dropped   : messages discarded because a delivery queue was full
+        coalesced : messages merged into a digest by a MattermostCoalescer, or repeated exceptions
+                    only counted by a MattermostExceptionReporter
+        requests  : HTTP requests made, including retries
+        bytes_sent: bytes of payload sent, including retries
+
+    Every request's latency goes into a histogram with the given bucket upper bounds, in seconds,
+    and the depth of the delivery queue of each interface is reported as a gauge.
+
+    Hooks are called in the thread making the request:
+        before_send(url, body)              : before each request
+        after_send(url, status_code, elapsed): after each request which got a response
+        on_error(url, error)                : after each request which raised an exception
+    Exceptions raised by hooks are ignored
+    """
+    COUNTERS = ('sent', 'failed', 'retried', 'dropped', 'coalesced', 'requests', 'bytes_sent')
+    HOOKS = ('before_send', 'after_send', 'on_error')
+    _default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets : tuple = None):
+        self.buckets = tuple(sorted(buckets)) if buckets is not None else self._default_buckets
+        self._counters = dict.fromkeys(self.COUNTERS, 0)
+        self._bucket_counts = [0] * (len(self.buckets) + 1)
+        self._latency_sum = 0.0
+        self._hooks = { x : [] for x in self.HOOKS }
+        self._queues = []
+        self._lock = threading.Lock()
+        _metrics.add(self)
+        return
+
+    ####################################################################################################
+    def add_hook(self, event : str, callback : Callable) -> None:
+        if event not in self._hooks:
+            raise ValueError(f"Unknown hook {event}, choose from {', '.join(self.HOOKS)}")
+        self._hooks[event].append(callback)
+        return
+
+    def remove_hook(self, event : str, callback : Callable) -> None:
+        self._hooks[event].remove(callback)
+        return
+
+    def call_hooks(self, event : str, *args) -> None:
+        for callback in self._hooks[event]:
+            try:
+                callback(*args)
+            except Exception:
+                pass
+        return
+
+    ####################################################################################################
+    def increment(self, name : str, n : int = 1) -> None:
+        with self._lock:
+            self._counters[name] += n
+        return
+
+    ####################################################################################################
+    def observe_request(self, url : str, nbytes : int, status_code : int, elapsed : float, error : Exception) -> None:
+        """
+        Record one HTTP request and call the after_send or on_error hooks
+        """
+        with self._lock:
+            self._counters['requests'] += 1
+            self._counters['bytes_sent'] += nbytes
+            self._bucket_counts[bisect.bisect_left(self.buckets, elapsed)] += 1
+            self._latency_sum += elapsed
+        if error is None:
+            self.call_hooks('after_send', url, status_code, elapsed)
+        else:
+            self.call_hooks('on_error', url, error)
+        return
+
+    ####################################################################################################
+    def watch_queue(self, name : str, depth : Callable[[], int]) -> None:
+        """
+        Report depth() as the depth of the queue called name. A bound method is only held weakly, so
+        that watching an interface's queue does not keep the interface alive, and the queue is no
+        longer reported once its interface is gone
+        """
+        if isinstance(depth, types.MethodType):
+            ref = weakref.WeakMethod(depth)
+        else:
+            ref = lambda: depth
+        with self._lock:
+            self._queues.append( (name, ref) )
+        return
+
+    ####################################################################################################
+    def get_counters(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+    def get_queue_depths(self) -> Dict[str, int]:
+        with self._lock:
+            queues = list(self._queues)
+        depths = {}
+        gone = False
+        for name, ref in queues:
+            depth = ref()
+            if depth is None:
+                gone = True
+            else:
+                depths[name] = depth()
+        if gone:
+            with self._lock:
+                self._queues = [ x for x in self._queues if x[1]() is not None ]
+        return depths
+
+    def get_latency_histogram(self) -> Dict[float, int]:
+        """
+        Cumulative number of requests which took at most each bucket's upper bound in seconds
+        """
+        with self._lock:
+            counts = list(self._bucket_counts)
+        histogram = {}
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            histogram[bound] = total
+        return histogram
+
+    ####################################################################################################
+    def to_prometheus(self, prefix : str = 'mattermost') -> str:
+        """
+        The metrics in the Prometheus text exposition format
+        """
+        counters = self.get_counters()
+        lines = []
+        for name in self.COUNTERS:
+            metric = f"{prefix}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {counters[name]}")
+
+        metric = f"{prefix}_request_duration_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        histogram = self.get_latency_histogram()
+        for bound, count in histogram.items():
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{metric}_bucket{{le="{le}"}} {count}')
+        with self._lock:
+            latency_sum = self._latency_sum
+        lines.append(f"{metric}_sum {latency_sum}")
+        lines.append(f"{metric}_count {histogram[float('inf')]}")
+
+        metric = f"{prefix}_queue_depth"
+        lines.append(f"# TYPE {metric} gauge")
+        for name, depth in self.get_queue_depths().items():
+            lines.append(f'{metric}{{queue="{name}"}} {depth}')
+        return "\n".join(lines) + "\n"
+
+####################################################################################################
+# Every MattermostMetrics, so that their locks can be replaced in the child after a fork, in case
+# another of the parent's threads held one
+_metrics = weakref.WeakSet()
+
+def _after_fork_in_child() -> None:
+    for metrics in list(_metrics):
+        metrics._lock = threading.Lock()
+    return
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
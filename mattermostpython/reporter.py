@@ -0,0 +1,233 @@
+import atexit
+import collections
+import sys
+import threading
+import time
+
+from .mattermostpython import MattermostField, MattermostInterface, MattermostMessage, exception_fingerprint
+
+####################################################################################################
+class _Entry:
+    """
+    POD class for what has been seen of one exception fingerprint
+    """
+    __slots__ = ('title', 'posted', 'suppressed')
+
+    def __init__(self, title : str, posted : float):
+        self.title = title
+        self.posted = posted  # When it was last posted
+        self.suppressed = 0   # Repeats held back since then
+        return
+
+####################################################################################################
+class MattermostExceptionReporter:
+    """
+    Posts exceptions to Mattermost without flooding the channel when the same failure happens over
+    and over, as in a crash loop. Exceptions are recognised by their type and the locations of the
+    frames of their traceback (see exception_fingerprint), which is much cheaper than formatting
+    them. The first occurrence is posted, and repeats within window seconds of it are only counted;
+    the count is added to the next report posted for it once the window has passed, or posted by
+    flush():
+
+        reporter = MattermostExceptionReporter(interface, window=300)
+        try:
+            ...
+        except Exception as e:
+            reporter.report(e)
+
+    The last max_entries fingerprints seen are remembered, least recently seen are forgotten first.
+    Tracebacks are cut down to max_frames frames and max_length characters (see format_exception).
+
+    use_queue : post through the interface's background queue rather than blocking
+    """
+    def __init__(self, interface : MattermostInterface, window : float = 60.0, max_entries : int = 256,
+                 max_frames : int = 20, max_length : int = 4000, use_queue : bool = True):
+        self.interface = interface
+        self.window = window
+        self.max_entries = max(1, max_entries)
+        self.max_frames = max_frames
+        self.max_length = max_length
+        self.use_queue = use_queue
+        self.suppressed = 0 # Number of repeats which were counted rather than posted
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        return
+
+    ####################################################################################################
+    def report(self, exception : Exception, title : str = None, timeout : float = None) -> bool:
+        """
+        Post the exception, titled with title instead of its type if given, unless the same failure
+        was posted within the window. Returns true if it was posted (or queued), false if it was only
+        counted, or could not be posted (or queued) within timeout seconds
+        """
+        key = exception_fingerprint(exception)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if now - entry.posted < self.window:
+                    entry.suppressed += 1
+                    self.suppressed += 1
+                    if self.interface.metrics is not None:
+                        self.interface.metrics.increment('coalesced')
+                    return False
+                repeats = entry.suppressed
+                entry.posted = now
+                entry.suppressed = 0
+            else:
+                repeats = 0
+                self._entries[key] = _Entry(type(exception).__name__, now)
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        message = MattermostMessage.create_message_from_exception(exception, self.max_frames, self.max_length,
+                                                                  getattr(self.interface, 'profile', None))
+        if title is not None:
+            message.set_title(title)
+            message.set_notification_message(title)
+        if repeats > 0:
+            message.add_field( MattermostField(True, 'Repeats', f"{repeats} more times since the last report") )
+        return self._send(message, timeout)
+
+    ####################################################################################################
+    def flush(self, timeout : float = None) -> int:
+        """
+        Post how many times each exception has been repeated since it was last posted, giving up on
+        the rest once timeout seconds have passed. Returns the number of messages posted
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            pending = [ entry for entry in self._entries.values() if entry.suppressed > 0 ]
+            counts = [ (entry.title, entry.suppressed) for entry in pending ]
+            for entry in pending:
+                entry.suppressed = 0
+
+        posted = 0
+        for title, count in counts:
+            remaining = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+            if remaining == 0.0:
+                break
+            message = MattermostMessage(title=f"{title} (repeated {count} more times)",
+                                        text=f"{title} was raised {count} more times since it was last reported",
+                                        profile=getattr(self.interface, 'profile', None))
+            posted += self._send(message, remaining)
+        return posted
+
+    ####################################################################################################
+    def _send(self, message : MattermostMessage, timeout : float = None) -> bool:
+        """
+        Post or queue the message, waiting at most timeout seconds for space in the queue, or for the
+        message to be posted
+        """
+        if self.use_queue:
+            return self.interface.post_async(message, timeout)
+        if timeout is None:
+            return self.interface.post(message)
+
+        # Post from another thread, so that a slow server cannot hold up this one for longer
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self.interface.post(message)),
+                                  name='mattermost-report', daemon=True)
+        thread.start()
+        thread.join(timeout)
+        return bool(result and result[0])
+
+####################################################################################################
+# The hooks replaced by the installed crash reporter, and its atexit hook
+_previous_hooks = None
+
+def install_crash_reporter(interface : MattermostInterface, exit_timeout : float = 5.0,
+                           **kwargs) -> MattermostExceptionReporter:
+    """
+    Report every unhandled exception, in the main thread (through sys.excepthook) or in any other
+    thread (through threading.excepthook), to Mattermost. The exceptions are still printed by the
+    hooks which were installed before. Reports are queued so that the crashing thread is not held
+    up (for more than exit_timeout seconds, should the queue be full), and at interpreter exit the
+    queue is flushed for at most exit_timeout seconds in all, so a Mattermost server which cannot
+    be reached cannot stop the process from exiting.
+
+        install_crash_reporter( MattermostInterface('.mattermost_url.txt') )
+
+    The other keyword arguments are passed to MattermostExceptionReporter, so that a crash loop
+    does not flood the channel. KeyboardInterrupt and SystemExit are not reported. Returns the
+    reporter
+    """
+    global _previous_hooks
+    uninstall_crash_reporter()
+
+    kwargs.setdefault('use_queue', True)
+    reporter = MattermostExceptionReporter(interface, **kwargs)
+    previous_excepthook = sys.excepthook
+    previous_threading_excepthook = getattr(threading, 'excepthook', None) # Only from python 3.8
+
+    def excepthook(exc_type, exc_value, exc_traceback):
+        previous_excepthook(exc_type, exc_value, exc_traceback)
+        if not issubclass(exc_type, KeyboardInterrupt):
+            _report_crash(reporter, exc_value, f"Unhandled {exc_type.__name__}", exit_timeout)
+        return
+
+    def threading_excepthook(args):
+        previous_threading_excepthook(args)
+        if issubclass(args.exc_type, SystemExit):
+            return
+        thread = args.thread.name if args.thread is not None else 'unknown thread'
+        _report_crash(reporter, args.exc_value, f"Unhandled {args.exc_type.__name__} in {thread}", exit_timeout)
+        return
+
+    def flush_at_exit():
+        _flush_crash_reports(reporter, exit_timeout)
+        return
+
+    # Start the interface's workers now, so that their own atexit flush is registered first and so
+    # runs after ours, finding nothing left to do
+    if reporter.use_queue:
+        interface._start_workers()
+
+    sys.excepthook = excepthook
+    if previous_threading_excepthook is not None:
+        threading.excepthook = threading_excepthook
+    atexit.register(flush_at_exit)
+
+    _previous_hooks = (previous_excepthook, previous_threading_excepthook, flush_at_exit)
+    return reporter
+
+def uninstall_crash_reporter() -> None:
+    """
+    Put back the hooks which install_crash_reporter() replaced
+    """
+    global _previous_hooks
+    if _previous_hooks is None:
+        return
+    previous_excepthook, previous_threading_excepthook, flush_at_exit = _previous_hooks
+    sys.excepthook = previous_excepthook
+    if previous_threading_excepthook is not None:
+        threading.excepthook = previous_threading_excepthook
+    atexit.unregister(flush_at_exit)
+    _previous_hooks = None
+    return
+
+def _report_crash(reporter : MattermostExceptionReporter, exception : BaseException, title : str,
+                  timeout : float) -> None:
+    """
+    Report an unhandled exception, never letting a failure to report it escape the hook
+    """
+    if exception is None:
+        return
+    try:
+        reporter.report(exception, title, timeout)
+    except Exception as e:
+        print(f"WARNING - failed to report crash to Mattermost: {e}", file=sys.stderr)
+    return
+
+def _flush_crash_reports(reporter : MattermostExceptionReporter, timeout : float) -> None:
+    """
+    Post any pending repeat counts and flush the queue, giving up after timeout seconds in all
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        reporter.flush(timeout)
+        reporter.interface.close(max(0.0, deadline - time.monotonic()))
+    except Exception as e:
+        print(f"WARNING - failed to flush crash reports to Mattermost: {e}", file=sys.stderr)
+    return
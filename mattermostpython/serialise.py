@@ -0,0 +1,78 @@
+# The encoders are only looked for when the first payload is encoded, as importing them takes a while
+_BACKENDS = None
+_backend = None
+_encode = None
+
+####################################################################################################
+# Each of these imports an encoder and returns a function encoding a payload with it
+def _load_orjson():
+    import orjson
+    return orjson.dumps
+
+def _load_ujson():
+    import ujson
+    return lambda data: ujson.dumps(data, ensure_ascii=False).encode()
+
+def _load_json():
+    import json
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    return lambda data: encoder.encode(data).encode()
+
+####################################################################################################
+def _find_backends() -> dict:
+    """
+    Find the available encoders, fastest first, and choose the fastest unless one has been chosen
+    """
+    global _BACKENDS, _backend, _encode
+    if _BACKENDS is None:
+        import importlib.util
+        backends = {}
+        if importlib.util.find_spec('orjson') is not None:
+            backends['orjson'] = _load_orjson
+        if importlib.util.find_spec('ujson') is not None:
+            backends['ujson'] = _load_ujson
+        backends['json'] = _load_json
+        _BACKENDS = backends
+        if _backend is None:
+            _backend = next(iter(backends))
+            _encode = backends[_backend]()
+    return _BACKENDS
+
+####################################################################################################
+def get_json_backends() -> list:
+    """
+    Names of the JSON encoders which are available, fastest first
+    """
+    return list(_find_backends())
+
+def get_json_backend() -> str:
+    """
+    Name of the JSON encoder used for message payloads
+    """
+    _find_backends()
+    return _backend
+
+def set_json_backend(name : str) -> None:
+    """
+    Choose the JSON encoder used for message payloads: 'orjson' or 'ujson' if they are installed, or
+    'json' from the standard library. By default the fastest available one is used
+    """
+    global _backend, _encode
+    backends = _find_backends()
+    if name not in backends:
+        raise ValueError(f"JSON backend {name} is not available, choose from {', '.join(backends)}")
+    _encode = backends[name]()
+    _backend = name
+    return
+
+####################################################################################################
+def encode_payload(data) -> bytes:
+    """
+    Encode a message payload as UTF-8 JSON, ready to be posted. Already encoded payloads are returned
+    as they are, so a payload is only ever encoded once however many times it is sent
+    """
+    if isinstance(data, bytes):
+        return data
+    if _encode is None:
+        _find_backends()
+    return _encode(data)
@@ -0,0 +1,179 @@
+from typing import List
+
+from .serialise import encode_payload
+
+# Mattermost rejects posts of more than 16383 characters, so by default stay a little below that
+DEFAULT_MAX_PAYLOAD_BYTES = 16000
+
+# Attachment keys which only go on the last part of a split message
+_FOOTER_KEYS = ('footer', 'footer_icon')
+
+_CONTINUED = ' (continued)'
+_MAX_FALLBACK = 200
+_FENCE = '```'
+
+####################################################################################################
+def split_payload(data : dict, max_bytes : int = DEFAULT_MAX_PAYLOAD_BYTES) -> List[dict]:
+    """
+    Split a message payload which encodes to more than max_bytes into several payloads which each
+    fit, to be posted one after another. Payloads which already fit are returned as they are.
+
+    The text is split at line boundaries (a single line which is too long is cut wherever it has
+    to be), and a code block cut in two is closed at the end of one part and reopened at the start
+    of the next. Fields follow the text, spread over as many attachments as needed, with several
+    attachments to a post where they fit. The first part keeps the priority and everything above
+    the text, the last part keeps the footer, and the other parts are titled as continuations
+    """
+    if len(encode_payload(data)) <= max_bytes:
+        return [data]
+
+    # A plain post without attachments only has text to split
+    if not data.get('attachments'):
+        budget = max(64, max_bytes - _size(dict(data, text='')))
+        return [ dict(data, text=chunk) for chunk in _split_text(data.get('text', ''), budget) ]
+
+    attachment = data['attachments'][0]
+
+    # The notification defaults to the text, which can be what made the message too big
+    fallback = attachment.get('fallback', '')
+    if len(fallback) > _MAX_FALLBACK:
+        attachment = dict(attachment, fallback=fallback[:_MAX_FALLBACK - 3] + '...')
+
+    title = attachment.get('title', '')
+    head = { k : v for k, v in attachment.items() if k not in ('text', 'fields') and k not in _FOOTER_KEYS }
+    tail = { k : attachment[k] for k in _FOOTER_KEYS if k in attachment }
+    common = { k : attachment[k] for k in ('fallback', 'color') if k in attachment }
+    follow = dict(common, title=title + _CONTINUED) if title else common
+
+    # Only the first part should notify with the message's priority
+    first_post = dict(data, attachments=[])
+    later_post = { k : v for k, v in data.items() if k not in ('priority', 'attachments') }
+    later_post['attachments'] = []
+
+    # Room left for the text, or the fields, of one attachment
+    overhead = max(_size(dict(first_post, attachments=[dict(head, text='', **tail)])),
+                   _size(dict(later_post, attachments=[dict(follow, text='', **tail)])))
+    budget = max(64, max_bytes - overhead)
+
+    chunks = _split_text(attachment.get('text', ''), budget)
+    segments = [ dict(head if i == 0 else follow, text=chunk) for i, chunk in enumerate(chunks) ]
+    if not segments:
+        segments = [dict(head)]
+
+    for page in _split_fields(attachment.get('fields', []), budget):
+        last = segments[-1]
+        # Allowing a little for the 'fields' key itself
+        if 'fields' not in last and _size(last.get('text', '')) + _size(page) + 16 <= budget:
+            last['fields'] = page
+        else:
+            segments.append(dict(common, fields=page))
+    segments[-1].update(tail)
+    segments.extend(data['attachments'][1:])
+
+    # Pack the attachments into as few posts as they fit in, keeping their order
+    posts = []
+    post = first_post
+    for segment in segments:
+        if post['attachments'] and _size(dict(post, attachments=post['attachments'] + [segment])) > max_bytes:
+            posts.append(post)
+            if title and 'title' not in segment:
+                segment = dict(segment, title=title + _CONTINUED)
+            post = dict(later_post, attachments=[])
+        post['attachments'] = post['attachments'] + [segment]
+    posts.append(post)
+    return posts
+
+####################################################################################################
+def _size(value) -> int:
+    """
+    Number of bytes value takes up once encoded as JSON
+    """
+    return len(encode_payload(value))
+
+####################################################################################################
+def _split_text(text : str, budget : int) -> List[str]:
+    """
+    Split text into chunks which each take up at most budget bytes once encoded, at line boundaries
+    where possible, closing and reopening any code block which is cut in two
+    """
+    if text == '':
+        return []
+
+    closing = _size('\n' + _FENCE) - 2
+    chunks = []
+    lines = []
+    size = 0
+    fence = None # Line which opened the code block we are in, if any
+
+    for line in text.split('\n'):
+        limit = budget - closing - (_size(fence) if fence is not None else 0)
+        for piece in _split_line(line, limit):
+            n = _size(piece)
+            if lines and size + n + closing > budget:
+                chunk = '\n'.join(lines)
+                if fence is not None:
+                    chunk += '\n' + _FENCE
+                chunks.append(chunk)
+                lines = [fence] if fence is not None else []
+                size = _size(fence) if fence is not None else 0
+            lines.append(piece)
+            size += n
+        if line.lstrip().startswith(_FENCE):
+            fence = line.strip() if fence is None else None
+
+    chunks.append('\n'.join(lines))
+    return chunks
+
+def _split_line(line : str, limit : int) -> List[str]:
+    """
+    Cut a line which takes up more than limit bytes once encoded into pieces which do not
+    """
+    limit = max(16, limit)
+    size = _size(line)
+    if size <= limit:
+        return [line]
+
+    # Guess from the line's average bytes per character, then shrink each piece until it fits
+    step = max(1, len(line) * limit // size)
+    pieces = []
+    while line:
+        n = step
+        while n > 1 and _size(line[:n]) > limit:
+            n //= 2
+        pieces.append(line[:n])
+        line = line[n:]
+    return pieces
+
+####################################################################################################
+def _split_fields(fields : List[dict], budget : int) -> List[List[dict]]:
+    """
+    Split fields into pages which each take up at most budget bytes once encoded, cutting the value
+    of any field which would not fit on a page by itself across several fields
+    """
+    pages = []
+    page = []
+    size = 2
+    for field in fields:
+        for piece in _split_field(field, budget - 3):
+            n = _size(piece) + 1
+            if page and size + n > budget:
+                pages.append(page)
+                page = []
+                size = 2
+            page.append(piece)
+            size += n
+    if page:
+        pages.append(page)
+    return pages
+
+def _split_field(field : dict, budget : int) -> List[dict]:
+    """
+    Cut a field which takes up more than budget bytes once encoded into fields which do not, the
+    later ones titled as continuations
+    """
+    if _size(field) <= budget:
+        return [field]
+    title = field.get('title', '')
+    follow = dict(field, title=title + _CONTINUED)
+    chunks = _split_text(field.get('value', ''), max(64, budget - _size(dict(follow, value=''))))
+    return [ dict(field if i == 0 else follow, value=chunk) for i, chunk in enumerate(chunks) ]
@@ -0,0 +1,246 @@
+import os
+import threading
+from typing import Callable, Union
+import weakref
+
+from .serialise import encode_payload
+
+####################################################################################################
+class MattermostSpool:
+    """
+    Durable, append-only journal of message payloads which could not be posted, so that they
+    survive Mattermost or network outages and restarts of the process. Give one to a
+    MattermostInterface and any message which fails to post is appended to the journal and replayed,
+    in order, once the webhook can be reached again:
+
+        interface = MattermostInterface('.mattermost_url.txt', spool=MattermostSpool('alerts.spool'))
+
+    The journal at path holds one JSON payload per line. The byte offset of the first payload not
+    yet replayed is kept in path + '.offset', which is replaced atomically after every replayed
+    payload, so a crash during replay resends at most one message. The offset file also records
+    which journal file it belongs to, so it is ignored if a crash left it behind a compaction. A
+    payload only partially written when the process died is discarded when the journal is reopened.
+
+    Disk usage is bounded by max_bytes: replayed payloads are compacted away when they make up more
+    than half of the journal, and if the journal is still full the oldest pending payloads are
+    dropped to make room.
+
+    fsync : sync every append to disk, which also survives power loss but is much slower
+    """
+    def __init__(self, path : str, max_bytes : int = 64*1024*1024, fsync : bool = False):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.dropped = 0 # Number of pending payloads discarded to stay within max_bytes
+        self._lock = threading.RLock()
+        self._replay_lock = threading.Lock()
+        self._base = 0 # Bytes compacted away since the journal was opened
+        self._file = None
+        self._open()
+        _spools.add(self)
+        return
+
+    def _reset_after_fork(self) -> None:
+        """
+        Called in the child after a fork: the locks may have been held by another of the parent's
+        threads, such as one replaying the spool
+        """
+        self._lock = threading.RLock()
+        self._replay_lock = threading.Lock()
+        return
+
+    ####################################################################################################
+    def __len__(self):
+        return self._pending
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    ####################################################################################################
+    def _open(self) -> None:
+        """
+        Open the journal, recovering from a crash if necessary
+        """
+        self._file = open(self.path, 'a+b')
+        self._ino = os.fstat(self._file.fileno()).st_ino
+
+        # The offset only applies to the journal file it was written for
+        self._offset = 0
+        if os.path.exists(self.offset_path):
+            with open(self.offset_path, 'r') as file:
+                try:
+                    offset, ino = [ int(x) for x in file.read().split() ]
+                    if ino == self._ino:
+                        self._offset = offset
+                except ValueError:
+                    pass
+
+        # Discard any partially written payload at the end of the journal
+        self._file.seek(0)
+        size = 0
+        self._pending = 0
+        for line in self._file:
+            if not line.endswith(b'\n'):
+                break
+            if size >= self._offset:
+                self._pending += 1
+            size += len(line)
+        self._file.truncate(size)
+        self._file.seek(size)
+        self._size = size
+        self._offset = min(self._offset, size)
+        return
+
+    ####################################################################################################
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        return
+
+    ####################################################################################################
+    def append(self, data : Union[dict, bytes]) -> bool:
+        """
+        Add a payload, either as a dict or already JSON-encoded, to the end of the journal. Returns
+        false if it is bigger than max_bytes
+        """
+        line = encode_payload(data) + b'\n'
+        if len(line) > self.max_bytes:
+            return False
+
+        with self._lock:
+            if self._size + len(line) > self.max_bytes:
+                self._make_room(len(line))
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._size += len(line)
+            self._pending += 1
+        return True
+
+    ####################################################################################################
+    def _make_room(self, nbytes : int) -> None:
+        """
+        Compact the journal and, if that is not enough, drop the oldest pending payloads until there
+        is room for nbytes more. Must hold the lock
+        """
+        if self._offset > 0:
+            self.compact()
+        if self._size + nbytes <= self.max_bytes:
+            return
+
+        self._file.seek(self._offset)
+        offset = self._offset
+        for line in self._file:
+            if self._size - (offset - self._offset) + nbytes <= self.max_bytes:
+                break
+            offset += len(line)
+            self._pending -= 1
+            self.dropped += 1
+        self._file.seek(0, os.SEEK_END)
+        self._set_offset(offset)
+        self.compact()
+        return
+
+    ####################################################################################################
+    def _set_offset(self, offset : int) -> None:
+        """
+        Atomically record the offset of the first pending payload. Must hold the lock
+        """
+        tmp = self.offset_path + '.tmp'
+        with open(tmp, 'w') as file:
+            file.write(f"{offset} {self._ino}")
+            if self.fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(tmp, self.offset_path)
+        self._offset = offset
+        return
+
+    ####################################################################################################
+    def compact(self) -> None:
+        """
+        Rewrite the journal without the payloads which have already been replayed
+        """
+        with self._lock:
+            if self._offset == 0:
+                return
+            tmp = self.path + '.tmp'
+            self._file.flush()
+            self._file.seek(self._offset)
+            with open(tmp, 'wb') as file:
+                while True:
+                    chunk = self._file.read(1024*1024)
+                    if not chunk:
+                        break
+                    file.write(chunk)
+                file.flush()
+                os.fsync(file.fileno())
+            self._file.close()
+
+            # If we crash between these two steps the old offset is ignored, as it was written for
+            # the old journal file
+            os.replace(tmp, self.path)
+            self._file = open(self.path, 'a+b')
+            self._ino = os.fstat(self._file.fileno()).st_ino
+            self._base += self._offset
+            self._set_offset(0)
+            self._size = self._file.seek(0, os.SEEK_END)
+        return
+
+    ####################################################################################################
+    def replay(self, send : Callable[[bytes], bool]) -> int:
+        """
+        Pass the pending JSON-encoded payloads, oldest first, to send, which returns true once the
+        payload has been posted (or should be discarded). Stops at the first payload which could not be sent so that the order is kept. Returns
+        the number of payloads sent. The journal stays open for appending while payloads are sent
+        """
+        sent = 0
+        with self._replay_lock:
+            while True:
+                with self._lock:
+                    if self._file is None:
+                        break
+                    start = self._base + self._offset
+                    self._file.flush()
+                    self._file.seek(self._offset)
+                    line = self._file.readline()
+                    self._file.seek(0, os.SEEK_END)
+                if not line:
+                    break
+
+                body = line.rstrip(b'\n')
+                if body:
+                    if not send(body):
+                        break
+                    sent += 1
+
+                with self._lock:
+                    # Unless the payload was dropped to make room while it was being sent
+                    if self._base + self._offset == start:
+                        self._set_offset(self._offset + len(line))
+                        self._pending -= 1
+
+            with self._lock:
+                if self._file is not None and self._offset > self._size // 2:
+                    self.compact()
+        return sent
+
+####################################################################################################
+# Every spool, so that they can be made safe to use in the child after a fork
+_spools = weakref.WeakSet()
+
+def _after_fork_in_child() -> None:
+    for spool in list(_spools):
+        spool._reset_after_fork()
+    return
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
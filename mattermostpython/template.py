@@ -0,0 +1,83 @@
+from typing import Dict, List
+
+from .mattermostpython import MattermostField, MattermostMessage
+
+####################################################################################################
+class MattermostTemplate:
+    """
+    A precompiled message shape, for sending many messages which only differ in a few places. The
+    template takes the same arguments as MattermostMessage, which are defaulted and validated once,
+    and the message payload is built once. render() then only substitutes the parts which change
+    into a copy of that payload, which can be posted by any interface in place of a message:
+
+        template = MattermostTemplate(title='Rate monitor', colour='#FF0000',
+                                      fields=[MattermostField(True, 'Run', ''), MattermostField(True, 'Rate', '')])
+        interface.post( template.render(text='Rate dropped', field_values={'Run': '42', 'Rate': '3 Hz'}) )
+
+    The rendered payloads share the unchanged parts of the template, so treat them as read-only
+    """
+    def __init__(self, **kwargs):
+        message = MattermostMessage(**kwargs)
+
+        # Only work out the notification from the rest of the message if none was given
+        notification_message = kwargs.get('notification_message')
+        if notification_message is None:
+            notification_message = MattermostMessage.resolve_profile(kwargs.get('profile')).notification_message
+        self._fixed_notification = notification_message != ''
+
+        self._data = message.get_message_data()
+        self._attachment = self._data['attachments'][0]
+        self._fields = self._attachment.get('fields', [])
+        self._field_index = { field['title'] : i for i, field in enumerate(self._fields) }
+        self._title = message.get_title()
+        self._pretext = message.get_pretext()
+        self._text = message.get_text()
+        return
+
+    ####################################################################################################
+    def render(self, text : str = None, title : str = None, pretext : str = None,
+               field_values : Dict[str, str] = None, fields : List[MattermostField] = None) -> dict:
+        """
+        Get the message payload with the given text, title and pretext, the values of the template's
+        fields with the given titles replaced, and any extra fields appended
+        """
+        attachment = self._attachment.copy()
+        if text is not None:
+            _set_or_remove(attachment, 'text', text)
+        if title is not None:
+            _set_or_remove(attachment, 'title', title)
+        if pretext is not None:
+            _set_or_remove(attachment, 'pretext', pretext)
+
+        if not self._fixed_notification and (text is not None or title is not None or pretext is not None):
+            attachment['fallback'] = (
+                (self._title if title is None else title) or
+                (self._pretext if pretext is None else pretext) or
+                (self._text if text is None else text) or
+                'ALERT!'
+            )
+
+        if field_values or fields:
+            rows = self._fields.copy()
+            if field_values:
+                for name, value in field_values.items():
+                    i = self._field_index[name]
+                    rows[i] = {"short" : rows[i]['short'], "title" : name, "value" : value}
+            if fields:
+                rows.extend([ {"short" : x.short, "title" : x.title, "value" : x.value} for x in fields ])
+            attachment['fields'] = rows
+
+        data = self._data.copy()
+        data['attachments'] = [attachment]
+        return data
+
+####################################################################################################
+def _set_or_remove(attachment : dict, key : str, value : str) -> None:
+    """
+    Empty values are left out of the payload, as MattermostMessage does
+    """
+    if value != '':
+        attachment[key] = value
+    else:
+        attachment.pop(key, None)
+    return
@@ -1,5 +1,21 @@
+import concurrent.futures
+import contextlib
+import gc
+import io
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+import requests
 import mattermostpython as mp
+from benchmarks.webhook_server import StandInWebhookServer
 
 ICON_URL = 'https://upload.wikimedia.org/wikipedia/commons/c/c3/Python-logo-notext.svg'
 
@@ -132,5 +148,1155 @@ class MattermostPythonTest( unittest.TestCase ):
             message = mp.MattermostMessage.create_message_from_exception(e)
             self.assertTrue( self.interface.post(message) )
 
+class MattermostInterfaceOfflineTest( unittest.TestCase ):
+    """
+    Tests which run against a local stand-in webhook server rather than a real Mattermost server
+    """
+    def setUp(self):
+        self.server = StandInWebhookServer().start()
+        self.interface = mp.MattermostInterface(self.server.url)
+
+    def tearDown(self):
+        self.interface.close()
+        self.server.stop()
+
+    def test_post(self):
+        message = mp.MattermostMessage(title='TEST MESSAGE TITLE', text='TEST MESSAGE TEXT')
+        self.assertTrue( self.interface.post(message) )
+        self.assertEqual( self.server.payloads, [message.get_message_data()] )
+
+    def test_connection_reused(self):
+        for i in range(5):
+            self.assertTrue( self.interface.post(mp.MattermostMessage(text=f'MESSAGE {i}')) )
+        self.assertEqual( self.server.requests, 5 )
+        self.assertEqual( self.server.connections, 1 )
+
+    def test_context_manager(self):
+        with mp.MattermostInterface(self.server.url, pool_maxsize=2) as interface:
+            self.assertTrue( interface.post(mp.MattermostMessage()) )
+        self.assertIsNone( interface._session )
+
+    def test_post_async(self):
+        for i in range(20):
+            self.assertTrue( self.interface.post_async(mp.MattermostMessage(text=f'MESSAGE {i}')) )
+        self.assertTrue( self.interface.flush(5) )
+        self.assertEqual( [ x['attachments'][0]['text'] for x in self.server.payloads ], [ f'MESSAGE {i}' for i in range(20) ] )
+
+    def test_post_async_drop_newest(self):
+        self.server.latency = 0.2
+        interface = mp.MattermostInterface(self.server.url, queue_size=1, queue_policy=mp.MattermostQueuePolicy.DROP_NEWEST)
+        results = [ interface.post_async(mp.MattermostMessage(text=f'MESSAGE {i}')) for i in range(5) ]
+        interface.close(5)
+        self.assertFalse( all(results) )
+        self.assertEqual( interface.get_dropped_count(), results.count(False) )
+        self.assertEqual( self.server.requests, results.count(True) )
+
+    def test_post_async_drop_oldest(self):
+        self.server.latency = 0.2
+        interface = mp.MattermostInterface(self.server.url, queue_size=1, queue_policy=mp.MattermostQueuePolicy.DROP_OLDEST)
+        for i in range(5):
+            self.assertTrue( interface.post_async(mp.MattermostMessage(text=f'MESSAGE {i}')) )
+        interface.close(5)
+        self.assertEqual( self.server.payloads[-1]['attachments'][0]['text'], 'MESSAGE 4' )
+        self.assertEqual( self.server.requests + interface.get_dropped_count(), 5 )
+
+    def test_post_async_while_closing(self):
+        self.server.latency = 0.2
+        interface = mp.MattermostInterface(self.server.url)
+        self.assertTrue( interface.post_async(mp.MattermostMessage(text='FIRST')) )
+        closer = threading.Thread(target=interface.close, args=(5,))
+        closer.start()
+        time.sleep(0.05)
+        interface.post_async(mp.MattermostMessage(text='DURING'))
+        closer.join()
+        # Nothing was left behind on the closed queue, and the interface can be used again
+        self.assertEqual( interface._threads, [] )
+        self.assertEqual( interface.get_queue_depth(), 0 )
+        self.assertTrue( interface.post_async(mp.MattermostMessage(text='AFTER')) )
+        self.assertTrue( interface.flush(5) )
+        self.assertEqual( self.server.payloads[-1]['attachments'][0]['text'], 'AFTER' )
+        interface.close()
+
+    def test_close_timeout(self):
+        self.server.latency = 0.3
+        interface = mp.MattermostInterface(self.server.url)
+        for i in range(3):
+            self.assertTrue( interface.post_async(mp.MattermostMessage(text=f'MESSAGE {i}')) )
+        time.sleep(0.05)
+        interface.close(0.1)
+        self.assertEqual( interface.get_dropped_count(), 2 )
+        # The worker still sending the first message must not open a new pool once it finishes
+        time.sleep(0.4)
+        self.assertIsNone( interface._session )
+        self.assertEqual( self.server.requests, 1 )
+
+    def test_atexit_registered_once(self):
+        with mock.patch.object(mp.mattermostpython.atexit, 'register') as register:
+            interface = mp.MattermostInterface(self.server.url)
+            for i in range(3):
+                self.assertTrue( interface.post_async(mp.MattermostMessage()) )
+                interface.close(5)
+        calls = [ x for x in register.call_args_list if x[0][0] is mp.mattermostpython._flush_at_exit ]
+        self.assertEqual( len(calls), 1 )
+
+    def test_urgent_overtakes_backlog(self):
+        # Load test: posting the backlog in order would take 5s, but the urgent message goes next
+        self.server.latency = 0.005
+        standard = mp.MattermostMessage(text='STANDARD').get_message_data()
+        for i in range(1000):
+            self.assertTrue( self.interface.post_async(standard) )
+        time.sleep(0.05)
+        start = time.perf_counter()
+        self.interface.post_async(mp.MattermostMessage(text='URGENT', priority=mp.MattermostMessagePriority.URGENT))
+        while not any( x['attachments'][0]['text'] == 'URGENT' for x in list(self.server.payloads) ):
+            self.assertLess( time.perf_counter() - start, 1.0 )
+            time.sleep(0.001)
+        self.assertGreater( self.interface.get_queue_depths()[mp.MattermostMessagePriority.STANDARD], 500 )
+        self.server.latency = 0.0
+        self.assertTrue( self.interface.flush(10) )
+        self.assertEqual( self.server.requests, 1001 )
+
+    def test_unknown_priority(self):
+        get_priority = mp.mattermostpython._get_priority
+        self.assertEqual( get_priority(mp.MattermostMessage(priority='')), mp.MattermostMessagePriority.STANDARD )
+        self.assertEqual( get_priority(mp.MattermostMessage(priority='urgent')), mp.MattermostMessagePriority.URGENT )
+        self.assertEqual( get_priority({'priority' : 'urgent'}), mp.MattermostMessagePriority.STANDARD )
+        self.assertEqual( get_priority({'priority' : {'priority' : ['urgent']}}), mp.MattermostMessagePriority.STANDARD )
+        self.assertTrue( self.interface.post_async(mp.MattermostMessage(text='EMPTY', priority='')) )
+        self.assertTrue( self.interface.flush(5) )
+        self.assertEqual( self.server.requests, 1 )
+
+    def test_priority_budgets(self):
+        queue = mp.mattermostpython._DeliveryQueue(1000, mp.MattermostQueuePolicy.BLOCK, aging=None)
+        for i in range(100):
+            queue.put('standard', priority=0)
+            queue.put('urgent', priority=2)
+        order = [ queue.get() for i in range(90) ]
+        # Urgent messages get 8 of every 9 sends, and standard ones are never starved
+        self.assertEqual( order.count('standard'), 10 )
+        self.assertLessEqual( max( len(x) for x in ''.join( x[0] for x in order ).split('s') ), 8 )
+
+        # Standard messages which have waited too long compete with the important ones
+        queue = mp.mattermostpython._DeliveryQueue(1000, mp.MattermostQueuePolicy.BLOCK, aging=0.0)
+        queue.put('standard', priority=0)
+        queue.put('important', priority=1)
+        self.assertEqual( queue.get(), 'important' )
+        self.assertEqual( queue.get_depths()[mp.MattermostMessagePriority.IMPORTANT], 1 )
+
+        with self.assertRaises(ValueError):
+            mp.MattermostInterface(self.server.url, priority_budgets={mp.MattermostMessagePriority.URGENT : 1})
+
+    def test_drop_lowest_priority(self):
+        queue = mp.mattermostpython._DeliveryQueue(2, mp.MattermostQueuePolicy.DROP_NEWEST)
+        self.assertTrue( queue.put('standard 1', priority=0) )
+        self.assertTrue( queue.put('standard 2', priority=0) )
+        self.assertFalse( queue.put('standard 3', priority=0) )
+        self.assertTrue( queue.put('urgent', priority=2) )
+        self.assertEqual( [queue.get(), queue.get()], ['urgent', 'standard 1'] )
+        self.assertEqual( queue.dropped, 2 )
+
+        queue = mp.mattermostpython._DeliveryQueue(2, mp.MattermostQueuePolicy.DROP_OLDEST)
+        self.assertTrue( queue.put('urgent 1', priority=2) )
+        self.assertTrue( queue.put('urgent 2', priority=2) )
+        self.assertFalse( queue.put('standard', priority=0) )
+        self.assertTrue( queue.put('urgent 3', priority=2) )
+        self.assertEqual( [queue.get(), queue.get()], ['urgent 2', 'urgent 3'] )
+        self.assertEqual( queue.dropped, 2 )
+
+    def test_post_many(self):
+        messages = [ mp.MattermostMessage(text=f'MESSAGE {i}') for i in range(3) ]
+        webhooks = [ self.server.url_for('a'), self.server.url_for('b') ]
+        results = self.interface.post_many(messages, webhooks, max_workers=4)
+        self.assertEqual( len(results), 6 )
+        self.assertTrue( all(results) )
+        self.assertEqual( [ x.url for x in results ], webhooks*3 )
+        self.assertEqual( [ x.message for x in results ], [ messages[i//2] for i in range(6) ] )
+        self.assertEqual( sorted(self.server.paths), ['/hooks/a']*3 + ['/hooks/b']*3 )
+
+    def test_post_return_result(self):
+        self.server.script(429, {'Retry-After': '0'})
+        result = self.interface.post(mp.MattermostMessage(), return_result=True)
+        self.assertTrue( result )
+        self.assertEqual( (result.status_code, result.attempts), (200, 2) )
+        self.server.script(400, body=b'invalid payload')
+        result = self.interface.post(mp.MattermostMessage(), return_result=True)
+        self.assertFalse( result )
+        self.assertEqual( (result.status_code, result.response_text, result.retryable), (400, 'invalid payload', False) )
+        self.server.script(503)
+        self.assertTrue( self.interface.post(mp.MattermostMessage(), return_result=True).retryable )
+
+    def test_post_many_error(self):
+        self.server.stop()
+        results = self.interface.post_many([mp.MattermostMessage()])
+        self.assertFalse( results[0] )
+        self.assertIsNone( results[0].status_code )
+        self.assertIsNotNone( results[0].error )
+        self.assertTrue( results[0].retryable )
+        self.server = StandInWebhookServer().start()
+
+class WebhookResolutionTest( unittest.TestCase ):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'webhook.txt')
+
+    def tearDown(self):
+        mp.MattermostInterface.close_shared()
+        self.tmpdir.cleanup()
+
+    def write(self, url):
+        with open(self.path, 'w') as file:
+            file.write('# comment\n' + url + '\n')
+
+    def test_file_reread_when_changed(self):
+        self.write('https://example.com/hooks/one')
+        self.assertEqual( mp.MattermostInterface(self.path).url, 'https://example.com/hooks/one' )
+        self.write('https://example.com/hooks/twotwo')
+        self.assertEqual( mp.MattermostInterface(self.path).url, 'https://example.com/hooks/twotwo' )
+
+    def test_file_cached(self):
+        self.write('https://example.com/hooks/one')
+        mp.MattermostInterface(self.path)
+        stat = os.stat(self.path)
+        with open(self.path, 'r+') as file:
+            file.write('# not a url\n')
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual( mp.MattermostInterface(self.path).url, 'https://example.com/hooks/one' )
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            mp.MattermostInterface('not a url')
+        self.write('no url here')
+        with self.assertRaises(ValueError):
+            mp.MattermostInterface(self.path)
+
+    def test_shared(self):
+        self.write('https://example.com/hooks/one')
+        interface = mp.MattermostInterface.get_shared(self.path)
+        self.assertIs( mp.MattermostInterface.get_shared('https://example.com/hooks/one'), interface )
+        self.assertIsNot( mp.MattermostInterface.get_shared('https://example.com/hooks/two'), interface )
+
+class MattermostRateLimiterOfflineTest( unittest.TestCase ):
+    def setUp(self):
+        self.server = StandInWebhookServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_token_bucket(self):
+        limiter = mp.MattermostRateLimiter(rate=20, burst=5)
+        waits = [ limiter.reserve() for i in range(10) ]
+        self.assertEqual( waits[:5], [0.0]*5 )
+        self.assertAlmostEqual( waits[9], 0.25, delta=0.02 )
+
+    def test_shared_per_url(self):
+        interface = mp.MattermostInterface(self.server.url, rate_limit=50)
+        self.assertIs( mp.MattermostRateLimiter.for_url(self.server.url), interface.rate_limiter )
+        self.assertEqual( interface.rate_limiter.rate, 50 )
+        interface.close()
+
+    def test_retry_after(self):
+        interface = mp.MattermostInterface(self.server.url)
+        self.server.script(429, {'Retry-After': '0.3'})
+        start = time.monotonic()
+        self.assertTrue( interface.post(mp.MattermostMessage()) )
+        self.assertGreaterEqual( time.monotonic() - start, 0.3 )
+        self.assertEqual( self.server.requests, 2 )
+        self.assertEqual( len(self.server.payloads), 1 )
+        interface.close()
+
+    def test_remaining_exhausted(self):
+        limiter = mp.MattermostRateLimiter()
+        self.assertEqual( limiter.update(200, {'X-Ratelimit-Remaining': '0', 'X-Ratelimit-Reset': '2'}), 0 )
+        self.assertAlmostEqual( limiter.reserve(), 2, delta=0.05 )
+
+class MattermostRetryPolicyOfflineTest( unittest.TestCase ):
+    def setUp(self):
+        self.server = StandInWebhookServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_retry_status(self):
+        policy = mp.MattermostRetryPolicy(max_attempts=3, backoff=0.01)
+        interface = mp.MattermostInterface(self.server.url, retry_policy=policy)
+        self.server.script(503, count=2)
+        self.assertTrue( interface.post(mp.MattermostMessage()) )
+        self.assertEqual( self.server.requests, 3 )
+        interface.close()
+
+    def test_no_retry_on_client_error(self):
+        interface = mp.MattermostInterface(self.server.url, retry_policy=mp.MattermostRetryPolicy(backoff=0.01))
+        self.server.script(400)
+        self.assertFalse( interface.post(mp.MattermostMessage()) )
+        self.assertEqual( self.server.requests, 1 )
+        interface.close()
+
+    def test_ambiguous_not_retried(self):
+        self.server.latency = 0.3
+        interface = mp.MattermostInterface(self.server.url, timeout=0.1, retry_policy=mp.MattermostRetryPolicy(backoff=0.01))
+        with self.assertRaises(requests.ReadTimeout):
+            interface.post(mp.MattermostMessage())
+        time.sleep(0.4)
+        self.assertEqual( self.server.requests, 1 )
+        interface.close()
+
+    def test_connection_refused_retried(self):
+        url = self.server.url
+        self.server.stop()
+        interface = mp.MattermostInterface(url, retry_policy=mp.MattermostRetryPolicy(max_attempts=3, backoff=0.01))
+        attempts = []
+        policy = interface.retry_policy
+        should_retry = policy.should_retry
+        policy.should_retry = lambda attempt, *args: attempts.append(attempt) or should_retry(attempt, *args)
+        with self.assertRaises(requests.ConnectionError):
+            interface.post(mp.MattermostMessage())
+        self.assertEqual( attempts, [1, 2, 3] )
+        self.server = StandInWebhookServer().start()
+
+    def test_deadline(self):
+        policy = mp.MattermostRetryPolicy(max_attempts=100, backoff=0.1, jitter=False, deadline=0.5)
+        interface = mp.MattermostInterface(self.server.url, retry_policy=policy)
+        self.server.script(503, count=100)
+        start = time.monotonic()
+        self.assertFalse( interface.post(mp.MattermostMessage()) )
+        self.assertLess( time.monotonic() - start, 0.5 )
+        self.assertLess( self.server.requests, 5 )
+        interface.close()
+
+    def test_deadline_bounds_rate_limit_wait(self):
+        interface = mp.MattermostInterface(self.server.url, retry_policy=mp.MattermostRetryPolicy(deadline=0.5))
+        self.server.script(429, {'Retry-After' : '3'})
+        self.assertFalse( interface.post(mp.MattermostMessage()) )
+        # The limiter now holds posts for 3 s, which is past the deadline, so don't wait at all
+        start = time.monotonic()
+        result = interface.post(mp.MattermostMessage(), return_result=True)
+        self.assertLess( time.monotonic() - start, 0.5 )
+        self.assertFalse( result.ok )
+        self.assertEqual( result.status_code, 429 )
+        self.assertEqual( result.attempts, 0 )
+        self.assertEqual( self.server.requests, 1 )
+        interface.close()
+
+class MattermostSpoolTest( unittest.TestCase ):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'test.spool')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_replay_in_order(self):
+        with mp.MattermostSpool(self.path) as spool:
+            for i in range(5):
+                spool.append({'text': i})
+            sent = []
+            self.assertEqual( spool.replay(lambda x: len(sent) < 3 and sent.append(json.loads(x)['text']) is None), 3 )
+            self.assertEqual( sent, [0, 1, 2] )
+            self.assertEqual( len(spool), 2 )
+
+        # Reopening carries on where we left off
+        with mp.MattermostSpool(self.path) as spool:
+            self.assertEqual( len(spool), 2 )
+            spool.replay(lambda x: sent.append(json.loads(x)['text']) is None)
+            self.assertEqual( sent, [0, 1, 2, 3, 4] )
+            self.assertEqual( len(spool), 0 )
+            self.assertEqual( os.path.getsize(self.path), 0 )
+
+    def test_partial_write_discarded(self):
+        with mp.MattermostSpool(self.path) as spool:
+            spool.append({'text': 'complete'})
+        with open(self.path, 'ab') as file:
+            file.write(b'{"text": "trunc')
+        with mp.MattermostSpool(self.path) as spool:
+            self.assertEqual( len(spool), 1 )
+            spool.append({'text': 'after'})
+            sent = []
+            spool.replay(lambda x: sent.append(json.loads(x)['text']) is None)
+        self.assertEqual( sent, ['complete', 'after'] )
+
+    def test_bounded_size(self):
+        with mp.MattermostSpool(self.path, max_bytes=200) as spool:
+            for i in range(100):
+                spool.append({'text': f'{i:03d}'})
+            self.assertLessEqual( os.path.getsize(self.path), 200 )
+            self.assertEqual( len(spool) + spool.dropped, 100 )
+            sent = []
+            spool.replay(lambda x: sent.append(json.loads(x)['text']) is None)
+        self.assertEqual( sent[-1], '099' )
+        self.assertEqual( sent, sorted(sent) )
+
+    def test_interface_spools_failures(self):
+        with StandInWebhookServer() as server:
+            interface = mp.MattermostInterface(server.url, spool=mp.MattermostSpool(self.path))
+            server.script(503, count=2)
+            self.assertFalse( interface.post(mp.MattermostMessage(text='FIRST')) )
+            self.assertFalse( interface.post(mp.MattermostMessage(text='SECOND')) )
+            self.assertEqual( len(interface.spool), 2 )
+            # The spooled messages are posted first, so everything arrives in order
+            self.assertTrue( interface.post(mp.MattermostMessage(text='THIRD')) )
+            self.assertEqual( [ x['attachments'][0]['text'] for x in server.payloads ], ['FIRST', 'SECOND', 'THIRD'] )
+            self.assertEqual( len(interface.spool), 0 )
+            # SECOND was spooled behind FIRST without being sent
+            self.assertEqual( server.requests, 5 )
+            interface.close()
+            interface.spool.close()
+
+class MattermostMessageTest( unittest.TestCase ):
+    def test_slots(self):
+        message = mp.MattermostMessage(fields=[mp.MattermostField(True, 'Title 1', 'Value 1')])
+        message.get_message_data()
+        self.assertFalse( hasattr(message, '__dict__') )
+        self.assertFalse( hasattr(message.get_fields()[0], '__dict__') )
+        with self.assertRaises(AttributeError):
+            message.dict
+
+    def test_payload_rebuilt(self):
+        message = mp.MattermostMessage(text='BEFORE')
+        self.assertEqual( message.get_message_data()['attachments'][0]['text'], 'BEFORE' )
+        message.set_text('AFTER')
+        self.assertEqual( message.get_message_data()['attachments'][0]['text'], 'AFTER' )
+
+class MattermostProfileTest( unittest.TestCase ):
+    def tearDown(self):
+        mp.MattermostMessage.set_default_profile( mp.MattermostProfile() )
+
+    def test_immutable(self):
+        profile = mp.MattermostProfile('immutable', username='BEFORE', colour='not a colour')
+        self.assertEqual( profile.colour, '' )
+        with self.assertRaises(AttributeError):
+            profile.username = 'AFTER'
+        changed = profile.replace(username='AFTER')
+        self.assertEqual( (profile.username, changed.username, changed.name), ('BEFORE', 'AFTER', 'immutable') )
+
+    def test_select_by_name(self):
+        mp.MattermostProfile.register( mp.MattermostProfile('daq', username='DAQ', colour='#0000FF') )
+        self.assertEqual( mp.MattermostMessage(profile='daq').get_username(), 'DAQ' )
+        self.assertEqual( mp.MattermostMessage(profile='daq', username='OTHER').get_username(), 'OTHER' )
+        self.assertEqual( mp.MattermostMessage().get_username(), '' )
+        self.assertEqual( mp.MattermostInterface('http://127.0.0.1:8065/hooks/abc', profile='daq').create_message(text='x').get_colour(), '#0000FF' )
+        with self.assertRaises(ValueError):
+            mp.MattermostMessage(profile='not registered')
+
+    def test_fields_copied_on_write(self):
+        mp.MattermostMessage.add_default_field( mp.MattermostField(True, 'Default', 'Value') )
+        first = mp.MattermostMessage()
+        second = mp.MattermostMessage()
+        first.add_field( mp.MattermostField(True, 'Extra', 'Value') )
+        first.get_fields()[0].value = 'Changed'
+        self.assertEqual( len(first.get_fields()), 2 )
+        self.assertEqual( [ x.value for x in second.get_fields() ], ['Value'] )
+        self.assertEqual( [ x.value for x in mp.MattermostMessage.get_default_profile().fields ], ['Value'] )
+        self.assertEqual( len(second.get_message_data()['attachments'][0]['fields']), 1 )
+
+    def test_concurrent_defaults(self):
+        # Every thread's change to the defaults is kept, and messages never see half a change
+        def work(i):
+            mp.MattermostMessage.add_default_field( mp.MattermostField(True, str(i), str(i)) )
+            mp.MattermostMessage.set_default_title(str(i))
+            message = mp.MattermostMessage()
+            return message.get_title() != '' and len(message.get_fields()) > 0
+
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            self.assertTrue( all(pool.map(work, range(200))) )
+        self.assertEqual( len(mp.MattermostMessage.get_default_profile().fields), 200 )
+
+class ExceptionFormattingTest( unittest.TestCase ):
+    @staticmethod
+    def recurse(n):
+        if n == 0:
+            raise ValueError('BOTTOM')
+        ExceptionFormattingTest.recurse(n - 1)
+
+    def catch(self, n=0):
+        try:
+            self.recurse(n)
+        except ValueError as e:
+            return e
+
+    def test_outside_except_block(self):
+        error = self.catch()
+        text = mp.MattermostMessage.create_message_from_exception(error).get_text()
+        self.assertIn( 'in recurse', text )
+        self.assertIn( 'ValueError: BOTTOM', text )
+
+    def test_truncation(self):
+        error = self.catch(50)
+        self.assertIn( '[Previous line repeated', mp.format_exception(error) )
+        self.assertLessEqual( mp.format_exception(error, max_frames=5).count('File '), 5 )
+        text = mp.format_exception(error, max_length=500)
+        self.assertLessEqual( len(text), 504 )
+        self.assertTrue( text.startswith('...\n') )
+        self.assertTrue( text.endswith('ValueError: BOTTOM') )
+
+    def test_fingerprint(self):
+        self.assertEqual( mp.exception_fingerprint(self.catch()), mp.exception_fingerprint(self.catch()) )
+        self.assertNotEqual( mp.exception_fingerprint(self.catch()), mp.exception_fingerprint(self.catch(1)) )
+
+    def test_reporter_dedup(self):
+        with StandInWebhookServer() as server:
+            with mp.MattermostInterface(server.url) as interface:
+                reporter = mp.MattermostExceptionReporter(interface, window=60, use_queue=False)
+                self.assertTrue( reporter.report(self.catch()) )
+                for i in range(100):
+                    self.assertFalse( reporter.report(self.catch()) )
+                self.assertTrue( reporter.report(self.catch(1)) )
+                self.assertEqual( reporter.suppressed, 100 )
+                self.assertEqual( reporter.flush(), 1 )
+                self.assertEqual( reporter.flush(), 0 )
+
+                reporter.window = 0
+                reporter.report(self.catch(1))
+                reporter.report(self.catch(1))
+            self.assertEqual( server.requests, 5 )
+            self.assertEqual( server.payloads[2]['attachments'][0]['title'], 'ValueError (repeated 100 more times)' )
+
+    def test_reporter_lru(self):
+        with mp.MattermostInterface('https://example.com/hooks/x') as interface:
+            reporter = mp.MattermostExceptionReporter(interface, max_entries=2)
+            reporter._send = lambda message, timeout=None: True
+            for n in (0, 1, 0, 2, 1):
+                reporter.report(self.catch(n))
+            self.assertEqual( reporter.suppressed, 1 )
+
+class SerialiseTest( unittest.TestCase ):
+    def tearDown(self):
+        mp.set_json_backend(mp.get_json_backends()[0])
+
+    def test_backends_agree(self):
+        data = mp.MattermostMessage(title='TITLE \u00b5', text='TEXT\n"quoted"', fields=[mp.MattermostField(True, 'a', 'b')]).get_message_data()
+        for backend in mp.get_json_backends():
+            mp.set_json_backend(backend)
+            body = mp.encode_payload(data)
+            self.assertIsInstance( body, bytes )
+            self.assertNotIn( b'\n', body )
+            self.assertEqual( json.loads(body), data )
+            self.assertIs( mp.encode_payload(body), body )
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            mp.set_json_backend('nonexistent')
+
+class LazyImportTest( unittest.TestCase ):
+    def test_heavy_modules_not_imported(self):
+        code = ("import sys, mattermostpython; "
+                "print(' '.join(x for x in ['requests', 'validators', 'aiohttp', 'asyncio', 'traceback', 'orjson', 'json', 'socketserver'] if x in sys.modules))")
+        result = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        self.assertEqual( result.stdout.strip(), '' )
+
+class MattermostHandlerOfflineTest( unittest.TestCase ):
+    def setUp(self):
+        mp.MattermostMessage.set_default_title('')
+        self.server = StandInWebhookServer().start()
+        self.interface = mp.MattermostInterface(self.server.url)
+        self.logger = logging.getLogger('mattermostpython.test')
+        self.logger.propagate = False
+
+    def tearDown(self):
+        for handler in self.logger.handlers[:]:
+            self.logger.removeHandler(handler)
+            handler.close()
+        self.interface.close()
+        self.server.stop()
+
+    def test_exception(self):
+        handler = mp.MattermostHandler(self.interface, flush_interval=60)
+        self.logger.addHandler(handler)
+        self.logger.info('NOT SENT')
+        try:
+            1/0
+        except ZeroDivisionError:
+            self.logger.exception('DIVISION FAILED')
+        self.assertEqual( self.server.requests, 0 )
+        handler.close()
+        self.assertEqual( self.server.requests, 1 )
+        data = self.server.payloads[0]
+        self.assertEqual( data['priority'], {'priority': 'important'} )
+        self.assertEqual( data['attachments'][0]['title'], 'ERROR: mattermostpython.test' )
+        self.assertTrue( data['attachments'][0]['text'].startswith('DIVISION FAILED\n```python\nTraceback') )
+        self.assertIn( 'ZeroDivisionError', data['attachments'][0]['text'] )
+
+    def test_batch(self):
+        handler = mp.MattermostHandler(self.interface, level=logging.WARNING, batch_size=5, flush_interval=60)
+        self.logger.addHandler(handler)
+        for i in range(4):
+            self.logger.warning('WARNING %d', i)
+        self.logger.critical('CRITICAL')
+        for i in range(50):
+            if self.server.requests:
+                break
+            time.sleep(0.1)
+        self.assertEqual( self.server.requests, 1 )
+        data = self.server.payloads[0]
+        self.assertEqual( data['priority'], {'priority': 'urgent'} )
+        self.assertEqual( data['attachments'][0]['title'], 'CRITICAL: 5 log records' )
+        self.assertIn( 'WARNING 3', data['attachments'][0]['text'] )
+
+    def test_buffer_bounded(self):
+        handler = mp.MattermostHandler(self.interface, batch_size=1000, flush_interval=60, max_buffer=10)
+        self.logger.addHandler(handler)
+        for i in range(25):
+            self.logger.error('ERROR %d', i)
+        self.assertEqual( handler.dropped, 15 )
+
+    def test_close_bounded(self):
+        self.server.latency = 0.5
+        handler = mp.MattermostHandler(self.interface, batch_size=1, flush_interval=60, close_timeout=0.2)
+        self.logger.addHandler(handler)
+        for i in range(5):
+            self.logger.error('ERROR %d', i)
+        output = io.StringIO()
+        start = time.monotonic()
+        with contextlib.redirect_stdout(output):
+            self.logger.removeHandler(handler)
+            handler.close()
+        self.assertLess( time.monotonic() - start, 1.5 )
+        # The background thread may still be posting the first record
+        self.assertGreaterEqual( handler.dropped, 3 )
+        self.assertIn( f'WARNING - gave up posting {handler.dropped} log records', output.getvalue() )
+
+    def test_failed_batch_reported_once(self):
+        handler = mp.MattermostHandler(self.interface, batch_size=10, flush_interval=60)
+        self.logger.addHandler(handler)
+        for i in range(5):
+            self.logger.error('ERROR %d', i)
+        self.server.script(400)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            handler.flush()
+        self.assertEqual( output.getvalue(), 'WARNING - failed to post 5 log records to Mattermost\n' )
+
+class CommandLineOfflineTest( unittest.TestCase ):
+    def setUp(self):
+        self.server = StandInWebhookServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def run_cli(self, *args, stdin=''):
+        return subprocess.run([sys.executable, '-m', 'mattermostpython', '--webhook', self.server.url] + list(args),
+                              input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    def test_single_message(self):
+        result = self.run_cli('--title', 'TITLE', '--priority', 'urgent', '--short-field', 'Run=42')
+        self.assertEqual( result.returncode, 0, result.stderr )
+        data = self.server.payloads[0]
+        self.assertEqual( data['priority'], {'priority': 'urgent'} )
+        self.assertEqual( data['attachments'][0]['title'], 'TITLE' )
+        self.assertEqual( data['attachments'][0]['fields'], [{'short': True, 'title': 'Run', 'value': '42'}] )
+
+    def test_stream(self):
+        lines = ['first line', '{"title": "JSON", "text": "from json", "priority": "important"}', ''] + ['repeat']*50
+        result = self.run_cli('--stream', '--title', 'LOG', stdin='\n'.join(lines) + '\n')
+        self.assertEqual( result.returncode, 0, result.stderr )
+        texts = [ (x['attachments'][0]['title'], x['attachments'][0]['text']) for x in self.server.payloads ]
+        # The important message may overtake the standard one queued before it
+        self.assertCountEqual( texts[:2], [('LOG', 'first line'), ('JSON', 'from json')] )
+        self.assertEqual( texts[2], ('LOG', 'repeat') )
+        self.assertEqual( texts[3][0], 'LOG (repeated 49 more times)' )
+        self.assertEqual( len(texts), 4 )
+
+    def test_stream_distinct_lines(self):
+        # Lines under the same title are only collapsed if their text repeats too
+        lines = [ f'line {i}' for i in range(100) ]
+        result = self.run_cli('--stream', '--title', 'LOG', stdin='\n'.join(lines) + '\n')
+        self.assertEqual( result.returncode, 0, result.stderr )
+        self.assertEqual( [ x['attachments'][0]['text'] for x in self.server.payloads ], lines )
+
+    def test_stream_terminated(self):
+        # What has been read is still posted when the stream is terminated
+        self.server.latency = 0.2
+        process = subprocess.Popen([sys.executable, '-m', 'mattermostpython', '--webhook', self.server.url, '--stream'],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        process.stdin.write(''.join( f'line {i}\n' for i in range(3) ))
+        process.stdin.flush()
+        for i in range(100):
+            if self.server.in_flight or self.server.requests:
+                break
+            time.sleep(0.05)
+        process.send_signal(signal.SIGTERM)
+        process.stdin.close()
+        stderr = process.stderr.read()
+        self.assertEqual( process.wait(10), 0, stderr )
+        self.assertEqual( [ x['attachments'][0]['text'] for x in self.server.payloads ], [ f'line {i}' for i in range(3) ] )
+        process.stdout.close()
+        process.stderr.close()
+
+    def test_bad_webhook(self):
+        result = subprocess.run([sys.executable, '-m', 'mattermostpython', '--webhook', 'nonsense'],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual( result.returncode, 2 )
+
+class SplitPayloadTest( unittest.TestCase ):
+    def test_small_payload_untouched(self):
+        data = mp.MattermostMessage(text='SHORT').get_message_data()
+        self.assertEqual( mp.split_payload(data), [data] )
+
+    def test_oversized_field_cut(self):
+        traceback = '\n'.join( f'  File "analysis.py", line {i}, in sort' for i in range(1000) )
+        for value in [traceback, 'x'*30000]:
+            data = mp.MattermostMessage(title='CRASH', fields=[mp.MattermostField(False, 'Traceback', value),
+                                                               mp.MattermostField(True, 'Run', '42')]).get_message_data()
+            parts = mp.split_payload(data)
+            fields = []
+            for part in parts:
+                self.assertLessEqual( len(mp.encode_payload(part)), mp.split.DEFAULT_MAX_PAYLOAD_BYTES )
+                fields.extend( x for attachment in part['attachments'] for x in attachment.get('fields', []) )
+            self.assertEqual( [ x['title'] for x in fields[:2] ], ['Traceback', 'Traceback (continued)'] )
+            self.assertEqual( fields[-1]['title'], 'Run' )
+            separator = '\n' if '\n' in value else ''
+            self.assertEqual( separator.join( x['value'] for x in fields[:-1] ), value )
+
+    def test_text_split_keeps_fences(self):
+        lines = [ f'line {i} ' + 'x'*50 for i in range(200) ]
+        text = 'Traceback:\n```python\n' + '\n'.join(lines) + '\n```\ndone'
+        data = mp.MattermostMessage(title='CRASH', text=text, footer='FOOTER').get_message_data()
+        parts = mp.split_payload(data, max_bytes=2000)
+        self.assertGreater( len(parts), 1 )
+        texts = []
+        for part in parts:
+            self.assertLessEqual( len(mp.encode_payload(part)), 2000 )
+            text = part['attachments'][0]['text']
+            self.assertEqual( text.count('```') % 2, 0 )
+            texts.append(text)
+        self.assertEqual( parts[0]['attachments'][0]['title'], 'CRASH' )
+        self.assertEqual( parts[1]['attachments'][0]['title'], 'CRASH (continued)' )
+        self.assertNotIn( 'priority', parts[1] )
+        self.assertEqual( parts[-1]['attachments'][-1]['footer'], 'FOOTER' )
+        joined = [ x for text in texts for x in text.split('\n') if not x.startswith('```') ]
+        self.assertEqual( joined, ['Traceback:'] + lines + ['done'] )
+
+    def test_long_line(self):
+        data = mp.MattermostMessage(text='\u00e9'*10000).get_message_data()
+        parts = mp.split_payload(data, max_bytes=3000)
+        self.assertTrue( all( len(mp.encode_payload(x)) <= 3000 for x in parts ) )
+        self.assertEqual( ''.join( x['attachments'][0]['text'] for x in parts ), '\u00e9'*10000 )
+
+    def test_fields_paginated(self):
+        fields = [ mp.MattermostField(True, f'Channel {i}', f'{i} Hz') for i in range(300) ]
+        data = mp.MattermostMessage(title='RATES', fields=fields).get_message_data()
+        parts = mp.split_payload(data, max_bytes=2000)
+        self.assertGreater( len(parts), 1 )
+        self.assertTrue( all( len(mp.encode_payload(x)) <= 2000 for x in parts ) )
+        titles = [ field['title'] for part in parts for attachment in part['attachments'] for field in attachment['fields'] ]
+        self.assertEqual( titles, [ x.title for x in fields ] )
+
+    def test_interface_posts_parts_in_order(self):
+        text = '\n'.join( f'LINE {i}' for i in range(2000) )
+        with StandInWebhookServer() as server:
+            with mp.MattermostInterface(server.url, max_payload_bytes=4000) as interface:
+                self.assertTrue( interface.post(mp.MattermostMessage(text=text)) )
+                self.assertTrue( interface.post_async(mp.MattermostMessage(text=text)) )
+                interface.flush(5)
+            self.assertEqual( server.connections, 1 )
+        texts = [ x['attachments'][0]['text'] for x in server.payloads ]
+        half = len(texts) // 2
+        self.assertGreater( half, 1 )
+        self.assertEqual( '\n'.join(texts[:half]), text )
+        self.assertEqual( '\n'.join(texts[half:]), text )
+
+class CrashReporterOfflineTest( unittest.TestCase ):
+    script = (
+        "import threading, mattermostpython as mp\n"
+        "mp.install_crash_reporter(mp.MattermostInterface({url!r}), exit_timeout={exit_timeout})\n"
+        "thread = threading.Thread(target=lambda: 1/0, name='WORKER')\n"
+        "thread.start()\n"
+        "thread.join()\n"
+        "raise ValueError('MAIN')\n"
+    )
+
+    def run_script(self, server, exit_timeout):
+        return subprocess.run([sys.executable, '-c', self.script.format(url=server.url, exit_timeout=exit_timeout)],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    def test_crashes_reported(self):
+        with StandInWebhookServer() as server:
+            result = self.run_script(server, 5.0)
+        self.assertEqual( result.returncode, 1 )
+        self.assertIn( 'ValueError: MAIN', result.stderr )
+        self.assertEqual( sorted( x['attachments'][0]['title'] for x in server.payloads ),
+                          ['Unhandled ValueError', 'Unhandled ZeroDivisionError in WORKER'] )
+
+    def test_exit_not_held_up(self):
+        with StandInWebhookServer(latency=10) as server:
+            start = time.monotonic()
+            result = self.run_script(server, 0.5)
+            self.assertLess( time.monotonic() - start, 5 )
+        self.assertEqual( result.returncode, 1 )
+
+    def test_full_queue_at_exit(self):
+        # The queue is full and the server slow, with repeat counts waiting to be flushed at exit
+        script = (
+            "import mattermostpython as mp\n"
+            "interface = mp.MattermostInterface({url!r}, queue_size=3, timeout=10)\n"
+            "reporter = mp.install_crash_reporter(interface, exit_timeout=0.5)\n"
+            "for i in range(5):\n"
+            "    interface.post_async(mp.MattermostMessage(text=str(i)), timeout=0)\n"
+            "for error in [ValueError, KeyError, TypeError]:\n"
+            "    for i in range(2):\n"
+            "        try:\n"
+            "            raise error()\n"
+            "        except Exception as e:\n"
+            "            reporter.report(e, timeout=0)\n"
+            "raise ValueError('MAIN')\n"
+        )
+        with StandInWebhookServer(latency=10) as server:
+            start = time.monotonic()
+            result = subprocess.run([sys.executable, '-c', script.format(url=server.url)],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            self.assertLess( time.monotonic() - start, 2.0 )
+        self.assertEqual( result.returncode, 1 )
+        self.assertIn( 'ValueError: MAIN', result.stderr )
+
+    def test_uninstall(self):
+        hook = sys.excepthook
+        with mp.MattermostInterface('https://example.com/hooks/x') as interface:
+            mp.install_crash_reporter(interface)
+            self.assertIsNot( sys.excepthook, hook )
+            mp.uninstall_crash_reporter()
+        self.assertIs( sys.excepthook, hook )
+
+def _post_from_worker(args):
+    path, worker = args
+    client = mp.MattermostSenderClient(path)
+    sent = [ client.post(mp.MattermostMessage(title=f'WORKER {worker}', text=f'MESSAGE {i}')) for i in range(5) ]
+    client.close()
+    return sent.count(True)
+
+@unittest.skipUnless( hasattr(os, 'fork'), 'needs fork' )
+class MattermostSenderDaemonOfflineTest( unittest.TestCase ):
+    def setUp(self):
+        self.server = StandInWebhookServer().start()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'mattermost.sock')
+
+    def tearDown(self):
+        self.server.stop()
+        self.directory.cleanup()
+
+    def test_pool_workers(self):
+        import multiprocessing
+        daemon = mp.MattermostSenderDaemon(mp.MattermostInterface(self.server.url), self.path).start()
+        with multiprocessing.get_context('fork').Pool(4) as pool:
+            self.assertEqual( pool.map(_post_from_worker, [ (self.path, i) for i in range(8) ]), [5]*8 )
+        daemon.stop(5)
+        self.assertEqual( self.server.requests, 40 )
+        self.assertEqual( self.server.connections, 1 )
+        self.assertFalse( os.path.exists(self.path) )
+
+    def test_coalescing(self):
+        with mp.MattermostSenderDaemon(mp.MattermostInterface(self.server.url), self.path, coalesce_window=60):
+            with mp.MattermostSenderClient(self.path) as client:
+                for i in range(10):
+                    self.assertTrue( client.post(mp.MattermostMessage(title='SAME', text=f'{i}')) )
+        self.assertEqual( self.server.requests, 2 )
+        self.assertEqual( self.server.payloads[1]['attachments'][0]['title'], 'SAME (repeated 9 more times)' )
+
+    def test_no_daemon(self):
+        self.assertFalse( mp.MattermostSenderClient(self.path).post(mp.MattermostMessage()) )
+
+    def test_interface_after_fork(self):
+        interface = mp.MattermostInterface(self.server.url)
+        self.assertTrue( interface.post(mp.MattermostMessage(text='PARENT')) )
+        pid = os.fork()
+        if pid == 0:
+            # The child gets its own connection rather than the parent's
+            ok = interface._session is None and interface.post(mp.MattermostMessage(text='CHILD'))
+            os._exit(0 if ok else 1)
+        self.assertEqual( os.waitpid(pid, 0)[1], 0 )
+        self.assertTrue( interface.post(mp.MattermostMessage(text='PARENT')) )
+        interface.close()
+        self.assertEqual( self.server.requests, 3 )
+        self.assertEqual( self.server.connections, 2 )
+
+    def test_defaults_after_fork(self):
+        # Locks held by another of the parent's threads at the fork must not deadlock the child
+        with mp.MattermostMessage._default_profile_lock, mp.MattermostProfile._profiles_lock:
+            pid = os.fork()
+            if pid == 0:
+                signal.alarm(5)
+                mp.MattermostMessage.set_default_title('CHILD')
+                mp.MattermostProfile.register( mp.MattermostProfile('child') )
+                os._exit(0 if mp.MattermostMessage().get_title() == 'CHILD' else 1)
+        self.assertEqual( os.waitpid(pid, 0)[1], 0 )
+
+    def test_locks_after_fork(self):
+        metrics = mp.MattermostMetrics()
+        spool = mp.MattermostSpool(os.path.join(self.directory.name, 'test.spool'))
+        interface = mp.MattermostInterface(self.server.url, metrics=metrics, spool=spool)
+        with mp.MattermostSenderDaemon(mp.MattermostInterface(self.server.url), self.path):
+            client = mp.MattermostSenderClient(self.path)
+            self.assertTrue( client.post(mp.MattermostMessage(text='PARENT')) )
+            with metrics._lock, spool._lock, spool._replay_lock, client._lock:
+                pid = os.fork()
+                if pid == 0:
+                    signal.alarm(5)
+                    ok = interface.post(mp.MattermostMessage(text='CHILD')) and interface.replay_spool() == 0
+                    ok = ok and client.post(mp.MattermostMessage(text='CHILD'))
+                    os._exit(0 if ok else 1)
+            self.assertEqual( os.waitpid(pid, 0)[1], 0 )
+            client.close()
+        interface.close()
+        spool.close()
+        self.assertEqual( self.server.requests, 3 )
+
+    def test_message_round_trip(self):
+        message = mp.MattermostMessage(username='USER', priority=mp.MattermostMessagePriority.URGENT, colour='#FF0000',
+                                       title='TITLE', text='TEXT', footer='FOOTER', message_info='INFO',
+                                       fields=[mp.MattermostField(True, 'a', 'b')])
+        data = message.get_message_data()
+        self.assertEqual( mp.MattermostMessage.from_message_data(data).get_message_data(), data )
+
+class MattermostAPIInterfaceOfflineTest( unittest.TestCase ):
+    """
+    Tests against the stand-in's mock of the REST API's posts endpoint
+    """
+    def setUp(self):
+        self.server = StandInWebhookServer().start()
+        host, port = self.server._server.server_address[:2]
+        self.api = mp.MattermostAPIInterface(f"http://{host}:{port}/", self.server.token, 'CHANNEL')
+
+    def tearDown(self):
+        self.api.close()
+        self.server.stop()
+
+    def test_create_and_update(self):
+        post_id = self.api.create_post( mp.MattermostMessage(username='USER', title='BEFORE', priority=mp.MattermostMessagePriority.URGENT) )
+        self.assertEqual( self.server.posts[post_id]['channel_id'], 'CHANNEL' )
+        self.assertEqual( self.server.posts[post_id]['metadata'], {'priority': {'priority': 'urgent'}} )
+        self.assertEqual( self.server.posts[post_id]['props']['override_username'], 'USER' )
+        self.assertTrue( self.api.update_post(post_id, mp.MattermostMessage(title='AFTER')) )
+        self.assertEqual( self.server.posts[post_id]['props']['attachments'][0]['title'], 'AFTER' )
+        self.assertFalse( self.api.update_post('missing', mp.MattermostMessage()) )
+        self.assertIsNone( mp.MattermostAPIInterface(self.api.api_url[:-len('/api/v4')], 'wrong token', 'CHANNEL').create_post({}) )
+
+    def test_live_post_sends_latest(self):
+        live = mp.MattermostLivePost(self.api, interval=0.2)
+        start = time.monotonic()
+        for i in range(50):
+            live.update( mp.MattermostMessage(text=f'STATE {i}') )
+            time.sleep(0.01)
+        live.close()
+        elapsed = time.monotonic() - start
+        self.assertEqual( len(self.server.posts), 1 )
+        self.assertEqual( self.server.posts[live.post_id]['props']['attachments'][0]['text'], 'STATE 49' )
+        # At most one request per interval, and the states in between were skipped
+        self.assertLessEqual( self.server.requests, elapsed / 0.2 + 2 )
+        self.assertEqual( live.sent + live.skipped, 50 )
+
+    def test_live_post_retries(self):
+        self.server.script(500)
+        with mp.MattermostLivePost(self.api, interval=0.05) as live:
+            live.update( mp.MattermostMessage(text='STATE') )
+            time.sleep(0.2)
+        self.assertEqual( self.server.posts[live.post_id]['props']['attachments'][0]['text'], 'STATE' )
+
+    def test_progress(self):
+        with mp.MattermostProgress(self.api, 'JOB', total=10, interval=60) as progress:
+            for i in range(10):
+                progress.advance(Current=f'file {i}')
+        post = self.server.posts[progress.live.post_id]
+        attachment = post['props']['attachments'][0]
+        self.assertEqual( attachment['title'], 'JOB (finished)' )
+        self.assertEqual( attachment['color'], mp.MattermostProgress.COLOUR_FINISHED )
+        fields = { x['title'] : x['value'] for x in attachment['fields'] }
+        self.assertIn( '10/10 (100%)', fields['Progress'] )
+        self.assertEqual( fields['Current'], 'file 9' )
+        self.assertEqual( self.server.requests, 2 )
+
+        with self.assertRaises(RuntimeError):
+            with mp.MattermostProgress(self.api, 'JOB', interval=60) as progress:
+                raise RuntimeError('broken')
+        attachment = self.server.posts[progress.live.post_id]['props']['attachments'][0]
+        self.assertEqual( (attachment['title'], attachment['text']), ('JOB (failed)', 'RuntimeError: broken') )
+
+class BenchmarkSuiteTest( unittest.TestCase ):
+    def test_injected_faults(self):
+        with StandInWebhookServer(throttle_rate=0.5, failure_rate=0.5, seed=1) as server:
+            with mp.MattermostInterface(server.url) as interface:
+                results = [ interface.post(mp.MattermostMessage()) for i in range(20) ]
+        self.assertEqual( server.throttled + server.failed, server.requests )
+        self.assertGreater( server.throttled, 0 )
+        self.assertFalse( any(results) )
+
+    def test_suite(self):
+        from benchmarks import bench_suite
+        results = bench_suite.run_suite(200, 10, 2, only=['serialise', 'post_sequential'])
+        self.assertEqual( sorted(results), ['post_sequential', 'post_sequential_faults', 'serialise'] )
+        self.assertEqual( results['post_sequential_faults']['posted'], 10 )
+        for result in results.values():
+            self.assertGreater( result['messages_per_s'], 0 )
+            self.assertLessEqual( result['p50_us'], result['p99_us'] )
+        json.dumps(results)
+
+class MattermostTemplateTest( unittest.TestCase ):
+    def setUp(self):
+        mp.MattermostMessage.set_default_title('')
+
+    def test_matches_message(self):
+        fields = [ mp.MattermostField(True, 'Run', ''), mp.MattermostField(True, 'Rate', '') ]
+        template = mp.MattermostTemplate(title='TITLE', colour='#FF0000', fields=fields)
+        rendered = template.render(text='TEXT', field_values={'Rate': '3 Hz'}, fields=[mp.MattermostField(False, 'Extra', 'x')])
+        message = mp.MattermostMessage(title='TITLE', colour='#FF0000', text='TEXT', fields=[
+            mp.MattermostField(True, 'Run', ''), mp.MattermostField(True, 'Rate', '3 Hz'), mp.MattermostField(False, 'Extra', 'x')
+        ])
+        self.assertEqual( rendered, message.get_message_data() )
+
+    def test_notification_from_text(self):
+        template = mp.MattermostTemplate(colour='#FF0000')
+        self.assertEqual( template.render()['attachments'][0]['fallback'], 'ALERT!' )
+        self.assertEqual( template.render(text='TEXT')['attachments'][0]['fallback'], 'TEXT' )
+        self.assertEqual( template.render(text='TEXT', title='TITLE')['attachments'][0]['fallback'], 'TITLE' )
+
+    def test_template_unchanged(self):
+        template = mp.MattermostTemplate(text='ORIGINAL', fields=[mp.MattermostField(True, 'Run', '1')])
+        template.render(text='', field_values={'Run': '2'})
+        rendered = template.render()
+        self.assertEqual( rendered['attachments'][0]['text'], 'ORIGINAL' )
+        self.assertEqual( rendered['attachments'][0]['fields'][0]['value'], '1' )
+
+    def test_post_rendered(self):
+        with StandInWebhookServer() as server:
+            with mp.MattermostInterface(server.url) as interface:
+                rendered = mp.MattermostTemplate(title='TITLE').render(text='TEXT')
+                self.assertTrue( interface.post(rendered) )
+            self.assertEqual( server.payloads, [rendered] )
+
+class MattermostMetricsOfflineTest( unittest.TestCase ):
+    def setUp(self):
+        self.server = StandInWebhookServer().start()
+        self.metrics = mp.MattermostMetrics()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_counters(self):
+        policy = mp.MattermostRetryPolicy(max_attempts=2, backoff=0.01)
+        interface = mp.MattermostInterface(self.server.url, retry_policy=policy, metrics=self.metrics)
+        events = []
+        self.metrics.add_hook('before_send', lambda url, body: events.append('before'))
+        self.metrics.add_hook('after_send', lambda url, status_code, elapsed: events.append(status_code))
+        self.server.script(503)
+        self.assertTrue( interface.post(mp.MattermostMessage()) )
+        self.server.script(400)
+        self.assertFalse( interface.post(mp.MattermostMessage()) )
+        counters = self.metrics.get_counters()
+        self.assertEqual( (counters['sent'], counters['failed'], counters['retried'], counters['requests']), (1, 1, 1, 3) )
+        self.assertGreater( counters['bytes_sent'], 0 )
+        self.assertEqual( events, ['before', 503, 'before', 200, 'before', 400] )
+        self.assertEqual( self.metrics.get_latency_histogram()[float('inf')], 3 )
+        interface.close()
+
+    def test_errors(self):
+        url = self.server.url
+        self.server.stop()
+        interface = mp.MattermostInterface(url, metrics=self.metrics)
+        errors = []
+        self.metrics.add_hook('on_error', lambda url, error: errors.append(error))
+        self.assertEqual( interface.post_many([mp.MattermostMessage()])[0].error, errors[0] )
+        self.assertEqual( self.metrics.get_counters()['failed'], 1 )
+        self.server = StandInWebhookServer().start()
+
+    def test_dropped_and_coalesced(self):
+        self.server.latency = 0.2
+        interface = mp.MattermostInterface(self.server.url, queue_size=1, metrics=self.metrics,
+                                           queue_policy=mp.MattermostQueuePolicy.DROP_NEWEST)
+        coalescer = mp.MattermostCoalescer(interface, window=60)
+        for i in range(3):
+            coalescer.post(mp.MattermostMessage(title='SAME'))
+        for i in range(3):
+            interface.post_async(mp.MattermostMessage(title=f'DIFFERENT {i}'))
+        self.assertEqual( self.metrics.get_queue_depths(), {interface.metrics_name: 1} )
+        counters = self.metrics.get_counters()
+        self.assertEqual( counters['coalesced'], 2 )
+        self.assertGreaterEqual( counters['dropped'], 2 )
+        coalescer.close()
+        interface.close(5)
+
+    def test_prometheus(self):
+        interface = mp.MattermostInterface(self.server.url, metrics=self.metrics)
+        interface.post(mp.MattermostMessage())
+        text = self.metrics.to_prometheus()
+        self.assertIn( 'mattermost_sent_total 1\n', text )
+        self.assertIn( 'mattermost_request_duration_seconds_bucket{le="+Inf"} 1\n', text )
+        self.assertIn( 'mattermost_request_duration_seconds_count 1\n', text )
+        self.assertIn( f'mattermost_queue_depth{{queue="{interface.metrics_name}"}} 0\n', text )
+        self.assertNotIn( interface.url, text )
+        interface.close()
+
+    def test_queue_name(self):
+        interface = mp.MattermostInterface(self.server.url, metrics=self.metrics, metrics_name='alerts')
+        self.assertEqual( self.metrics.get_queue_depths(), {'alerts': 0} )
+        interface.close()
+
+    def test_queue_forgotten(self):
+        interface = mp.MattermostInterface(self.server.url, metrics=self.metrics)
+        self.assertTrue( interface.metrics_name.startswith('127.0.0.1-') )
+        del interface
+        gc.collect()
+        self.assertEqual( self.metrics.get_queue_depths(), {} )
+        self.assertEqual( self.metrics._queues, [] )
+
+class MattermostCoalescerOfflineTest( unittest.TestCase ):
+    def setUp(self):
+        self.server = StandInWebhookServer().start()
+        self.interface = mp.MattermostInterface(self.server.url)
+
+    def tearDown(self):
+        self.interface.close()
+        self.server.stop()
+
+    def test_storm(self):
+        with mp.MattermostCoalescer(self.interface, window=60, max_rows=3, use_queue=False) as coalescer:
+            for i in range(100):
+                self.assertTrue( coalescer.post(mp.MattermostMessage(title='TRIP', text=f'READING {i}')) )
+            self.assertTrue( coalescer.post(mp.MattermostMessage(title='OTHER')) )
+            self.assertEqual( self.server.requests, 2 )
+        self.assertEqual( coalescer.coalesced, 99 )
+        self.assertEqual( self.server.requests, 3 )
+        digest = self.server.payloads[-1]['attachments'][0]
+        self.assertEqual( digest['title'], 'TRIP (repeated 99 more times)' )
+        self.assertEqual( digest['text'], 'READING 99' )
+        self.assertEqual( digest['fields'][0]['value'], '100' )
+        self.assertEqual( [ x['value'] for x in digest['fields'][3:] ], ['READING 1', 'READING 2', 'READING 3', '... and 96 more'] )
+
+    def test_window_closes(self):
+        with mp.MattermostCoalescer(self.interface, window=0.1, use_queue=False) as coalescer:
+            coalescer.post(mp.MattermostMessage(title='TRIP'))
+            coalescer.post(mp.MattermostMessage(title='TRIP'))
+            time.sleep(0.5)
+            self.assertEqual( self.server.requests, 2 )
+            coalescer.post(mp.MattermostMessage(title='TRIP'))
+            self.assertEqual( self.server.requests, 3 )
+        self.assertEqual( self.server.requests, 3 )
+
+class AsyncMattermostInterfaceOfflineTest( unittest.IsolatedAsyncioTestCase ):
+    def setUp(self):
+        self.server = StandInWebhookServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    async def test_post(self):
+        message = mp.MattermostMessage(title='TEST MESSAGE TITLE', text='TEST MESSAGE TEXT')
+        async with mp.AsyncMattermostInterface(self.server.url) as interface:
+            self.assertTrue( await interface.post(message) )
+        self.assertEqual( self.server.payloads, [message.get_message_data()] )
+
+    async def test_post_many(self):
+        self.server.latency = 0.05
+        messages = [ mp.MattermostMessage(text=f'MESSAGE {i}') for i in range(8) ]
+        async with mp.AsyncMattermostInterface(self.server.url, max_in_flight=2) as interface:
+            self.assertEqual( await interface.post_many(messages), [True]*8 )
+        self.assertEqual( self.server.requests, 8 )
+        self.assertLessEqual( self.server.max_in_flight, 2 )
+
+    async def test_post_return_result(self):
+        self.server.script(500, body=b'server error')
+        async with mp.AsyncMattermostInterface(self.server.url) as interface:
+            results = await interface.post_many([mp.MattermostMessage(), mp.MattermostMessage()], return_result=True)
+        self.assertEqual( sorted( x.status_code for x in results ), [200, 500] )
+        failed = [ x for x in results if not x ][0]
+        self.assertEqual( (failed.response_text, failed.retryable, failed.attempts), ('server error', True, 1) )
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file